@@ -93,16 +93,17 @@ def zh_experiment0(dir_list, args):
     param_combos = itertools.product(
             vec_types, num_unit_list, projection_list, num_hidden_layer_list)
     pardo(_zh_experiment0_helper, param_combos, 10, exp_name=experiment_name,
-            relation_list=relation_list, label_vector=label_vector, label_alphabet=label_alphabet)
+            relation_list=relation_list, label_vector=label_vector, label_alphabet=label_alphabet,
+            dir_list=dir_list[0:2])
 
 
 def _zh_experiment0_helper(vec_type, num_units, projection, num_hidden_layers, 
-        exp_name, relation_list, label_vector, label_alphabet):
+        exp_name, relation_list, label_vector, label_alphabet, dir_list=None):
     params = [vec_type, str(num_units), projection, str(num_hidden_layers)] 
     file_name = '%s-%s' % (experiment_name, '-'.join(params))
     json_file = util.set_logger(file_name)
 
-    word2vec_ff = util._get_zh_word2vec_ff(num_units, vec_type, projection)
+    word2vec_ff = util._get_zh_word2vec_ff(num_units, vec_type, projection, dir_list)
     data_matrix_pair = word2vec_ff(relation_list) 
 
     learning_rate = 0.001
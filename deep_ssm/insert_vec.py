@@ -1,52 +1,84 @@
-import json
-import re
-import sys
+"""Save the DSSM and CDSSM vectors of the relations
+
+python insert_vec.py pdtb-data.json > pdtb-data-plus.json
 
-from collections import namedtuple
+The vectors are saved as .npy sidecar files next to the data file so that
+they can be memory-mapped. They are not in the json, which only passes 
+the relations through. The rows line up with the relations by ID.
 
+	[prefix].ids.npy : doc_relation_id of each relation in order
+	[prefix].DSSMSource.npy, [prefix].CDSSMTarget.npy, etc. :
+		float32 num relations x 2 (Arg1, Arg2) x num units
 
-class SemVectorPair(object):
+See dense_feature_functions.VectorSidecar and 
+feature_functions.DSSMFeaturizer
+"""
+import argparse
+import json
+import os
 
-	def __init__(self, src_vec, target_vec):
-		#self.src_vec = '[%s]' % re.sub(' ', ',', src_vec)
-		self.src_vec = [float(x) for x in src_vec.split(' ')]
-		#self.target_vec = '[%s]' % re.sub(' ', ',', target_vec)
-		self.target_vec = [float(x) for x in target_vec.split(' ')]
+import numpy as np
 
 def parse_dssm_output_file(output_file):
-	svp_list = []
-	while True:
-		sim_line = output_file.readline()
-		if sim_line == '':
-			break
-		src_line = output_file.readline().strip().split(': ')[1]
-		target_line = output_file.readline().strip().split(': ')[1]
-		svp_list.append(SemVectorPair(src_line, target_line))
-	return svp_list
+	"""Parse the sent2vec output into matrices
 
-if __name__ == '__main__':
-	file_name = sys.argv[1]
-	relations = [json.loads(x) for x in open(file_name)]
+	Each vector pair takes three lines: the similarity, the source vector,
+	and the target vector. All of the vectors are parsed at once.
+
+	Returns the source matrix and the target matrix
+	"""
+	lines = output_file.read().splitlines()
+	num_pairs = len(lines) / 3
+	src_lines = [x.strip().split(': ')[1] for x in lines[1:3 * num_pairs:3]]
+	target_lines = [x.strip().split(': ')[1] for x in lines[2:3 * num_pairs:3]]
+	src_matrix = np.fromstring(' '.join(src_lines), sep=' ').reshape(num_pairs, -1)
+	target_matrix = np.fromstring(' '.join(target_lines), sep=' ').reshape(num_pairs, -1)
+	return src_matrix, target_matrix
+
+def arg_vectors(src_matrix, target_matrix, num_relations):
+	"""Arrange the vectors by relation and arg
 
-	dssm_file = open('tmp_dssm_vec.out')
-	dssm_vectors = parse_dssm_output_file(dssm_file)
-	assert(len(dssm_vectors) == 2 * len(relations))
+	The first half of the pairs is Arg1 -> Arg2 and the second half is Arg2 -> Arg1
 
-	cdssm_file = open('tmp_cdssm_vec.out')
-	cdssm_vectors = parse_dssm_output_file(cdssm_file)
-	assert(len(cdssm_vectors) == 2 * len(relations))
+	Returns the source and target tensors (num relations x 2 x num units)
+	"""
+	source = np.concatenate([src_matrix[:num_relations, None, :],
+		src_matrix[num_relations:, None, :]], axis=1)
+	target = np.concatenate([target_matrix[num_relations:, None, :],
+		target_matrix[:num_relations, None, :]], axis=1)
+	return source, target
 
+def write_sidecar(prefix, relations, vector_dict):
+	ids = np.array(['%s_%s' % (x['DocID'], x['ID']) for x in relations])
+	np.save('%s.ids.npy' % prefix, ids)
+	for name, tensor in vector_dict.items():
+		np.save('%s.%s.npy' % (prefix, name), tensor.astype(np.float32))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser()
+	parser.add_argument('file_name', help='pdtb-data.json')
+	parser.add_argument('--sidecar_prefix', default=None,
+		help='where to save the .npy files. Default: pdtb-data-plus next to the data file')
+	args = parser.parse_args()
+	file_name = args.file_name
+	sidecar_prefix = args.sidecar_prefix
+	if sidecar_prefix is None:
+		sidecar_prefix = os.path.join(os.path.dirname(file_name), 'pdtb-data-plus')
+	relations = [json.loads(x) for x in open(file_name)]
 	num_relations = len(relations)
-	for i, relation in enumerate(relations):
-		relation['Arg1']['DSSMSource'] = dssm_vectors[i].src_vec
-		relation['Arg2']['DSSMTarget'] = dssm_vectors[i].target_vec
-		relation['Arg1']['CDSSMSource'] = cdssm_vectors[i].src_vec
-		relation['Arg2']['CDSSMTarget'] = cdssm_vectors[i].target_vec
-
-		relation['Arg1']['DSSMTarget'] = dssm_vectors[i + num_relations].target_vec
-		relation['Arg2']['DSSMSource'] = dssm_vectors[i + num_relations].src_vec
-		relation['Arg1']['CDSSMTarget'] = cdssm_vectors[i + num_relations].target_vec
-		relation['Arg2']['CDSSMSource'] = cdssm_vectors[i + num_relations].src_vec
-		print json.dumps(relation, sort_keys=True)
 
+	dssm_src, dssm_target = parse_dssm_output_file(open('tmp_dssm_vec.out'))
+	assert(len(dssm_src) == 2 * num_relations)
 
+	cdssm_src, cdssm_target = parse_dssm_output_file(open('tmp_cdssm_vec.out'))
+	assert(len(cdssm_src) == 2 * num_relations)
+
+	vector_dict = {}
+	vector_dict['DSSMSource'], vector_dict['DSSMTarget'] = \
+		arg_vectors(dssm_src, dssm_target, num_relations)
+	vector_dict['CDSSMSource'], vector_dict['CDSSMTarget'] = \
+		arg_vectors(cdssm_src, cdssm_target, num_relations)
+	write_sidecar(sidecar_prefix, relations, vector_dict)
+
+	for relation in relations:
+		print json.dumps(relation, sort_keys=True)
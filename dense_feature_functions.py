@@ -1,5 +1,8 @@
 from tpl.language.lexical_structure import WordEmbeddingDict
 
+import os
+from array import array
+
 from theano import config
 import numpy as np
 
@@ -9,8 +12,11 @@ class EmbeddingFeaturizer(object):
 	WORD_EMBEDDING_FILE = '../lib/lexicon/google_word_vector/GoogleNews-vectors-negative300.txt'
 	OOV_VALUE = 0
 
-	def __init__(self, word_embedding_file=WORD_EMBEDDING_FILE):
-		self.word_embedding_dict = WordEmbeddingDict(word_embedding_file)
+	def __init__(self, word_embedding_file=WORD_EMBEDDING_FILE, word_embedding_dict=None):
+		if word_embedding_dict is not None:
+			self.word_embedding_dict = word_embedding_dict
+		else:
+			self.word_embedding_dict = WordEmbeddingDict(word_embedding_file)
 
 	def create_arg_matrix(self, arg_tokens):
 		num_tokens = len(arg_tokens)
@@ -22,47 +28,143 @@ class EmbeddingFeaturizer(object):
 				sentence_matrix[i, :] = EmbeddingFeaturizer.OOV_VALUE
 		return sentence_matrix
 	
+	def index_args(self, relation_list):
+		"""Flatten the tokens of both args of all relations into index arrays
+
+		Each token type is looked up in the embedding dict only once.
+		Row 0 of the embedding matrix is for the OOV tokens.
+
+		Returns
+			the embedding matrix of the token types in the relations
+			and a list of (token indices, offsets) for Arg1 and Arg2.
+			The tokens of relation i are token indices[offsets[i]:offsets[i+1]]
+		"""
+		vocab = {}
+		embedding_list = [np.zeros(self.word_embedding_dict.num_units) + EmbeddingFeaturizer.OOV_VALUE]
+		arg_indices = []
+		for arg_pos in [1, 2]:
+			indices = array('i')
+			lengths = array('i')
+			for relation in relation_list:
+				arg_tokens = relation.arg_tokens(arg_pos)
+				for token in arg_tokens:
+					if token not in vocab:
+						if token in self.word_embedding_dict:
+							vocab[token] = len(embedding_list)
+							embedding_list.append(self.word_embedding_dict[token])
+						else:
+							vocab[token] = 0
+					indices.append(vocab[token])
+				lengths.append(len(arg_tokens))
+			offsets = np.zeros(len(relation_list) + 1, dtype=np.int64)
+			np.cumsum(np.frombuffer(lengths, dtype=np.int32), out=offsets[1:])
+			arg_indices.append((np.frombuffer(indices, dtype=np.int32), offsets))
+		embedding_matrix = np.array(embedding_list).astype(config.floatX)
+		return embedding_matrix, arg_indices
+
+	def pool_args(self, relation_list, projections):
+		"""Pool the word vectors of both args in one pass
+
+		The word vectors of each arg are gathered once and then
+		all of the projections are computed with reduceat on the gathered matrix.
+		An arg without any token gets a zero vector.
+
+		projections is a list of 'sum_pool', 'mean_pool', 'max_pool', 'top'
+
+		Returns a list of [arg1_matrix, arg2_matrix], one for each projection
+		"""
+		for projection in projections:
+			if projection not in ['sum_pool', 'mean_pool', 'max_pool', 'top']:
+				raise ValueError('projection must be one of {mean_pool, sum_pool, max_pool, top}. Got %s ' % projection)
+		embedding_matrix, arg_indices = self.index_args(relation_list)
+		num_units = embedding_matrix.shape[1]
+		pooled = [[] for p in projections]
+		for indices, offsets in arg_indices:
+			gathered = embedding_matrix[indices]
+			lengths = np.diff(offsets)
+			non_empty = lengths > 0
+			starts = offsets[:-1][non_empty]
+			arg_sum = None
+			for i, projection in enumerate(projections):
+				arg_matrix = np.zeros((len(relation_list), num_units), dtype=config.floatX)
+				if len(starts) == 0:
+					pass
+				elif projection == 'sum_pool' or projection == 'mean_pool':
+					if arg_sum is None:
+						arg_sum = np.add.reduceat(gathered, starts)
+					if projection == 'sum_pool':
+						arg_matrix[non_empty] = arg_sum
+					else:
+						arg_matrix[non_empty] = arg_sum / \
+							lengths[non_empty][:, None].astype(config.floatX)
+				elif projection == 'max_pool':
+					arg_matrix[non_empty] = np.maximum.reduceat(gathered, starts)
+				else:
+					arg_matrix[non_empty] = gathered[offsets[1:][non_empty] - 1]
+				pooled[i].append(arg_matrix)
+		return pooled
+
 	def additive_args(self, relation_list):
-		num_relations = len(relation_list)
-		num_units = self.word_embedding_dict.num_units
-		
-		arg1_matrix = np.array([self.create_arg_matrix(x.arg_tokens(1)).sum(0) 
-			for x in relation_list])
-		arg2_matrix = np.array([self.create_arg_matrix(x.arg_tokens(2)).sum(0) 
-			for x in relation_list])
-		return [arg1_matrix, arg2_matrix]
+		return self.pool_args(relation_list, ['sum_pool'])[0]
 
 	def mean_args(self, relation_list):	
-		num_relations = len(relation_list)
-		num_units = self.word_embedding_dict.num_units
-		
-		arg1_matrix = np.array([self.create_arg_matrix(x.arg_tokens(1)).mean(0) 
-			for x in relation_list])
-		arg2_matrix = np.array([self.create_arg_matrix(x.arg_tokens(2)).mean(0) 
-			for x in relation_list])
-		return [arg1_matrix, arg2_matrix]
+		return self.pool_args(relation_list, ['mean_pool'])[0]
 
 	def max_args(self, relation_list):
-		num_relations = len(relation_list)
-		num_units = self.word_embedding_dict.num_units
-		
-		arg1_matrix = np.array([self.create_arg_matrix(x.arg_tokens(1)).max(0) 
-			for x in relation_list])
-		arg2_matrix = np.array([self.create_arg_matrix(x.arg_tokens(2)).max(0) 
-			for x in relation_list])
-		return [arg1_matrix, arg2_matrix]
+		return self.pool_args(relation_list, ['max_pool'])[0]
 
 	def top_args(self, relation_list):
-		num_relations = len(relation_list)
-		num_units = self.word_embedding_dict.num_units
-		
-		arg1_matrix = np.array([self.create_arg_matrix(x.arg_tokens(1))[-1,:]
-			for x in relation_list])
-		arg2_matrix = np.array([self.create_arg_matrix(x.arg_tokens(2))[-1,:]
-			for x in relation_list])
-		return [arg1_matrix, arg2_matrix]
+		return self.pool_args(relation_list, ['top'])[0]
+
+class VectorSidecar(object):
+	"""Memory-mapped DSSM/CDSSM vectors saved by deep_ssm/insert_vec.py
+
+	The rows are looked up by doc_relation_id, so one sidecar can cover
+	all of the data splits.
+	"""
+
+	def __init__(self, prefix_list):
+		self.prefix_list = prefix_list
+		self.location = {}
+		for part, prefix in enumerate(prefix_list):
+			ids = np.load('%s.ids.npy' % prefix)
+			for row, doc_relation_id in enumerate(ids.tolist()):
+				self.location[doc_relation_id] = (part, row)
+		self._vectors = {}
 
-def cdssm_feature(relation_list):
+	def vectors(self, part, name):
+		if (part, name) not in self._vectors:
+			self._vectors[(part, name)] = np.load(
+				'%s.%s.npy' % (self.prefix_list[part], name), mmap_mode='r')
+		return self._vectors[(part, name)]
+
+	def arg_matrix(self, relation_list, name, arg_pos):
+		"""Gather the vectors of one arg for the relations (in order)"""
+		locations = np.array([self.location[x.doc_relation_id] for x in relation_list])
+		parts = locations[:, 0]
+		rows = locations[:, 1]
+		num_units = self.vectors(parts[0], name).shape[2]
+		matrix = np.zeros((len(relation_list), num_units), dtype=config.floatX)
+		for part in np.unique(parts):
+			in_part = parts == part
+			matrix[in_part] = self.vectors(part, name)[rows[in_part], arg_pos - 1]
+		return matrix
+
+def load_vector_sidecar(dir_list, file_name='pdtb-data-plus'):
+	"""Returns the VectorSidecar for the data splits or None if any is missing"""
+	prefix_list = [os.path.join(x, file_name) for x in dir_list]
+	if all(os.path.exists('%s.ids.npy' % x) for x in prefix_list):
+		return VectorSidecar(prefix_list)
+	return None
+
+def cdssm_feature(relation_list, sidecar=None):
+	if sidecar is not None:
+		arg1_matrix = np.hstack((sidecar.arg_matrix(relation_list, 'CDSSMTarget', 1),
+			sidecar.arg_matrix(relation_list, 'CDSSMSource', 1)))
+		arg2_matrix = np.hstack((sidecar.arg_matrix(relation_list, 'CDSSMTarget', 2),
+			sidecar.arg_matrix(relation_list, 'CDSSMSource', 2)))
+		return [arg1_matrix, arg2_matrix]
+	# only the json files from before the sidecars have the vectors
 	num_relations = len(relation_list)
 	num_units = len(relation_list[0].relation_dict['Arg1']['CDSSMTarget']) * 2
 	
@@ -80,7 +182,10 @@ def cached_features(relation_list, feature_name):
 	num_units = len(relation_list[0].relation_dict[feature_name]) 
 	return [np.array([x.relation_dict[feature_name] for x in relation_list]).astype(config.floatX)]
 
-def cached_argwise_features(relation_list, feature_name):
+def cached_argwise_features(relation_list, feature_name, sidecar=None):
+	if sidecar is not None:
+		return [sidecar.arg_matrix(relation_list, feature_name, 1),
+			sidecar.arg_matrix(relation_list, feature_name, 2)]
 	num_relations = len(relation_list)
 	num_units = len(relation_list[0].relation_dict['Arg1'][feature_name]) 
 	arg1_matrix = np.array([x.relation_dict['Arg1'][feature_name] for x in relation_list])
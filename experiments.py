@@ -185,7 +185,8 @@ code up experiment 3 again, which is really not a big deal...
 """
 def experiment4_0(mapping_file, dir_list):
 	experiment_name = 'experiment4.0'
-	ff_list = [f.dssm_feature, f.cdssm_feature]
+	df = f.DSSMFeaturizer(dir_list)
+	ff_list = [df.dssm_feature, df.cdssm_feature]
 	dimension_mapper = l.GenericMapping(mapping_file, True)
 	lf_list = dimension_mapper.get_all_label_functions()
 	lf_list.append(l.OriginalLabel())
@@ -194,7 +195,8 @@ def experiment4_0(mapping_file, dir_list):
 
 def experiment4_1(mapping_file, dir_list):
 	experiment_name = 'experiment4.1'
-	ff_list = [f.dssm_feature]
+	df = f.DSSMFeaturizer(dir_list)
+	ff_list = [df.dssm_feature]
 	dimension_mapper = l.GenericMapping(mapping_file, True)
 	lf_list = dimension_mapper.get_all_label_functions()
 	lf_list.append(l.OriginalLabel())
@@ -203,7 +205,8 @@ def experiment4_1(mapping_file, dir_list):
 
 def experiment4_2(mapping_file, dir_list):
 	experiment_name = 'experiment4.2'
-	ff_list = [f.cdssm_feature]
+	df = f.DSSMFeaturizer(dir_list)
+	ff_list = [df.cdssm_feature]
 	dimension_mapper = l.GenericMapping(mapping_file, True)
 	lf_list = dimension_mapper.get_all_label_functions()
 	lf_list.append(l.OriginalLabel())
@@ -213,7 +216,8 @@ def experiment4_2(mapping_file, dir_list):
 def experiment4_0_1(mapping_file, dir_list):
 	experiment_name = 'experiment4.0.1'
 	bf = f.BrownClusterFeaturizer()
-	ff_list = [f.dssm_feature, f.cdssm_feature,
+	df = f.DSSMFeaturizer(dir_list)
+	ff_list = [df.dssm_feature, df.cdssm_feature,
 			f.production_rules, bf.brown_words, bf.brown_word_pairs]
 	dimension_mapper = l.GenericMapping(mapping_file, True)
 	lf_list = dimension_mapper.get_all_label_functions()
@@ -224,7 +228,8 @@ def experiment4_0_1(mapping_file, dir_list):
 def experiment4_1_1(mapping_file, dir_list):
 	experiment_name = 'experiment4.1.1'
 	bf = f.BrownClusterFeaturizer()
-	ff_list = [f.dssm_feature, 
+	df = f.DSSMFeaturizer(dir_list)
+	ff_list = [df.dssm_feature, 
 			f.production_rules, bf.brown_words, bf.brown_word_pairs]
 	dimension_mapper = l.GenericMapping(mapping_file, True)
 	lf_list = dimension_mapper.get_all_label_functions()
@@ -235,7 +240,8 @@ def experiment4_1_1(mapping_file, dir_list):
 def experiment4_2_1(mapping_file, dir_list):
 	experiment_name = 'experiment4.2.1'
 	bf = f.BrownClusterFeaturizer()
-	ff_list = [f.cdssm_feature, 
+	df = f.DSSMFeaturizer(dir_list)
+	ff_list = [df.cdssm_feature, 
 			f.production_rules, bf.brown_words, bf.brown_word_pairs]
 	dimension_mapper = l.GenericMapping(mapping_file, True)
 	lf_list = dimension_mapper.get_all_label_functions()
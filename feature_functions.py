@@ -248,6 +248,52 @@ def cdssm_feature(rplus):
             _vector_based_feature(rplus.relation_dict['Arg2']['CDSSMSource'], 'CS2'))
     return feature_vector
 
+class DSSMFeaturizer(object):
+    """DSSM and CDSSM features from the .npy sidecars
+
+    deep_ssm/insert_vec.py saves the vectors in sidecar files next to 
+    pdtb-data-plus.json instead of in the relations, so dssm_feature and
+    cdssm_feature above only work with the old json files.
+
+    df = DSSMFeaturizer(dir_list)
+    df.dssm_feature <--- feature function that looks up the sidecar
+
+    """
+    def __init__(self, dir_list, file_name='pdtb-data-plus'):
+        # dense_feature_functions pulls in theano
+        from dense_feature_functions import load_vector_sidecar
+        self.sidecar = load_vector_sidecar(dir_list, file_name)
+        if self.sidecar is None:
+            raise IOError('No DSSM vector sidecar %s in %s' % 
+                    (file_name, dir_list))
+
+    def _vector(self, rplus, name, arg_pos):
+        return self.sidecar.arg_matrix([rplus], name, arg_pos)[0].tolist()
+
+    def dssm_feature(self, rplus):
+        feature_vector = []
+        feature_vector.extend(
+                _vector_based_feature(self._vector(rplus, 'DSSMTarget', 1), 'DT1'))
+        feature_vector.extend(
+                _vector_based_feature(self._vector(rplus, 'DSSMTarget', 2), 'DT2'))
+        feature_vector.extend(
+                _vector_based_feature(self._vector(rplus, 'DSSMSource', 1), 'DS1'))
+        feature_vector.extend(
+                _vector_based_feature(self._vector(rplus, 'DSSMSource', 2), 'DS2'))
+        return feature_vector
+
+    def cdssm_feature(self, rplus):
+        feature_vector = []
+        feature_vector.extend(
+                _vector_based_feature(self._vector(rplus, 'CDSSMTarget', 1), 'CT1'))
+        feature_vector.extend(
+                _vector_based_feature(self._vector(rplus, 'CDSSMTarget', 2), 'CT2'))
+        feature_vector.extend(
+                _vector_based_feature(self._vector(rplus, 'CDSSMSource', 1), 'CS1'))
+        feature_vector.extend(
+                _vector_based_feature(self._vector(rplus, 'CDSSMSource', 2), 'CS2'))
+        return feature_vector
+
 def dependency_rules(relation):
     rule_set1 = set(relation.arg_dtree_rule_list(1))
     rule_set2 = set(relation.arg_dtree_rule_list(2))
@@ -0,0 +1,151 @@
+"""Compact feature alphabet that can be saved with a model
+
+The alphabets that come out of util.sparse_featurize are dicts from feature
+strings to column indices. For pair features, they are the biggest object
+in the process and we rebuild them in every run.
+
+FrozenAlphabet stores the same mapping as
+    keys : all UTF-8 encoded feature strings sorted and concatenated
+    offsets : where each key starts in keys (int64, one extra at the end)
+    columns : the column index of each key (int32)
+The three files are memory-mapped at load time and a lookup is a binary
+search over the keys, so we never make a Python string for every entry.
+The columns are ordered by training frequency, column 0 being the most
+frequent feature, so the hot columns are contiguous.
+
+util.sparse_featurize(..., alphabet_prefix) freezes the training alphabet,
+saves it and featurizes the dev and test sets with the memory-mapped copy.
+"""
+import mmap
+import os
+
+import numpy as np
+import scipy as sp
+import scipy.sparse
+
+from cognitive_disco.nets.util import select_csr_columns
+
+def alphabet_exists(prefix):
+    return all(os.path.exists(prefix + x) for x in
+            ['.keys', '.offsets.npy', '.columns.npy'])
+
+def _encode(feature):
+    if isinstance(feature, unicode):
+        return feature.encode('utf8')
+    return feature
+
+class FrozenAlphabet(object):
+
+    def __init__(self, keys, offsets, columns):
+        self.keys = keys
+        self.offsets = offsets
+        self.columns = columns
+        self._positions = None
+
+    @staticmethod
+    def from_dict(alphabet, counts=None):
+        """Freeze a dict alphabet
+
+        counts is an array of feature counts indexed by the old column
+        indices. The new columns are ordered by decreasing counts.
+        If counts is None, we keep the old column indices.
+
+        Returns the FrozenAlphabet and new_to_old, where new column j was
+        old column new_to_old[j]
+        """
+        num_features = len(alphabet)
+        if counts is None:
+            new_to_old = np.arange(num_features, dtype=np.int32)
+        else:
+            # stable sort so that ties keep the order of first appearance
+            new_to_old = np.argsort(-np.asarray(counts), kind='mergesort').\
+                    astype(np.int32)
+        old_to_new = np.empty(num_features, dtype=np.int32)
+        old_to_new[new_to_old] = np.arange(num_features, dtype=np.int32)
+
+        encoded = sorted((_encode(f), i) for f, i in alphabet.iteritems())
+        keys = ''.join(x[0] for x in encoded)
+        offsets = np.zeros(num_features + 1, dtype=np.int64)
+        np.cumsum([len(x[0]) for x in encoded], out=offsets[1:])
+        columns = old_to_new[np.array([x[1] for x in encoded], dtype=np.int32)] \
+                if num_features > 0 else np.zeros(0, dtype=np.int32)
+        return FrozenAlphabet(keys, offsets, columns), new_to_old
+
+    def save(self, prefix):
+        with open('%s.keys' % prefix, 'wb') as f:
+            f.write(self.keys[:])
+        np.save('%s.offsets.npy' % prefix, self.offsets)
+        np.save('%s.columns.npy' % prefix, self.columns)
+
+    @staticmethod
+    def load(prefix, use_mmap=True):
+        if use_mmap:
+            offsets = np.load('%s.offsets.npy' % prefix, mmap_mode='r')
+            columns = np.load('%s.columns.npy' % prefix, mmap_mode='r')
+            with open('%s.keys' % prefix, 'rb') as f:
+                if offsets[-1] > 0:
+                    keys = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    keys = ''
+        else:
+            offsets = np.load('%s.offsets.npy' % prefix)
+            columns = np.load('%s.columns.npy' % prefix)
+            with open('%s.keys' % prefix, 'rb') as f:
+                keys = f.read()
+        return FrozenAlphabet(keys, offsets, columns)
+
+    def __len__(self):
+        return len(self.columns)
+
+    def _key(self, position):
+        return self.keys[self.offsets[position]:self.offsets[position + 1]]
+
+    def _find(self, feature):
+        key = _encode(feature)
+        low = 0
+        high = len(self.columns)
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.columns) and self._key(low) == key:
+            return low
+        return -1
+
+    def __contains__(self, feature):
+        return self._find(feature) >= 0
+
+    def __getitem__(self, feature):
+        position = self._find(feature)
+        if position < 0:
+            raise KeyError(feature)
+        return int(self.columns[position])
+
+    def get(self, feature, default=None):
+        position = self._find(feature)
+        if position < 0:
+            return default
+        return int(self.columns[position])
+
+    def feature(self, column):
+        """Reverse lookup. Returns the UTF-8 encoded feature string"""
+        if self._positions is None:
+            self._positions = np.argsort(self.columns)
+        return self._key(self._positions[column])
+
+def freeze_feature_matrices(feature_matrices, alphabet):
+    """Freeze the alphabet and reorder the columns by training frequency
+
+    The first matrix is the training set. The counts are the number of
+    training instances in which each feature is present.
+
+    Returns the reordered CSR matrices and the FrozenAlphabet
+    """
+    training_matrix = sp.sparse.csr_matrix(feature_matrices[0])
+    counts = np.bincount(training_matrix.indices,
+            minlength=training_matrix.shape[1])
+    frozen_alphabet, new_to_old = FrozenAlphabet.from_dict(alphabet, counts)
+    return [select_csr_columns(x, new_to_old) for x in feature_matrices], \
+            frozen_alphabet
@@ -32,7 +32,7 @@ class AttentionModelBase(object):
 class AttentionModelSimple(AttentionModelBase):
 
     def __init__(self, rng, num_units, num_hidden_layers,
-            num_hidden_units, dropout):
+            num_hidden_units, dropout, embedding_layer=None):
         self.rng = rng
         self.num_units = num_units
         self.num_hidden_units = num_hidden_units
@@ -40,9 +40,17 @@ class AttentionModelSimple(AttentionModelBase):
         self.dropout = dropout
         self.n_out = num_units
 
-        self.X = T.tensor3('x', dtype=config.floatX) 
+        self.embedding_layer = embedding_layer
+        if embedding_layer is None:
+            self.X = T.tensor3('x', dtype=config.floatX) 
+            word_input = [self.X]
+            self.sparse_params = []
+        else:
+            self.X = embedding_layer.X
+            word_input = embedding_layer.input
+            self.sparse_params = embedding_layer.sparse_params
         self.mask = T.matrix('mask', dtype=config.floatX)
-        self.input = [self.X, self.mask]
+        self.input = word_input + [self.mask]
         
         self.att_net, _ = make_multilayer_net(rng, 
                 num_units, self.X, None, False, 
@@ -59,11 +67,13 @@ class AttentionModelSimple(AttentionModelBase):
 
     def reset(self, rng):
         self.att_net.reset(rng)
+        if self.embedding_layer is not None:
+            self.embedding_layer.reset(rng)
 
 class AttentionLSTM(AttentionModelBase):
 
     def __init__(self, rng, num_units, num_hidden_layers,
-            num_hidden_units, dropout):
+            num_hidden_units, dropout, embedding_layer=None):
         self.rng = rng
         self.num_units = num_units
         self.num_hidden_units = num_hidden_units
@@ -72,14 +82,17 @@ class AttentionLSTM(AttentionModelBase):
         self.n_out = num_units
     
         self.att_lstm = SerialLSTM(rng, num_units, pooling=None, 
-                dropout_p=0.85 if dropout else 1.0)
+                dropout_p=0.85 if dropout else 1.0,
+                embedding_layer=embedding_layer)
         self.att_net, _ = make_multilayer_net_from_layers(
                 [self.att_lstm], None, False, 
                 num_hidden_layers, num_hidden_units, 1, 
                 T.nnet.sigmoid, dropout)
         self.params = self.att_net.params 
+        self.sparse_params = self.att_lstm.sparse_params
         self.input = self.att_lstm.input
-        self.X, self.mask = self.input
+        self.X = self.att_lstm.X
+        self.mask = self.att_lstm.mask
         self.compute_activations()
 
     def _compute_attention(self):
@@ -13,11 +13,17 @@ from cognitive_disco.nets.bilinear_layer import \
         InputLayer, make_multilayer_net_from_layers
 from cognitive_disco.nets.attention import \
         AttentionModelSimple, AttentionLSTM
-from cognitive_disco.nets.lstm import prep_serrated_matrix_relations
+from cognitive_disco.nets.lstm import prep_serrated_matrix_relations, \
+        EmbeddingLayer
 import cognitive_disco.nets.util as util
 
 
 def att_experiment1(dir_list, args):
+    """Simple attention model for feedforward nets
+
+    The optional fifth argument is index (look up the embeddings in the graph)
+    or tune (also train the embeddings)
+    """
     experiment_name = sys._getframe().f_code.co_name    
     sense_lf = l.SecondLevelLabel()
     num_units = int(args[0])
@@ -26,14 +32,17 @@ def att_experiment1(dir_list, args):
     dropout_arg = args[3]
     assert(dropout_arg =='d' or dropout_arg =='n')
     dropout = True if dropout_arg == 'd' else False
+    embedding_mode = args[4] if len(args) > 4 else None
+    assert(embedding_mode in [None, 'index', 'tune'])
     
 
     relation_list_list = [extract_implicit_relations(dir, sense_lf) 
             for dir in dir_list]
-    wbm = util.get_wbm(num_units)
+    wbm = util.get_wbm(num_units, dir_list)
     data_list = []
     for relation_list in relation_list_list:
-        data = prep_serrated_matrix_relations(relation_list, wbm, 50)
+        data = prep_serrated_matrix_relations(relation_list, wbm, 50,
+                index_only=embedding_mode is not None)
         data_list.append(data)
     label_vectors, label_alphabet = \
             util.label_vectorize(relation_list_list, sense_lf)
@@ -45,12 +54,12 @@ def att_experiment1(dir_list, args):
 
     json_file = util.set_logger('%s_%sunits_%sh_%sh_%s' % \
             (experiment_name, num_units, 
-                num_hidden_layers, num_att_hidden_layer, dropout_arg))
+                num_hidden_layers, num_att_hidden_layer, '_'.join(args[3:])))
     for num_hidden_units in num_hidden_unit_list:
         _att_experiment_ff_helper(experiment_name, AttentionModelSimple,
                 json_file, data_triplet, wbm, num_reps, 
                 num_att_hidden_layer, num_hidden_layers, num_hidden_units,
-                dropout)
+                dropout, embedding_mode)
 
 def att_experiment2(dir_list, args):
     """Simple feedforward net without the attention model. 
@@ -67,9 +76,9 @@ def att_experiment2(dir_list, args):
 
     relation_list_list = [extract_implicit_relations(dir, sense_lf) 
             for dir in dir_list]
-    wbm = util.get_wbm(num_units)
+    wbm = util.get_wbm(num_units, dir_list)
     data_list = []
-    word2vec_ff = util._get_word2vec_ff(num_units, 'sum_pool')
+    word2vec_ff = util._get_word2vec_ff(num_units, 'sum_pool', dir_list)
     data_list = [word2vec_ff(relation_list) \
             for relation_list in relation_list_list]
     label_vectors, label_alphabet = \
@@ -90,6 +99,9 @@ def att_experiment2(dir_list, args):
 
 def att_experiment3(dir_list, args):
     """LSTM Attention Mechanism for feedforward nets
+
+    The optional fifth argument is index (look up the embeddings in the graph)
+    or tune (also train the embeddings)
     """
     experiment_name = sys._getframe().f_code.co_name    
     num_units = int(args[0])
@@ -98,20 +110,23 @@ def att_experiment3(dir_list, args):
     dropout_arg = args[3]
     assert(dropout_arg =='d' or dropout_arg =='n')
     dropout = True if dropout_arg == 'd' else False
-    wbm = util.get_wbm(num_units)
-    data_triplet = util.get_data_srm(dir_list, wbm)
+    embedding_mode = args[4] if len(args) > 4 else None
+    assert(embedding_mode in [None, 'index', 'tune'])
+    wbm = util.get_wbm(num_units, dir_list)
+    data_triplet = util.get_data_srm(dir_list, wbm, 
+            index_only=embedding_mode is not None)
     num_reps = 10
     num_hidden_unit_list = [0] if num_hidden_layers == 0 \
             else [300, 400, 600, 800] 
 
     json_file = util.set_logger('%s_%sunits_%sh_%sh_%s' % \
             (experiment_name, num_units, 
-                num_hidden_layers, num_att_hidden_layer, dropout_arg))
+                num_hidden_layers, num_att_hidden_layer, '_'.join(args[3:])))
     for num_hidden_units in num_hidden_unit_list:
         _att_experiment_ff_helper(experiment_name, AttentionLSTM,
                 json_file, data_triplet, wbm, num_reps, 
                 num_att_hidden_layer, num_hidden_layers, num_hidden_units,
-                dropout)
+                dropout, embedding_mode)
 
 def _train_feedforward_net(experiment_name,
         json_file, data_triplet, wbm, num_reps, 
@@ -167,15 +182,25 @@ def _train_feedforward_net(experiment_name,
 def _att_experiment_ff_helper(experiment_name, attention_model,
         json_file, data_triplet, wbm, num_reps, 
         num_att_hidden_layer, num_hidden_layers, num_hidden_units,
-        dropout):
+        dropout, embedding_mode=None):
+    """embedding_mode is None (the data are embedding series), 
+    index (the data are token indices), or tune (also train the embeddings)
+    """
     rng = np.random.RandomState(100)
 
+    if embedding_mode is not None:
+        arg1_embedding = EmbeddingLayer(rng, wbm, embedding_mode == 'tune')
+        arg2_embedding = EmbeddingLayer(rng, wbm, embedding_mode == 'tune',
+                E=arg1_embedding.E)
+    else:
+        arg1_embedding = None
+        arg2_embedding = None
     arg1_model = attention_model(rng, 
             wbm.num_units, num_att_hidden_layer, num_hidden_units,
-            dropout=False)
+            dropout=False, embedding_layer=arg1_embedding)
     arg2_model = attention_model(rng, 
             wbm.num_units, num_att_hidden_layer, num_hidden_units,
-            dropout=False)
+            dropout=False, embedding_layer=arg2_embedding)
     nn, all_layers = make_multilayer_net_from_layers(
             input_layers=[arg1_model, arg2_model],
             Y=T.lvector(), use_sparse=False,
@@ -222,7 +247,8 @@ def _att_experiment_ff_helper(experiment_name, attention_model,
                 'experiment name': experiment_name,
                 'num hidden units': num_hidden_units,
                 'cost function': 'crossentropy',
-                'dropout': dropout
+                'dropout': dropout,
+                'embedding mode': embedding_mode
                 }
         json_file.write('%s\n' % json.dumps(result_dict, sort_keys=True))
 
@@ -243,7 +269,7 @@ def get_net():
     dir_list = ['conll15-st-05-19-15-dev', 'conll15-st-05-19-15-dev', 'conll15-st-05-19-15-test']
     relation_list_list = [extract_implicit_relations(dir, sense_lf) 
             for dir in dir_list]
-    wbm = util.get_wbm(num_units)
+    wbm = util.get_wbm(num_units, dir_list)
     data_list = []
     for relation_list in relation_list_list:
         data = prep_serrated_matrix_relations(relation_list, wbm, 50)
@@ -8,19 +8,55 @@ import theano.tensor as T
 from theano.tensor.shared_randomstreams import RandomStreams
 import timeit
 
-from learning import AdagradTrainer
+from learning import AdagradTrainer, unique_with_inverse
 
-class NeuralNet(object):
+def multiclass_hinge_loss(activation, Y):
+    """Multiclass hinge loss summed over the minibatch
+
+    sum_n sum_{j != Y[n]} max(0, 1 - a[n, Y[n]] + a[n, j])
+    The N x k margin matrix is computed in one go instead of 
+    scanning over the samples. The j = Y[n] terms are all 1 
+    and are subtracted at the end.
+    """
+    n_samples = Y.shape[0]
+    correct = activation[T.arange(n_samples), Y]
+    margins = T.maximum(0, 1 - correct[:, None] + activation)
+    return margins.sum() - n_samples.astype(theano.config.floatX)
+
+class LazyHingeLoss(object):
+    """hinge_loss is built on first access
+
+    Most experiments train on crossentropy so there is no point 
+    in building the hinge loss graph unless a trainer asks for it.
+    Subclasses implement _make_hinge_loss.
+    """
+
+    _hinge_loss = None
+
+    @property
+    def hinge_loss(self):
+        if self._hinge_loss is None:
+            self._hinge_loss = self._make_hinge_loss()
+        return self._hinge_loss
+
+    @hinge_loss.setter
+    def hinge_loss(self, value):
+        self._hinge_loss = value
+
+    def _make_hinge_loss(self):
+        raise NotImplementedError
+
+class NeuralNet(LazyHingeLoss):
     """A wrapper neural net class to combine multiple layers into one network
 
     """
 
     def __init__(self, layers=None):
         self.params = []#a list of paramter variables
+        self.sparse_params = [] # (param, row indices, rows) see lstm.EmbeddingLayer
         self.input = [] #a list of input variables
         self.output = []#a list of output variables
         self.predict = [] # a list of prediction functions
-        self.hinge_loss = None # a function
         self.crossentropy = None # a function
         self.layers = [] # a list of layer in the topological order
         self.rng = None
@@ -29,16 +65,22 @@ class NeuralNet(object):
 
     def add_layers(self, layers):
         self.rng = layers[0].rng 
-        self.input = layers[0].input
+        self.input = getattr(layers[0], 'input', [])
         self.output = layers[-1].output
         self.predict = layers[-1].predict
         self.activation_train = layers[-1].activation_train
         self.activation_test = layers[-1].activation_test
         self.crossentropy = layers[-1].crossentropy
-        self.hinge_loss = layers[-1].hinge_loss
+        self.hinge_loss = None # built from the last layer on demand
         for layer in layers:
             self.layers.append(layer)
             self.params.extend(layer.params)
+            self.sparse_params.extend(getattr(layer, 'sparse_params', []))
+
+    def _make_hinge_loss(self):
+        if len(self.layers) == 0:
+            return None
+        return self.layers[-1].hinge_loss
 
     def reset(self, rng):
         for layer in self.layers:
@@ -60,6 +102,86 @@ class InputLayer(object):
     def reset(self, rng):
         pass
 
+class EmbeddingBagLayer(object):
+    """Input layer that sums the looked-up rows of the active features
+
+    A sparse feature vector x goes in as a padded list of feature indices
+    (N x L, padded with -1) and optionally their values (N x L, 0 for
+    the padding). The activation is sum_l values[n, l] E[indices[n, l]],
+    which is x E without the n_features x size dense product.
+    util.csr_to_padded_indices makes the inputs from a CSR matrix.
+
+    The embedding matrix E is in sparse_params (see lstm.EmbeddingLayer)
+    so the trainer only updates the rows in the minibatch.
+    If rank is given, E is n_features x rank and the bag is projected
+    to size by a dense rank x size matrix P.
+    """
+
+    def __init__(self, rng, n_features, size, use_values=False, rank=None):
+        self.rng = rng
+        self.n_features = n_features
+        self.n_out = size
+        self.rank = rank
+
+        self.indices = T.lmatrix('feature indices')
+        self.input = [self.indices]
+        if use_values:
+            self.values = T.matrix('feature values', dtype=theano.config.floatX)
+            self.input.append(self.values)
+            weights = self.values * T.ge(self.indices, 0)
+        else:
+            weights = T.ge(self.indices, 0).astype(theano.config.floatX)
+
+        E_values, P_values = self._get_init_param_values(rng)
+        self.E = theano.shared(value=E_values, name='E', borrow=True)
+        # the padding is left out of the lookup. Otherwise -1 would look up
+        # the last feature, and the stateful optimizers (momentum, Adam)
+        # would move its row in every minibatch.
+        flat_indices = self.indices.flatten()
+        positions = T.ge(flat_indices, 0).nonzero()[0]
+        active_indices = flat_indices[positions]
+        rows = self.E[active_indices]
+        samples = positions // self.indices.shape[1]
+        bag = T.zeros((self.indices.shape[0], self.E.shape[1]), 
+                dtype=self.E.dtype)
+        bag = T.inc_subtensor(bag[samples], 
+                rows * weights.flatten()[positions][:, None])
+        self.sparse_params = [(self.E, active_indices, rows)]
+        if rank is None:
+            self.P = None
+            self.params = []
+            activation = bag
+        else:
+            self.P = theano.shared(value=P_values, name='P', borrow=True)
+            self.params = [self.P]
+            activation = T.dot(bag, self.P)
+        self.activation_train = activation
+        self.activation_test = activation
+
+    def _get_init_param_values(self, rng):
+        n_columns = self.n_out if self.rank is None else self.rank
+        E_values = np.asarray(
+                rng.uniform(
+                    low=-np.sqrt(6. / (self.n_features + n_columns)),
+                    high=np.sqrt(6. / (self.n_features + n_columns)),
+                    size=(self.n_features, n_columns)),
+                dtype=theano.config.floatX)
+        if self.rank is None:
+            return E_values, None
+        P_values = np.asarray(
+                rng.uniform(
+                    low=-np.sqrt(6. / (self.rank + self.n_out)),
+                    high=np.sqrt(6. / (self.rank + self.n_out)),
+                    size=(self.rank, self.n_out)),
+                dtype=theano.config.floatX)
+        return E_values, P_values
+
+    def reset(self, rng):
+        E_values, P_values = self._get_init_param_values(rng)
+        self.E.set_value(E_values)
+        if self.P is not None:
+            self.P.set_value(P_values)
+
 class MaskedInputLayer(object):
 
     def __init__(self, rng, size, pooling=None, 
@@ -107,18 +229,29 @@ class MaskedInputLayer(object):
         pass
 
 
-class LinearLayer(object):
+class LinearLayer(LazyHingeLoss):
     """Linear Layer that supports multiple separate input (sparse) vectors
 
     This new version is not backward compatible and 
     will break all of the previous experiments that precede
     attention_experiments. 
+
+    Dropout on a sparse (CSR) input is applied to its data array so the
+    input stays sparse. If use_sparse, the weights of the sparse inputs
+    are not in params but in sparse_params (see lstm.EmbeddingLayer).
+    Only the rows of the features present in the minibatch are looked up
+    so the trainer only computes and applies the updates for those rows.
+
+    If dropout_p < 1, the keep probability is the shared variable 
+    T_dropout_p, which can be changed without compiling again.
     """
 
     def __init__(self, rng, n_out, use_sparse, parent_layers=[], Y=None, 
             activation_fn=T.tanh, dropout_p=1.0):
         self.n_out = n_out
         self.dropout_p = dropout_p
+        self.T_dropout_p = theano.shared(
+                np.asarray(dropout_p, dtype=theano.config.floatX))
         self.use_sparse = use_sparse
         self.parent_layers = parent_layers
 
@@ -130,7 +263,7 @@ class LinearLayer(object):
         self.W_list = [theano.shared(value=W_values, borrow=True) 
                 for W_values in W_values_list]
         self.b = theano.shared(value=b_values, borrow=True)
-        self.params = self.W_list + [self.b]
+        self.sparse_params = []
 
         self.activation_fn = activation_fn
         self.rng = rng
@@ -146,30 +279,29 @@ class LinearLayer(object):
         for i, parent_layer in enumerate(parent_layers):
             input_train = parent_layer.activation_train
             input_test = parent_layer.activation_test
-            dropout_mask = self.srng.binomial(
-                    size=[input_train.shape[-1]], p=dropout_p, 
-                    dtype=theano.config.floatX)
             if type(input_train) == theano.sparse.basic.SparseVariable:
-
+                net_train += self._sparse_dot_train(input_train, self.W_list[i])
                 if dropout_p < 1:
-                    net_train += theano.sparse.structured_dot(
-                            input_train * dropout_mask, self.W_list[i])
                     net_test += theano.sparse.structured_dot(
-                            input_test, self.W_list[i] * dropout_p)
+                            input_test, self.W_list[i] * self.T_dropout_p)
                 else:
-                    net_train += theano.sparse.structured_dot(
-                            input_train, self.W_list[i])
                     net_test += theano.sparse.structured_dot(
                             input_test, self.W_list[i])
             else:
+                dropout_mask = self.srng.binomial(
+                        size=[input_train.shape[-1]], p=self.T_dropout_p, 
+                        dtype=theano.config.floatX)
                 if dropout_p < 1:
                     net_train += T.dot(
                             input_train * dropout_mask, self.W_list[i])
                     net_test += T.dot(
-                            input_test, self.W_list[i] * dropout_p)
+                            input_test, self.W_list[i] * self.T_dropout_p)
                 else:
                     net_train += T.dot(input_train, self.W_list[i])
                     net_test += T.dot(input_test, self.W_list[i])
+        sparse_weights = [x[0] for x in self.sparse_params]
+        self.params = [W for W in self.W_list if W not in sparse_weights] + \
+                [self.b]
 
 
         self.activation_train = net_train if activation_fn is None\
@@ -181,17 +313,38 @@ class LinearLayer(object):
             self.output = []
             self.crossentropy = None
             self.predict = []
-            self.hinge_loss = None
         else:
             self.output = [Y]
             self.predict = [self.activation_test.argmax(1)]
-            hinge_loss_instance, _ = theano.scan(
-                    lambda a, y: T.maximum(0, 1 - a[y] + a).sum() - 1,
-                    sequences=[self.activation_train, Y])
-            self.hinge_loss = hinge_loss_instance.sum()
             likelihood = self.activation_train[T.arange(Y.shape[0]), Y].astype(theano.config.floatX)
             self.crossentropy = -T.mean(T.log(likelihood))
 
+    def _make_hinge_loss(self):
+        if len(self.output) == 0:
+            return None
+        return multiclass_hinge_loss(self.activation_train, self.output[0])
+
+    def _sparse_dot_train(self, X, W):
+        """X W during training for a CSR X
+
+        The dropout mask is drawn for the non-zeros only. If use_sparse, 
+        the columns of X are renumbered to the unique features in X 
+        and multiplied by those rows of W only.
+        """
+        data, indices, indptr, shape = theano.sparse.csm_properties(X)
+        if self.dropout_p < 1:
+            data = data * self.srng.binomial(size=data.shape, 
+                    p=self.T_dropout_p, dtype=data.dtype)
+        if self.use_sparse:
+            rows_in_use, indices = unique_with_inverse(indices)
+            W_rows = W[rows_in_use]
+            self.sparse_params.append((W, rows_in_use, W_rows))
+            shape = T.stack([shape[0], rows_in_use.shape[0]])
+            W = W_rows
+        X = theano.sparse.CSR(data, indices.astype('int32'), indptr, 
+                shape.astype('int32'))
+        return theano.sparse.structured_dot(X, W)
+
     def _get_init_param_values(self, rng):
         W_list = []
         for parent_layer in self.parent_layers:
@@ -224,7 +377,7 @@ class LinearLayer(object):
             dropout_p=self.dropout_p)
         return l
 
-class MJMModel(object):
+class MJMModel(LazyHingeLoss):
 
     def __init__(self, layer_list, X_list):
         self.params = list(itertools.chain(
@@ -236,13 +389,18 @@ class MJMModel(object):
 
         #this can actually be anything, but we should play with weighting later
         #make the model focus on the main label sense
+        self.layer_list = layer_list
         self.crossentropy = 0
-        self.hinge_loss = 0
         for layer in layer_list:
             self.crossentropy += layer.crossentropy
-            self.hinge_loss += layer.hinge_loss
 
-class GlueLayer(object):
+    def _make_hinge_loss(self):
+        hinge_loss = 0
+        for layer in self.layer_list:
+            hinge_loss += layer.hinge_loss
+        return hinge_loss
+
+class GlueLayer(LazyHingeLoss):
     """Glue Layer that glues Bilinear and Linear layers output together
     by simply adding up
     """
@@ -263,13 +421,14 @@ class GlueLayer(object):
         else:
             self.output = [Y]
             self.predict = [self.activation.argmax(1)]
-            hinge_loss_instance, _ = theano.scan(
-                    lambda a, y: T.maximum(0, 1 - a[y] + a).sum() - 1 ,
-                    sequences=[self.activation, Y])
-            self.hinge_loss = hinge_loss_instance.sum()
             self.crossentropy = \
                     -T.mean(T.log(self.activation[T.arange(Y.shape[0]), Y]))
 
+    def _make_hinge_loss(self):
+        if len(self.output) == 0:
+            return None
+        return multiclass_hinge_loss(self.activation, self.output[0])
+
 def make_multilayer_net(rng, n_in, X, Y, use_sparse, 
         num_hidden_layers, num_hidden_units, num_output_units,
         output_activation_fn=T.nnet.softmax,
@@ -286,14 +445,14 @@ def make_multilayer_net_from_layers(input_layers, Y, use_sparse,
     layers = []
     if num_hidden_layers > 0:
         hidden_layers = add_hidden_layers(input_layers,
-                num_hidden_units, num_hidden_layers, dropout)
+                num_hidden_units, num_hidden_layers, dropout, use_sparse)
         layers.extend(hidden_layers)
         output_layer = LinearLayer(rng, num_output_units, False,
                 parent_layers=layers[-1:], Y=Y,
                 activation_fn=output_activation_fn,
                 dropout_p=0.5 if dropout else 1)
     else:
-        output_layer = LinearLayer(rng, num_output_units, False,
+        output_layer = LinearLayer(rng, num_output_units, use_sparse,
                 parent_layers=input_layers, Y=Y,
                 activation_fn=output_activation_fn,
                 dropout_p=0.5 if dropout else 1)
@@ -301,12 +460,12 @@ def make_multilayer_net_from_layers(input_layers, Y, use_sparse,
     nn = NeuralNet(input_layers + layers)
     nn.input = []
     for input_layer in input_layers:
-        nn.input.extend(input_layer.input)
+        nn.input.extend(getattr(input_layer, 'input', []))
     return nn, layers
 
 
 def add_hidden_layers(input_layers,
-        num_hidden_units, num_hidden_layers, dropout):
+        num_hidden_units, num_hidden_layers, dropout, use_sparse=False):
     parent_layers = input_layers
     hidden_layers = []
     rng = input_layers[0].rng
@@ -315,50 +474,61 @@ def add_hidden_layers(input_layers,
             dropout_p = 0.95
         else:
             dropout_p = 0.5
-        hidden_layer = LinearLayer(rng, num_hidden_units, False,
+        hidden_layer = LinearLayer(rng, num_hidden_units, 
+                use_sparse and i == 0,
                 parent_layers, activation_fn=T.tanh, 
                 dropout_p=dropout_p if dropout else 1)
         hidden_layers.append(hidden_layer)
         parent_layers = [hidden_layer]
     return hidden_layers
 
-class MixtureOfExperts(object):
+class MixtureOfExperts(LazyHingeLoss):
+    """Experts weighted by a softmax gating net on the input layers
 
-    def __init__(self, rng, n_in_list, expert_list, 
-            X_list, Y, num_hidden_layers=0, num_hidden_units=100):
+    The experts are layers with activation_train and activation_test 
+    (e.g. the output LinearLayer from make_multilayer_net_from_layers).
+    The params are those of the gating net only. Put the input layers, 
+    the expert layers, and this layer into a NeuralNet to train them.
+    """
         
-        self.gating_net, _ = make_multilayer_net(rng, 
-                n_in_list, X_list, T.lvector(), False,
-                num_hidden_layers, num_hidden_units, len(expert_list))
-
-        self.n_in_list = n_in_list
-        self.input = X_list    
+    def __init__(self, rng, input_layers, expert_list, Y, 
+            num_hidden_layers=0, num_hidden_units=100):
+        self.rng = rng
+        _, self.gating_layers = make_multilayer_net_from_layers(input_layers, 
+                None, False, num_hidden_layers, num_hidden_units, 
+                len(expert_list))
+        self.input = list(itertools.chain(
+            *[layer.input for layer in input_layers]))
         self.expert_list = expert_list
+        self.params = list(itertools.chain(
+            *[layer.params for layer in self.gating_layers]))
 
-        self.params = self.gating_net.params
-        for expert in expert_list:
-            self.params.extend(expert.params)
-
-        gating_activation = self.gating_net.activation
-
-        self.activation = 0
-        for i, expert in enumerate(expert_list):
-            g = T.addbroadcast(gating_activation[:,i:i+1], 1)
-            self.activation += expert.activation * g
+        self.activation_train = \
+                self._mix(self.gating_layers[-1].activation_train, 
+                        [expert.activation_train for expert in expert_list])
+        self.activation_test = \
+                self._mix(self.gating_layers[-1].activation_test, 
+                        [expert.activation_test for expert in expert_list])
+        self.activation = self.activation_train
 
         self.output = [Y]
-        self.predict = [self.activation.argmax(1)]
-        hinge_loss_instance, _ = theano.scan(
-                lambda a, y: T.maximum(0, 1 - a[y] + a).sum() - 1 ,
-                sequences=[self.activation, Y])
-        self.hinge_loss = hinge_loss_instance.sum()
+        self.predict = [self.activation_test.argmax(1)]
         self.crossentropy = \
                 -T.mean(T.log(self.activation[T.arange(Y.shape[0]), Y]))
 
+    def _mix(self, gating_activation, expert_activations):
+        activation = 0
+        for i, expert_activation in enumerate(expert_activations):
+            g = T.addbroadcast(gating_activation[:,i:i+1], 1)
+            activation += expert_activation * g
+        return activation
+
+    def _make_hinge_loss(self):
+        return multiclass_hinge_loss(self.activation, self.output[0])
+
     def reset(self, rng):
-        self.gating_net.reset(rng)
-        for expert in self.expert_list:
-            expert.reset(rng)
+        for layer in self.gating_layers:
+            layer.reset(rng)
 
 class LinearLayerTensorOutput(object):
     """Linear Layer that supports tensor-shaped output
@@ -366,9 +536,14 @@ class LinearLayerTensorOutput(object):
     It turns out that I could have just modified the LinearLayer
     to compute crossentropy based on the boolean mask matrix. 
     But I will roll with this gratuitous class for now. 
+
+    If sparse_targets, Y is a 2T x N matrix of label indices instead of 
+    the 2T x N x k one-hot tensor. The nodes with ignore_index are skipped 
+    and the output is only computed for the labeled nodes.
     """
 
-    def __init__(self, rng, n_in, n_out, X, W=None, b=None):
+    def __init__(self, rng, n_in, n_out, X, W=None, b=None, 
+            sparse_targets=False, ignore_index=-1):
         self.n_in = n_in
         self.n_out = n_out
         self.rng = rng
@@ -387,9 +562,13 @@ class LinearLayerTensorOutput(object):
         self.b = b
         self.params = [self.W, self.b]
 
+        if sparse_targets:
+            self._sparse_target_loss(X, ignore_index)
+            return
+
         net = X.dot(self.W) + self.b
         net_max = T.max(net, 2)
-        denom = T.log(T.sum(T.exp(net - net_max[:,:,None]), 2)) - net_max 
+        denom = T.log(T.sum(T.exp(net - net_max[:,:,None]), 2)) + net_max 
         log_prob = net - denom[:,:,None]
 
         Y = T.tensor3(dtype=theano.config.floatX)
@@ -401,6 +580,21 @@ class LinearLayerTensorOutput(object):
         #node_mask = Y.sum(2).nonzero()
         #self.miscs = [T.argmax(Y,2)[node_mask][0:20], T.argmax(net, 2)[node_mask][0:20]]
 
+    def _sparse_target_loss(self, X, ignore_index):
+        Y = T.lmatrix()
+        self.output = [Y]
+        node_indices, sample_indices = T.neq(Y, ignore_index).nonzero()
+        labels = Y[node_indices, sample_indices]
+
+        net = X[node_indices, sample_indices].dot(self.W) + self.b
+        net_max = T.max(net, 1)
+        denom = T.log(T.sum(T.exp(net - net_max[:,None]), 1)) + net_max
+        log_prob = net[T.arange(labels.shape[0]), labels] - denom
+        num_nodes = T.cast(labels.shape[0], theano.config.floatX)
+        self.crossentropy = -log_prob.sum() / num_nodes
+        correct = T.eq(T.argmax(net, 1), labels).sum()
+        self.miscs = [correct / num_nodes, self.crossentropy]
+
     def reset(self, rng):
         n_in, n_out = self.W.get_value().shape
         W_values = np.asarray(rng.uniform(
@@ -412,28 +606,34 @@ class LinearLayerTensorOutput(object):
         b_values = np.zeros((n_out,), dtype=theano.config.floatX)
         self.b.set_value(b_values)
 
-class BilinearLayer(object):
+class BilinearLayer(LazyHingeLoss):
     """Bilinear layer with dense vectors
 
     Tensor product in theano does not support sparse vectors. 
     We have to go around this isssue.
+
+    net[n, o] = x1[n] W[o] x2[n] + b[o] for the whole minibatch at once.
+    If rank is given, each W[o] is factorized into U[o] V[o]^T of rank r 
+    so we need (n_in1 + n_in2) x n_out x r parameters 
+    instead of n_in1 x n_in2 x n_out. 
     """
 
     def __init__(self, rng, n_in1, n_in2, n_out, 
-            X1=None, X2=None, Y=None, W=None, b=None, activation_fn=T.tanh):
+            X1=None, X2=None, Y=None, W=None, b=None, activation_fn=T.tanh,
+            rank=None, U=None, V=None):
         self.n_in1 = n_in1
         self.n_in2 = n_in2
         self.n_out = n_out
-        if W is None:
-            W_values = np.asarray(
-                rng.uniform(
-                    low=-np.sqrt(6. / (n_in1 + n_in2 + n_out)),
-                    high=np.sqrt(6. / (n_in1 + n_in2 + n_out)),
-                    size=(n_out, n_in1, n_in2)
-                ),
-                dtype=theano.config.floatX
-            )
-            W = theano.shared(value=W_values, name='W', borrow=True)
+        self.rank = rank
+        self.rng = rng
+        if rank is None and W is None:
+            W = theano.shared(value=self._init_W(rng), name='W', borrow=True)
+        if rank is not None and U is None:
+            U = theano.shared(value=self._init_factor(rng, n_in1), 
+                    name='U', borrow=True)
+        if rank is not None and V is None:
+            V = theano.shared(value=self._init_factor(rng, n_in2), 
+                    name='V', borrow=True)
         
         if b is None:
             b_values = np.zeros((n_out,), dtype=theano.config.floatX)
@@ -442,13 +642,21 @@ class BilinearLayer(object):
         self.X1 = T.matrix('x1') if X1 is None else X1
         self.X2 = T.matrix('x2') if X2 is None else X2
         self.W = W
+        self.U = U
+        self.V = V
         self.b = b
         self.input = [self.X1, self.X2]
-        self.params = [self.W, self.b]
-        net, _ = theano.scan(
-                lambda x1, x2: T.dot(T.dot(x1, self.W),x2.T) + self.b,
-                sequences=[self.X1, self.X2]
-            )
+        n_samples = self.X1.shape[0]
+        if rank is None:
+            self.params = [self.W, self.b]
+            # N x n_out x n_in2
+            x1_W = T.tensordot(self.X1, self.W, axes=[[1], [1]])
+            net = T.batched_dot(x1_W, self.X2) + self.b
+        else:
+            self.params = [self.U, self.V, self.b]
+            x1_U = T.dot(self.X1, self.U).reshape((n_samples, n_out, rank))
+            x2_V = T.dot(self.X2, self.V).reshape((n_samples, n_out, rank))
+            net = (x1_U * x2_V).sum(axis=2) + self.b
 
         self.activation = net if activation_fn is None else activation_fn(net)
         if Y is None:
@@ -456,15 +664,16 @@ class BilinearLayer(object):
         else:
             self.output = [Y]
             self.predict = [self.activation.argmax(1)]
-            hinge_loss_instance, _ = theano.scan(
-                    lambda a, y: T.maximum(0, 1 - a[y] + a).sum() - 1 ,
-                    sequences=[self.activation, Y])
-            self.hinge_loss = hinge_loss_instance.sum()
             self.crossentropy = \
                     -T.mean(T.log(self.activation[T.arange(Y.shape[0]), Y]))
 
-    def reset(self, rng):
-        W_values = np.asarray(
+    def _make_hinge_loss(self):
+        if len(self.output) == 0:
+            return None
+        return multiclass_hinge_loss(self.activation, self.output[0])
+
+    def _init_W(self, rng):
+        return np.asarray(
             rng.uniform(
                 low=-np.sqrt(6. / (self.n_in1 + self.n_in2 + self.n_out)),
                 high=np.sqrt(6. / (self.n_in1 + self.n_in2 + self.n_out)),
@@ -472,7 +681,132 @@ class BilinearLayer(object):
             ),
             dtype=theano.config.floatX
         )
-        self.W.set_value(W_values)
+
+    def _init_factor(self, rng, n_in):
+        """n_in x (n_out * rank) factor. Column o * rank + k is the kth 
+        component of output o.
+        """
+        num_columns = self.n_out * self.rank
+        return np.asarray(
+            rng.uniform(
+                low=-np.sqrt(6. / (n_in + num_columns)),
+                high=np.sqrt(6. / (n_in + num_columns)),
+                size=(n_in, num_columns)
+            ),
+            dtype=theano.config.floatX
+        )
+
+    def reset(self, rng):
+        if self.rank is None:
+            self.W.set_value(self._init_W(rng))
+        else:
+            self.U.set_value(self._init_factor(rng, self.n_in1))
+            self.V.set_value(self._init_factor(rng, self.n_in2))
+        b_values = np.zeros((self.n_out,), dtype=theano.config.floatX)
+        self.b.set_value(b_values)
+
+class PairInteractionLayer(LazyHingeLoss):
+    """Factorization machine over the feature pairs across two sparse bags
+
+    net[n, o] = sum_i sum_j x1[n, i] x2[n, j] <U[i, o], V[j, o]>
+                + x1[n] W1[:, o] + x2[n] W2[:, o] + b[o]
+    where U[i, o] and V[j, o] are rank-r factors. The double sum over
+    the pairs factorizes into <x1[n] U[:, o], x2[n] V[:, o]> so the cost is
+    linear in the number of non-zeros of X1 and X2. This replaces the
+    materialized pair features (e.g. brown_word_pairs), whose non-zeros
+    grow quadratically with the arg length.
+
+    X1 and X2 are the per-arg bags (e.g. Brown clusters), CSR if use_sparse.
+    The linear terms are dropped if linear_terms is False.
+    """
+
+    def __init__(self, rng, n_in1, n_in2, n_out, rank, use_sparse=True,
+            X1=None, X2=None, Y=None, U=None, V=None, linear_terms=True,
+            activation_fn=T.tanh):
+        self.n_in1 = n_in1
+        self.n_in2 = n_in2
+        self.n_out = n_out
+        self.rank = rank
+        self.rng = rng
+        self.linear_terms = linear_terms
+        if X1 is None:
+            X1 = theano.sparse.csr_matrix('x1') if use_sparse else T.matrix('x1')
+        if X2 is None:
+            X2 = theano.sparse.csr_matrix('x2') if use_sparse else T.matrix('x2')
+        if U is None:
+            U = theano.shared(value=self._init_factor(rng, n_in1),
+                    name='U', borrow=True)
+        if V is None:
+            V = theano.shared(value=self._init_factor(rng, n_in2),
+                    name='V', borrow=True)
+        b_values = np.zeros((n_out,), dtype=theano.config.floatX)
+        self.b = theano.shared(value=b_values, name='b', borrow=True)
+
+        self.X1 = X1
+        self.X2 = X2
+        self.U = U
+        self.V = V
+        self.input = [self.X1, self.X2]
+        self.params = [self.U, self.V, self.b]
+
+        n_samples = self.X1.shape[0]
+        x1_U = self._dot(self.X1, self.U).reshape((n_samples, n_out, rank))
+        x2_V = self._dot(self.X2, self.V).reshape((n_samples, n_out, rank))
+        net = (x1_U * x2_V).sum(axis=2) + self.b
+        if linear_terms:
+            self.W1 = theano.shared(value=self._init_linear(n_in1),
+                    name='W1', borrow=True)
+            self.W2 = theano.shared(value=self._init_linear(n_in2),
+                    name='W2', borrow=True)
+            self.params.extend([self.W1, self.W2])
+            net += self._dot(self.X1, self.W1) + self._dot(self.X2, self.W2)
+
+        self.activation = net if activation_fn is None else activation_fn(net)
+        self.activation_train = self.activation
+        self.activation_test = self.activation
+        if Y is None:
+            self.output = []
+            self.predict = []
+            self.crossentropy = None
+        else:
+            self.output = [Y]
+            self.predict = [self.activation.argmax(1)]
+            self.crossentropy = \
+                    -T.mean(T.log(self.activation[T.arange(Y.shape[0]), Y]))
+
+    def _dot(self, X, W):
+        if type(X) == theano.sparse.basic.SparseVariable:
+            return theano.sparse.structured_dot(X, W)
+        return T.dot(X, W)
+
+    def _init_factor(self, rng, n_in):
+        """n_in x (n_out * rank) factor. Column o * rank + k is the kth
+        component of output o.
+        """
+        num_columns = self.n_out * self.rank
+        return np.asarray(
+            rng.uniform(
+                low=-np.sqrt(6. / (n_in + num_columns)),
+                high=np.sqrt(6. / (n_in + num_columns)),
+                size=(n_in, num_columns)
+            ),
+            dtype=theano.config.floatX
+        )
+
+    def _init_linear(self, n_in):
+        return np.zeros((n_in, self.n_out), dtype=theano.config.floatX)
+
+    def _make_hinge_loss(self):
+        if len(self.output) == 0:
+            return None
+        return multiclass_hinge_loss(self.activation, self.output[0])
+
+    def reset(self, rng):
+        self.U.set_value(self._init_factor(rng, self.n_in1))
+        self.V.set_value(self._init_factor(rng, self.n_in2))
+        if self.linear_terms:
+            self.W1.set_value(self._init_linear(self.n_in1))
+            self.W2.set_value(self._init_linear(self.n_in2))
         b_values = np.zeros((self.n_out,), dtype=theano.config.floatX)
         self.b.set_value(b_values)
 
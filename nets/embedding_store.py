@@ -0,0 +1,399 @@
+"""Memory-mapped word embedding store
+
+Loading the GoogleNews vectors as text (or as .npy plus a vocab file) takes
+minutes and all of the vectors end up in the memory even though a corpus
+only uses a small fraction of them. This module converts the vectors once
+into a store that can be memory-mapped
+
+    [prefix].vectors.npy : float32 matrix. The last row is the OOV vector (zeros)
+    [prefix].words : all UTF-8 encoded words concatenated
+    [prefix].offsets.npy : where each word starts in words (int64)
+    [prefix].table.npy : open addressing hash table from word to row (int32)
+
+WordEmbeddingStore has the same interface as WordEmbeddingMatrix
+(wm, num_units, index_tokens, get_embedding) so it can be passed to
+prep_srm_arg and friends. wm[indices] only touches the rows that we use.
+
+python embedding_store.py --txt GoogleNews-vectors-negative300.txt GoogleNews-vectors-negative300
+python embedding_store.py --npy wsj-skipgram50.npy wsj-skipgram50_vocab.txt wsj-skipgram50
+
+quantize_store makes a copy of a store with float16 vectors or with int8
+vectors and a float32 scale for each row, which is 2x or ~4x smaller.
+WordEmbeddingStore dequantizes only the rows that are gathered.
+
+python embedding_store.py --quantize int8 wsj-skipgram50 wsj-skipgram50-int8
+
+restricted_store keeps only the words that occur in the given data splits
+(plus the OOV row). The subset is cached on disk, keyed by the embedding file
+and the set of splits, so only the first run has to read the full vectors.
+"""
+import argparse
+import codecs
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
+
+import numpy as np
+
+EMPTY = -1
+CACHE_DIR = os.environ.get('COGNITIVE_DISCO_CACHE',
+        os.path.expanduser('~/.cognitive_disco_cache'))
+PARSE_FILES = ['pdtb-parses-plus.json', 'parses.json']
+PRECISIONS = ['float32', 'float16', 'int8']
+
+def _encode(word):
+    if isinstance(word, unicode):
+        return word.encode('utf8')
+    return word
+
+def _hash(key):
+    return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+def store_exists(prefix):
+    return all(os.path.exists(prefix + x) for x in
+            ['.vectors.npy', '.words', '.offsets.npy', '.table.npy'])
+
+def _write_index(prefix, word_list):
+    """Write the words and the hash table for the rows in order
+
+    If a word occurs more than once, the first row wins.
+    """
+    num_words = len(word_list)
+    offsets = np.zeros(num_words + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in word_list], out=offsets[1:])
+    with open(prefix + '.words', 'wb') as f:
+        for word in word_list:
+            f.write(word)
+    np.save(prefix + '.offsets.npy', offsets)
+
+    table_size = 1
+    while table_size < 2 * num_words:
+        table_size *= 2
+    table = np.zeros(table_size, dtype=np.int32) + EMPTY
+    mask = table_size - 1
+    for row, word in enumerate(word_list):
+        slot = _hash(word) & mask
+        while table[slot] != EMPTY:
+            if word_list[table[slot]] == word:
+                break
+            slot = (slot + 1) & mask
+        if table[slot] == EMPTY:
+            table[slot] = row
+    np.save(prefix + '.table.npy', table)
+
+def _write_store(prefix, word_list, vector_list, num_units):
+    """Write a small store from the vectors in the memory
+
+    The files are written under a temporary name and then renamed
+    with the hash table last, so a half-written store never exists.
+    """
+    tmp_prefix = '%s.tmp%s' % (prefix, os.getpid())
+    vectors = np.zeros((len(word_list) + 1, num_units), dtype=np.float32)
+    if len(vector_list) > 0:
+        vectors[:-1] = vector_list
+    np.save(tmp_prefix + '.vectors.npy', vectors)
+    _write_index(tmp_prefix, word_list)
+    for ext in ['.vectors.npy', '.words', '.offsets.npy', '.table.npy']:
+        os.rename(tmp_prefix + ext, prefix + ext)
+
+def convert_txt(txt_file, prefix):
+    """Convert the word2vec text format
+
+    Each line is [word] [value1] [value2] ... The first line may be
+    the header [num words] [num units].
+    """
+    num_words = 0
+    num_units = None
+    has_header = False
+    with open(txt_file) as f:
+        for i, line in enumerate(f):
+            fields = line.rstrip().split(' ')
+            if i == 0 and len(fields) == 2:
+                has_header = True
+                continue
+            if num_units is None:
+                num_units = len(fields) - 1
+            num_words += 1
+
+    vectors = np.lib.format.open_memmap(prefix + '.vectors.npy', mode='w+',
+            dtype=np.float32, shape=(num_words + 1, num_units))
+    word_list = []
+    with open(txt_file) as f:
+        if has_header:
+            f.readline()
+        for row, line in enumerate(f):
+            word, values = line.rstrip().split(' ', 1)
+            vectors[row, :] = np.fromstring(values, dtype=np.float32, sep=' ')
+            word_list.append(word)
+    vectors[num_words, :] = 0
+    vectors.flush()
+    del vectors
+    _write_index(prefix, word_list)
+
+def convert_npy(npy_file, vocab_file, prefix, block_size=100000):
+    """Convert the .npy matrix and the vocab file that util.get_wbm uses
+
+    The vocab file has one word per line in the order of the rows.
+    If the matrix has one more row than the vocab, the last row is taken
+    as the OOV vector. Otherwise, a zero row is added.
+    """
+    with open(vocab_file) as f:
+        word_list = [line.split()[0] for line in f if line.strip() != '']
+    matrix = np.load(npy_file, mmap_mode='r')
+    num_words = len(word_list)
+    assert matrix.shape[0] in (num_words, num_words + 1)
+    vectors = np.lib.format.open_memmap(prefix + '.vectors.npy', mode='w+',
+            dtype=np.float32, shape=(num_words + 1, matrix.shape[1]))
+    for start in xrange(0, matrix.shape[0], block_size):
+        end = min(start + block_size, matrix.shape[0])
+        vectors[start:end] = matrix[start:end]
+    if matrix.shape[0] == num_words:
+        vectors[num_words, :] = 0
+    vectors.flush()
+    del vectors
+    _write_index(prefix, word_list)
+
+def quantize_store(prefix, new_prefix, precision, block_size=100000):
+    """Copy the store with the vectors in reduced precision
+
+    float16 keeps the vectors as they are in half precision.
+    int8 scales each row by max |value| / 127 and rounds. The scales
+    are saved in [new_prefix].scales.npy.
+    """
+    assert precision in PRECISIONS
+    vectors = np.load(prefix + '.vectors.npy', mmap_mode='r')
+    tmp_prefix = '%s.tmp%s' % (new_prefix, os.getpid())
+    dtype = np.int8 if precision == 'int8' else np.dtype(precision)
+    new_vectors = np.lib.format.open_memmap(tmp_prefix + '.vectors.npy',
+            mode='w+', dtype=dtype, shape=vectors.shape)
+    scales = np.ones(vectors.shape[0], dtype=np.float32)
+    for start in xrange(0, vectors.shape[0], block_size):
+        end = min(start + block_size, vectors.shape[0])
+        block = np.asarray(vectors[start:end], dtype=np.float32)
+        if precision == 'int8':
+            max_values = np.abs(block).max(1)
+            scales[start:end] = np.where(max_values > 0, max_values / 127., 1.)
+            block = np.round(block / scales[start:end, None])
+        new_vectors[start:end] = block
+    new_vectors.flush()
+    del new_vectors
+    extensions = ['.vectors.npy', '.words', '.offsets.npy', '.table.npy']
+    if precision == 'int8':
+        np.save(tmp_prefix + '.scales.npy', scales)
+        extensions.insert(1, '.scales.npy')
+    for ext in extensions[1:]:
+        if ext != '.scales.npy':
+            shutil.copyfile(prefix + ext, tmp_prefix + ext)
+    for ext in extensions:
+        os.rename(tmp_prefix + ext, new_prefix + ext)
+
+def _parse_file(data_folder):
+    for parse_file in PARSE_FILES:
+        if os.path.exists(os.path.join(data_folder, parse_file)):
+            return os.path.join(data_folder, parse_file)
+    raise IOError('No parse file in %s' % data_folder)
+
+def corpus_vocabulary(dir_list):
+    """All of the words in the parses of the data splits
+
+    This includes the leaves of the parse trees because the tree models
+    index the leaves rather than the tokens. Returns a set of UTF-8 strings.
+    """
+    leaf_pattern = re.compile(r'\([^\s()]+ ([^\s()]+)\)')
+    vocab = set()
+    for data_folder in dir_list:
+        parse = json.load(codecs.open(_parse_file(data_folder), encoding='utf8'))
+        for doc in parse.itervalues():
+            for sentence in doc['sentences']:
+                for word in sentence['words']:
+                    vocab.add(_encode(word[0]))
+                for leaf in leaf_pattern.findall(sentence['parsetree']):
+                    vocab.add(_encode(leaf))
+    return vocab
+
+def _file_signature(file_name):
+    stat = os.stat(file_name)
+    return '%s %s %s' % (os.path.abspath(file_name), stat.st_size, int(stat.st_mtime))
+
+def restricted_store_prefix(embedding_file, dir_list, cache_dir=CACHE_DIR):
+    """The cache prefix for the subset of the embedding
+
+    The key hashes the path, size and modification time of the embedding file
+    and of the parse files of the splits. We do not hash the content because
+    that means reading the full vectors, which is what we try to avoid.
+    """
+    signatures = [_file_signature(embedding_file)] + \
+            sorted(set(_file_signature(_parse_file(x)) for x in dir_list))
+    key = hashlib.md5('\n'.join(signatures)).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(embedding_file))[0]
+    return os.path.join(cache_dir, '%s-%s' % (name, key))
+
+def restricted_store(embedding_file, dir_list, vocab_file=None,
+        cache_dir=CACHE_DIR, precision='float32'):
+    """WordEmbeddingStore with only the words in the data splits
+
+    embedding_file is either the word2vec text file or the .npy matrix
+    with its vocab_file. If the full store has been converted next to
+    the embedding file, we read the vectors from it instead.
+    If precision is float16 or int8, the subset is quantized
+    (and cached as well).
+    """
+    prefix = restricted_store_prefix(embedding_file, dir_list, cache_dir)
+    if precision != 'float32':
+        quantized_prefix = '%s-%s' % (prefix, precision)
+        if not store_exists(quantized_prefix):
+            restricted_store(embedding_file, dir_list, vocab_file, cache_dir)
+            quantize_store(prefix, quantized_prefix, precision)
+        return WordEmbeddingStore(quantized_prefix)
+    if not store_exists(prefix):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        vocab = corpus_vocabulary(dir_list)
+        full_prefix = os.path.splitext(embedding_file)[0]
+        if store_exists(full_prefix):
+            full_store = WordEmbeddingStore(full_prefix)
+            word_list = sorted(x for x in vocab if x in full_store)
+            vector_list = full_store.wm[[full_store.index(x) for x in word_list]]
+            num_units = full_store.num_units
+        elif embedding_file.endswith('.npy'):
+            word_list, vector_list, num_units = \
+                    _restrict_npy(embedding_file, vocab_file, vocab)
+        else:
+            word_list, vector_list, num_units = _restrict_txt(embedding_file, vocab)
+        _write_store(prefix, word_list, vector_list, num_units)
+    return WordEmbeddingStore(prefix)
+
+def _restrict_txt(txt_file, vocab):
+    word_list = []
+    vector_list = []
+    seen = set()
+    num_units = None
+    with open(txt_file) as f:
+        for i, line in enumerate(f):
+            word, values = line.rstrip().split(' ', 1)
+            if i == 0 and len(values.split(' ')) == 1:
+                continue
+            if num_units is None:
+                num_units = len(values.split(' '))
+            if word in vocab and word not in seen:
+                seen.add(word)
+                word_list.append(word)
+                vector_list.append(np.fromstring(values, dtype=np.float32, sep=' '))
+    return word_list, vector_list, num_units
+
+def _restrict_npy(npy_file, vocab_file, vocab):
+    word_list = []
+    rows = []
+    seen = set()
+    with open(vocab_file) as f:
+        all_words = [line.split()[0] for line in f if line.strip() != '']
+    for row, word in enumerate(all_words):
+        if word in vocab and word not in seen:
+            seen.add(word)
+            word_list.append(word)
+            rows.append(row)
+    matrix = np.load(npy_file, mmap_mode='r')
+    return word_list, matrix[rows], matrix.shape[1]
+
+class QuantizedMatrix(object):
+    """int8 matrix with a scale for each row
+
+    Indexing dequantizes only the rows that are gathered.
+    """
+
+    def __init__(self, values, scales):
+        self.values = values
+        self.scales = scales
+        self.shape = values.shape
+        self.dtype = np.dtype(np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        scales = np.asarray(self.scales[index], dtype=np.float32)
+        return self.values[index].astype(np.float32) * scales[..., None]
+
+class WordEmbeddingStore(object):
+
+    def __init__(self, prefix):
+        self.wm = np.load(prefix + '.vectors.npy', mmap_mode='r')
+        if os.path.exists(prefix + '.scales.npy'):
+            self.wm = QuantizedMatrix(self.wm,
+                    np.load(prefix + '.scales.npy', mmap_mode='r'))
+        self.offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+        self.table = np.load(prefix + '.table.npy', mmap_mode='r')
+        with open(prefix + '.words', 'rb') as f:
+            if self.offsets[-1] > 0:
+                self.words = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.words = ''
+        self.num_units = self.wm.shape[1]
+        self.oov_index = self.wm.shape[0] - 1
+        self._mask = len(self.table) - 1
+
+    def __len__(self):
+        return self.oov_index
+
+    def _word(self, row):
+        return self.words[self.offsets[row]:self.offsets[row + 1]]
+
+    def index(self, word):
+        """Returns the row of the word or -1 if it is OOV"""
+        key = _encode(word)
+        slot = _hash(key) & self._mask
+        while True:
+            row = self.table[slot]
+            if row == EMPTY:
+                return -1
+            if self._word(row) == key:
+                return int(row)
+            slot = (slot + 1) & self._mask
+
+    def __contains__(self, word):
+        return self.index(word) >= 0
+
+    def __getitem__(self, word):
+        row = self.index(word)
+        if row < 0:
+            raise KeyError(word)
+        return np.array(self.wm[row], dtype=np.float32)
+
+    def index_tokens(self, tokens, ignore_OOV=True):
+        indices = []
+        for token in tokens:
+            row = self.index(token)
+            if row >= 0:
+                indices.append(row)
+            elif not ignore_OOV:
+                indices.append(self.oov_index)
+        return indices
+
+    def get_embedding(self, word):
+        row = self.index(word)
+        return np.array(self.wm[row if row >= 0 else self.oov_index],
+                dtype=np.float32)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--txt', help='word2vec text file', default=None)
+    parser.add_argument('--npy', help='.npy matrix and vocab file',
+            default=None, nargs=2)
+    parser.add_argument('--quantize', help='copy the store in this precision',
+            default=None, choices=PRECISIONS[1:])
+    parser.add_argument('prefix', help='prefix of the store files')
+    parser.add_argument('new_prefix', help='prefix of the quantized store',
+            nargs='?', default=None)
+    args = parser.parse_args()
+    if args.txt is not None:
+        convert_txt(args.txt, args.prefix)
+    elif args.npy is not None:
+        convert_npy(args.npy[0], args.npy[1], args.prefix)
+    elif args.quantize is not None and args.new_prefix is not None:
+        quantize_store(args.prefix, args.new_prefix, args.quantize)
+    else:
+        parser.error('either --txt, --npy or --quantize with new_prefix is required')
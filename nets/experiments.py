@@ -1,3 +1,4 @@
+import functools
 import json
 import sys
 import timeit
@@ -14,7 +15,8 @@ from mixture_experiments import net_mixture_experiment1, net_mixture_experiment2
 from cognitive_disco.data_reader import extract_implicit_relations
 from cognitive_disco.nets.bilinear_layer import \
         BilinearLayer, LinearLayer, GlueLayer, \
-        MJMModel, MixtureOfExperts
+        MJMModel, MixtureOfExperts, PairInteractionLayer, EmbeddingBagLayer, \
+        make_multilayer_net_from_layers
 
 from cognitive_disco.nets.learning import AdagradTrainer, DataTriplet
 import cognitive_disco.nets.util as util
@@ -114,12 +116,24 @@ def net_experiment0_3(dir_list, args):
 #
 
 
-def _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=False):
-    json_file = set_logger(experiment_name)
+def _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=False,
+        bag_size=None, bag_rank=None):
+    if bag_size is not None:
+        experiment_name = '%s_bag%s' % (experiment_name, bag_size)
+        if bag_rank is not None:
+            experiment_name = '%s_rank%s' % (experiment_name, bag_rank)
+    json_file = util.set_logger(experiment_name)
     lf = l.SecondLevelLabel()
     relation_list_list = [extract_implicit_relations(dir, lf) for dir in dir_list]
-    sfeature_matrices, alphabet = util.sparse_featurize(relation_list_list, ff_list)
+    # the frozen alphabet is saved next to the log and the json output
+    sfeature_matrices, alphabet = util.sparse_featurize(relation_list_list, 
+            ff_list, alphabet_prefix='%s.alphabet' % experiment_name)
     label_vectors, label_alphabet = util.label_vectorize(relation_list_list, lf)
+    if bag_size is not None:
+        _net_experiment1_bag_helper(json_file, experiment_name, 
+                sfeature_matrices, label_vectors, label_alphabet, 
+                use_hinge_loss, bag_size, bag_rank)
+        return
     for rep in xrange(15):
         random_seed = rep
         minibatch_size = 50
@@ -159,84 +173,197 @@ def _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge
                 }
         json_file.write('%s\n' % json.dumps(result_dict, sort_keys=True))
 
+def _net_experiment1_bag_helper(json_file, experiment_name, 
+        sfeature_matrices, label_vectors, label_alphabet, 
+        use_hinge_loss, bag_size, bag_rank):
+    """Same as the sparse helper but the features are padded index lists
+    going into an EmbeddingBagLayer, so only the rows of the features
+    in the minibatch are looked up and updated.
+    """
+    data_list = [[util.csr_to_padded_indices(x)[0]] for x in sfeature_matrices]
+    data_triplet = DataTriplet(data_list, [[x] for x in label_vectors], 
+            [label_alphabet])
+    n_features = sfeature_matrices[0].shape[1]
+    for rep in xrange(15):
+        random_seed = rep
+        minibatch_size = 50
+        n_epochs = 20
+        learning_rate = 0.01
+        lr_smoother = 0.01
+
+        rng = np.random.RandomState(random_seed)
+        bag_layer = EmbeddingBagLayer(rng, n_features, bag_size, rank=bag_rank)
+        nn, _ = make_multilayer_net_from_layers([bag_layer], T.lvector(), 
+                False, 0, 0, len(label_alphabet), 
+                output_activation_fn=None if use_hinge_loss else T.nnet.softmax,
+                dropout=False)
+        trainer = AdagradTrainer(nn, 
+                nn.hinge_loss if use_hinge_loss else nn.crossentropy, 
+                learning_rate, lr_smoother, data_triplet)
+
+        start_time = timeit.default_timer()
+        best_iter, best_dev_acc, best_test_acc = \
+                trainer.train_minibatch_triplet(minibatch_size, n_epochs)
+        end_time = timeit.default_timer()
+        print end_time - start_time 
+        print best_iter, best_dev_acc, best_test_acc
+        result_dict = {
+                'test accuracy': best_test_acc,
+                'best dev accuracy': best_dev_acc,
+                'best iter': best_iter,
+                'random seed': random_seed,
+                'minibatch size': minibatch_size,
+                'learning rate': learning_rate,
+                'lr smoother': lr_smoother,
+                'experiment name': experiment_name,
+                'cost function': 'hinge' if use_hinge_loss else 'crossentropy',
+                'bag size': bag_size,
+                'bag rank': bag_rank,
+                }
+        json_file.write('%s\n' % json.dumps(result_dict, sort_keys=True))
+
 
 def net_experiment1_brown_l(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     bf = f.BrownClusterFeaturizer()
     ff_list = [bf.brown_words]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list,
+            **util.parse_bag_options(args))
 
 def net_experiment1_brown_bl(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     bf = f.BrownClusterFeaturizer()
     ff_list = [bf.brown_word_pairs]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list,
+            **util.parse_bag_options(args))
 
 def net_experiment1_brown_l_bl(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     bf = f.BrownClusterFeaturizer()
     ff_list = [bf.brown_words, bf.brown_word_pairs]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list,
+            **util.parse_bag_options(args))
 
 def net_experiment1_production_l(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     ff_list = [f.production_singles]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list,
+            **util.parse_bag_options(args))
 
 def net_experiment1_production_bl(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     ff_list = [f.production_pairs]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list,
+            **util.parse_bag_options(args))
 
 def net_experiment1_production_l_bl(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     ff_list = [f.production_singles, f.production_pairs]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list,
+            **util.parse_bag_options(args))
 
 def net_experiment1_brown_l2(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     bf = f.BrownClusterFeaturizer()
     ff_list = [bf.brown_words]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True,
+            **util.parse_bag_options(args))
 
 def net_experiment1_brown_bl2(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     bf = f.BrownClusterFeaturizer()
     ff_list = [bf.brown_word_pairs]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True,
+            **util.parse_bag_options(args))
 
 def net_experiment1_brown_l_bl2(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     bf = f.BrownClusterFeaturizer()
     ff_list = [bf.brown_words, bf.brown_word_pairs]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True,
+            **util.parse_bag_options(args))
 
 def net_experiment1_production_l2(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     ff_list = [f.production_singles]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True,
+            **util.parse_bag_options(args))
 
 def net_experiment1_production_bl2(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     ff_list = [f.production_pairs]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True,
+            **util.parse_bag_options(args))
 
 def net_experiment1_production_l_bl2(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     ff_list = [f.production_singles, f.production_pairs]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True,
+            **util.parse_bag_options(args))
 
 def net_experiment1_brown_production_l_bl(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     bf = f.BrownClusterFeaturizer()
     ff_list = [bf.brown_words, bf.brown_word_pairs, f.production_singles, f.production_pairs]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=False)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=False,
+            **util.parse_bag_options(args))
 
 def net_experiment1_brown_production_l_bl2(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     bf = f.BrownClusterFeaturizer()
     ff_list = [bf.brown_words, bf.brown_word_pairs, f.production_singles, f.production_pairs]
-    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True)
+    _net_experiment1_sparse_helper(dir_list, experiment_name, ff_list, use_hinge_loss=True,
+            **util.parse_bag_options(args))
+
+def net_experiment1_brown_fm(dir_list, args):
+    """Brown cluster pairs through the factorization machine
+
+    The pairs are never materialized. The arg1 and arg2 Brown cluster bags
+    go into PairInteractionLayer. The optional argument is the rank.
+    """
+    rank = int(args[0]) if len(args) > 0 else 10
+    experiment_name = sys._getframe().f_code.co_name
+    json_file = util.set_logger('%s_rank%s' % (experiment_name, rank))
+    lf = l.SecondLevelLabel()
+    relation_list_list = [extract_implicit_relations(dir, lf) for dir in dir_list]
+    brown_dict = util.BrownDictionary()
+    data_list = [brown_dict.get_brown_sparse_matrices_relations(relation_list)
+            for relation_list in relation_list_list]
+    label_vectors, label_alphabet = util.label_vectorize(relation_list_list, lf)
+    data_triplet = DataTriplet(data_list, [[x] for x in label_vectors],
+            [label_alphabet])
+    for rep in xrange(15):
+        random_seed = rep
+        minibatch_size = 50
+        n_epochs = 20
+        learning_rate = 0.01
+        lr_smoother = 0.01
+
+        rng = np.random.RandomState(random_seed)
+        fm = PairInteractionLayer(rng, brown_dict.num_clusters,
+                brown_dict.num_clusters, len(label_alphabet), rank,
+                use_sparse=True, Y=T.lvector(), activation_fn=T.nnet.softmax)
+        trainer = AdagradTrainer(fm, fm.crossentropy, learning_rate, lr_smoother,
+                data_triplet)
+        start_time = timeit.default_timer()
+        best_iter, best_dev_acc, best_test_acc = \
+                trainer.train_minibatch_triplet(minibatch_size, n_epochs)
+        end_time = timeit.default_timer()
+        print end_time - start_time
+        print best_iter, best_dev_acc, best_test_acc
+        result_dict = {
+                'test accuracy': best_test_acc,
+                'best dev accuracy': best_dev_acc,
+                'best iter': best_iter,
+                'random seed': random_seed,
+                'minibatch size': minibatch_size,
+                'learning rate': learning_rate,
+                'lr smoother': lr_smoother,
+                'experiment name': experiment_name,
+                'cost function': 'crossentropy',
+                'rank': rank,
+                }
+        json_file.write('%s\n' % json.dumps(result_dict, sort_keys=True))
 
 
 def net_experiment1_word2vec_l(dir_list, args):
@@ -280,8 +407,14 @@ def net_experiment1_word2vec_l(dir_list, args):
         json_file.write('%s\n' % json.dumps(result_dict, sort_keys=True))
 
 def net_experiment1_word2vec_bl(dir_list, args):
+    """The optional argument is the rank of the factorized bilinear layer
+    """
     experiment_name = sys._getframe().f_code.co_name    
-    json_file = set_logger(experiment_name)
+    rank = int(args[0]) if len(args) > 0 else None
+    if rank is None:
+        json_file = set_logger(experiment_name)
+    else:
+        json_file = set_logger('%s_rank%s' % (experiment_name, rank))
     lf = l.SecondLevelLabel()
     relation_list_list = [extract_implicit_relations(dir, lf) for dir in dir_list]
 
@@ -300,7 +433,7 @@ def net_experiment1_word2vec_bl(dir_list, args):
 
         blm = BilinearLayer(rng, data_triplet.input_dimensions()[0],
             data_triplet.input_dimensions()[1], len(label_alphabet),
-            Y=T.lvector(), activation_fn=T.nnet.softmax)
+            Y=T.lvector(), activation_fn=T.nnet.softmax, rank=rank)
 
         trainer = AdagradTrainer(blm, blm.crossentropy, learning_rate, lr_smoother)
         start_time = timeit.default_timer()
@@ -318,6 +451,7 @@ def net_experiment1_word2vec_bl(dir_list, args):
                 'learning rate': learning_rate,
                 'lr smoother': lr_smoother,
                 'experiment name': experiment_name,
+                'rank': rank,
                 }
         json_file.write('%s\n' % json.dumps(result_dict, sort_keys=True))
 
@@ -426,8 +560,14 @@ def net_experiment1_word2vec_l2(dir_list, args):
         json_file.write('%s\n' % json.dumps(result_dict, sort_keys=True))
 
 def net_experiment1_word2vec_bl2(dir_list, args):
+    """The optional argument is the rank of the factorized bilinear layer
+    """
     experiment_name = sys._getframe().f_code.co_name    
-    json_file = set_logger(experiment_name)
+    rank = int(args[0]) if len(args) > 0 else None
+    if rank is None:
+        json_file = set_logger(experiment_name)
+    else:
+        json_file = set_logger('%s_rank%s' % (experiment_name, rank))
     lf = l.SecondLevelLabel()
     relation_list_list = [extract_implicit_relations(dir, lf) for dir in dir_list]
 
@@ -446,7 +586,7 @@ def net_experiment1_word2vec_bl2(dir_list, args):
 
         blm = BilinearLayer(rng, data_triplet.input_dimensions()[0],
             data_triplet.input_dimensions()[1], len(label_alphabet),
-            Y=T.lvector(), activation_fn=None)
+            Y=T.lvector(), activation_fn=None, rank=rank)
 
         trainer = AdagradTrainer(blm, blm.hinge_loss, learning_rate, lr_smoother)
         start_time = timeit.default_timer()
@@ -464,6 +604,7 @@ def net_experiment1_word2vec_bl2(dir_list, args):
                 'learning rate': learning_rate,
                 'lr smoother': lr_smoother,
                 'experiment name': experiment_name,
+                'rank': rank,
                 'cost function': 'hinge'
                 }
         json_file.write('%s\n' % json.dumps(result_dict, sort_keys=True))
@@ -600,25 +741,31 @@ def net_experiment1_cdssm_l(dir_list, args):
         num_reps = 2
     else:
         num_reps = 30
-    _run_simple_net(experiment_name+'_hinge', df.cdssm_feature, num_reps, dir_list, 
+    cdssm_ff = functools.partial(df.cdssm_feature,
+            sidecar=df.load_vector_sidecar(dir_list))
+    _run_simple_net(experiment_name+'_hinge', cdssm_ff, num_reps, dir_list, 
             use_linear=True, use_bilinear=False, use_hinge=True)
-    _run_simple_net(experiment_name+'_xe', df.cdssm_feature, num_reps, dir_list, 
+    _run_simple_net(experiment_name+'_xe', cdssm_ff, num_reps, dir_list, 
             use_linear=True, use_bilinear=False, use_hinge=False)
 
 def net_experiment1_cdssm_bl(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     num_reps = 30
-    _run_simple_net(experiment_name+'_hinge', df.cdssm_feature, num_reps, dir_list, 
+    cdssm_ff = functools.partial(df.cdssm_feature,
+            sidecar=df.load_vector_sidecar(dir_list))
+    _run_simple_net(experiment_name+'_hinge', cdssm_ff, num_reps, dir_list, 
             use_linear=False, use_bilinear=True, use_hinge=True)
-    _run_simple_net(experiment_name+'_xe', df.cdssm_feature, num_reps, dir_list, 
+    _run_simple_net(experiment_name+'_xe', cdssm_ff, num_reps, dir_list, 
             use_linear=False, use_bilinear=True, use_hinge=False)
 
 def net_experiment1_cdssm_l_bl(dir_list, args):
     experiment_name = sys._getframe().f_code.co_name    
     num_reps = 30
-    _run_simple_net(experiment_name+'_hinge', df.cdssm_feature, num_reps, dir_list, 
+    cdssm_ff = functools.partial(df.cdssm_feature,
+            sidecar=df.load_vector_sidecar(dir_list))
+    _run_simple_net(experiment_name+'_hinge', cdssm_ff, num_reps, dir_list, 
             use_linear=True, use_bilinear=True, use_hinge=True)
-    _run_simple_net(experiment_name+'_xe', df.cdssm_feature, num_reps, dir_list, 
+    _run_simple_net(experiment_name+'_xe', cdssm_ff, num_reps, dir_list, 
             use_linear=True, use_bilinear=True, use_hinge=False)
 
 # net_experiment2_x series
@@ -1022,10 +1169,11 @@ def net_experiment3_cdssm(dir_list, args):
     relation_list_list = [extract_implicit_relations(dir, sense_lf) for dir in dir_list]
     num_reps = 20
 
+    sidecar = df.load_vector_sidecar(dir_list)
     data_list = []
     for relation_list in relation_list_list:
         data = []
-        data.extend(df.cdssm_feature(relation_list))
+        data.extend(df.cdssm_feature(relation_list, sidecar))
         data.extend(df.cached_features(relation_list, 'BaselineClassification'))
         data_list.append(data)
     label_vectors, label_alphabet = util.label_vectorize(relation_list_list, sense_lf)
@@ -1052,7 +1200,7 @@ def net_experiment4_1(dir_list, args):
             (experiment_name, num_units, num_hidden_layers, projection))
 
     relation_list_list = [extract_implicit_relations(dir, sense_lf) for dir in dir_list]
-    word2vec_ff = util._get_word2vec_ff(num_units, projection)
+    word2vec_ff = util._get_word2vec_ff(num_units, projection, dir_list)
     data_list = [word2vec_ff(relation_list) for relation_list in relation_list_list]
     label_vectors, label_alphabet = util.label_vectorize(relation_list_list, sense_lf)
     data_triplet = DataTriplet(data_list, [[x] for x in label_vectors], [label_alphabet])
@@ -0,0 +1,192 @@
+"""Feature selection on sparse feature matrices
+
+Python versions of the feature selection in src/feature_selection
+(MInfoGain.java and FreqCutoff.java) plus chi-square.
+Everything is computed from the contingency counts of
+(feature present, label), which we get from one sparse product
+X.T * onehot(Y) per chunk of features.
+
+Several label vectors (e.g. one per dimension of a GenericMapping) can be
+scored in one pass. A label of -1 means that the instance does not have
+a label in that dimension and it is not counted.
+"""
+import numpy as np
+import scipy as sp
+import scipy.sparse
+from scipy.special import xlogy
+
+from cognitive_disco.nets.util import select_top_features, select_csr_columns
+
+def mapping_label_vectors(relation_list, lf_list):
+    """Make label vectors for all of the label functions
+
+    Use this with GenericMapping.get_all_label_functions().
+    Relations whose label is None get -1.
+
+    Returns
+        a list of label vectors (int64) and a list of label alphabets
+    """
+    label_vectors = []
+    alphabets = []
+    for lf in lf_list:
+        alphabet = {}
+        for label in sorted(lf.valid_labels()):
+            alphabet[label] = len(alphabet)
+        label_vector = []
+        for relation in relation_list:
+            label = lf.label(relation)
+            label_vector.append(-1 if label is None else alphabet[label])
+        label_vectors.append(np.array(label_vector, np.int64))
+        alphabets.append(alphabet)
+    return label_vectors, alphabets
+
+def _stacked_label_matrix(label_vector_list):
+    """One-hot matrices of all label vectors side by side
+
+    Returns the N x (L1 + L2 + ...) sparse matrix and the column offsets
+    """
+    num_rows = len(label_vector_list[0])
+    rows = []
+    columns = []
+    offsets = [0]
+    for label_vector in label_vector_list:
+        label_vector = np.asarray(label_vector)
+        assert len(label_vector) == num_rows
+        labeled = np.nonzero(label_vector >= 0)[0]
+        rows.append(labeled)
+        columns.append(label_vector[labeled] + offsets[-1])
+        offsets.append(offsets[-1] + np.max(label_vector) + 1)
+    rows = np.concatenate(rows)
+    columns = np.concatenate(columns)
+    label_matrix = sp.sparse.csr_matrix(
+            (np.ones(len(rows)), (rows, columns)),
+            shape=(num_rows, offsets[-1]))
+    return label_matrix, offsets
+
+def _contingency_chunks(feature_matrix, label_vector_list, chunk_size):
+    """Count (feature present, label) one chunk of features at a time
+
+    Only the presence of a feature counts (value > 0) like MInfoGain.java.
+
+    Yields (start column index, a list of target_feature_count matrices)
+    target_feature_count is chunk_size x num_labels for each label vector.
+    """
+    presence = sp.sparse.csc_matrix(feature_matrix > 0, dtype=np.float64)
+    label_matrix, offsets = _stacked_label_matrix(label_vector_list)
+    num_features = presence.shape[1]
+    for start in xrange(0, num_features, chunk_size):
+        end = min(start + chunk_size, num_features)
+        counts = presence[:, start:end].T.dot(label_matrix).toarray()
+        yield start, [counts[:, offsets[i]:offsets[i + 1]]
+                for i in range(len(label_vector_list))]
+
+def _binary_entropy(p):
+    return -xlogy(p, p) - xlogy(1 - p, 1 - p)
+
+def _target_counts(label_vector_list):
+    """The number of instances with each label for each label vector"""
+    target_counts = []
+    for label_vector in label_vector_list:
+        label_vector = np.asarray(label_vector)
+        num_labels = np.max(label_vector) + 1
+        target_counts.append(np.bincount(label_vector[label_vector >= 0], 
+            minlength=num_labels).astype(np.float64))
+    return target_counts
+
+def info_gain(target_feature_count, target_count):
+    """Information gain as in Lin et al. (2009) and MInfoGain.java
+
+    For each label, we compute the information gain of the presence of
+    the feature for the binary (label vs. the rest) distinction
+    and take the best one over the labels.
+    """
+    feature_count = target_feature_count.sum(1)
+    total = target_count.sum()
+    if total == 0:
+        return np.zeros(len(feature_count))
+
+    base_entropy = _binary_entropy(target_count / total)
+
+    present_norm = np.maximum(feature_count, 1)[:, None]
+    present_entropy = _binary_entropy(target_feature_count / present_norm)
+    absent_norm = np.maximum(total - feature_count, 1)[:, None]
+    absent_entropy = _binary_entropy(
+            (target_count - target_feature_count) / absent_norm)
+
+    p_present = (feature_count / total)[:, None]
+    conditional_entropy = p_present * present_entropy + \
+            (1 - p_present) * absent_entropy
+    return (base_entropy - conditional_entropy).max(1)
+
+def chi_square(target_feature_count, target_count):
+    """Chi-square statistic of the 2x2 table (feature present, label)
+
+    We take the best one over the labels.
+    """
+    feature_count = target_feature_count.sum(1)[:, None]
+    total = target_count.sum()
+    target_count = target_count[None, :]
+
+    a = target_feature_count
+    b = feature_count - a
+    c = target_count - a
+    d = total - feature_count - target_count + a
+    denom = (a + b) * (c + d) * (a + c) * (b + d)
+    chi2 = total * np.square(a * d - b * c) / np.maximum(denom, 1e-12)
+    chi2[denom == 0] = 0
+    return chi2.max(1)
+
+def score_features(feature_matrix, label_vector_list,
+        score_fn=info_gain, chunk_size=50000):
+    """Score every feature against every label vector in one pass
+
+    Returns a list of score vectors, one for each label vector
+    """
+    num_features = feature_matrix.shape[1]
+    scores = [np.zeros(num_features) for x in label_vector_list]
+    target_counts = _target_counts(label_vector_list)
+    for start, count_list in _contingency_chunks(
+            feature_matrix, label_vector_list, chunk_size):
+        for score, counts, target_count in \
+                zip(scores, count_list, target_counts):
+            score[start:start + counts.shape[0]] = \
+                    score_fn(counts, target_count)
+    return scores
+
+def feature_frequencies(feature_matrix):
+    """The number of instances in which each feature is present
+
+    Same as FreqCutoff.countFrequency
+    """
+    feature_matrix = sp.sparse.csr_matrix(feature_matrix)
+    present = feature_matrix.indices[feature_matrix.data > 0]
+    return np.bincount(present, minlength=feature_matrix.shape[1])
+
+def frequency_cutoff(feature_matrix, cutoff):
+    """Returns the indices of the features that occur at least cutoff times"""
+    frequencies = feature_frequencies(feature_matrix)
+    return np.nonzero(frequencies >= cutoff)[0].astype(np.int32)
+
+def select_features(feature_matrix, label_vector_list, num_features,
+        score_fn=info_gain, min_frequency=0, chunk_size=50000):
+    """Select the top features for each label vector
+
+    Features that occur fewer than min_frequency times are never selected.
+
+    Returns a list of feature index arrays, one for each label vector
+    """
+    scores = score_features(feature_matrix, label_vector_list,
+            score_fn, chunk_size)
+    if min_frequency > 0:
+        rare = feature_frequencies(feature_matrix) < min_frequency
+        for score in scores:
+            score[rare] = -np.inf
+    selected = []
+    for score in scores:
+        num_valid = np.sum(np.isfinite(score))
+        selected.append(select_top_features(score, min(num_features, num_valid)))
+    return selected
+
+def prune_feature_matrices(feature_matrices, feature_indices):
+    """Keep only the selected columns. The matrices stay CSR."""
+    return [select_csr_columns(x, feature_indices) for x in feature_matrices]
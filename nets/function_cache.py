@@ -0,0 +1,361 @@
+"""Cache of the compiled functions of the trainers
+
+Taking the gradient and compiling the training function take most of the
+start-up time of an experiment, and the helpers build the same architecture
+again and again (across hidden layer sizes, experiments and processes).
+The functions are keyed by the structural signature of the graph: the ops,
+the types of the inputs, the values of the constants and the types of the
+shared variables (dtype, number of dimensions and broadcastable pattern),
+but not their values or shapes. The compiled functions work on shared 
+variables of any shape, so the hidden layer sizes and the size of the data
+only change the key when they show up as constants in the graph (e.g. the
+gate slices of the LSTMs).
+
+The key is computed before taking the gradient, so the update rule is not
+in the graph. The trainer adds source_signature of the optimizer and the 
+trainer classes to the key instead, and any edit to those source files 
+(e.g. optimizers.py or learning.py) makes new keys.
+
+A cached function is stored with placeholders for its shared variables
+(params, optimizer states, training data, ...). On a hit, we copy the
+function and swap in the shared variables of the new trainer, which skips
+the gradient and the graph optimization. The functions are also pickled
+in FUNCTION_CACHE_DIR (COGNITIVE_DISCO_CACHE/compiled_functions) so that 
+the next process can load them. After each save, the least recently used 
+files are deleted until the directory is under max_disk_bytes. 
+Pass use_disk=False to keep the cache in memory only.
+
+    cache = FunctionCache()
+    functions = cache.get(key, shared_variables)
+    if functions is None:
+        functions = {'train': theano.function(...), ...}
+        cache.put(key, functions, shared_variables, compile_time)
+    print cache.report()
+"""
+import copy
+import cPickle
+import hashlib
+import inspect
+import os
+import re
+import sys
+import timeit
+
+import numpy as np
+import scipy.sparse as sp
+import theano
+import theano.tensor as T
+from theano import config
+from theano.compile.io import SymbolicOutput
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof import DestroyHandler, FunctionGraph, graph
+
+from cognitive_disco.nets.embedding_store import CACHE_DIR
+
+FUNCTION_CACHE_DIR = os.path.join(CACHE_DIR, 'compiled_functions')
+FUNCTION_CACHE_VERSION = 1
+PICKLE_RECURSION_LIMIT = 50000
+MAX_DISK_BYTES = 2 * 2 ** 30
+
+def _describe_op(op):
+    if hasattr(op, 'inputs') and hasattr(op, 'outputs'):
+        # scan and the other ops with an inner graph
+        inner_signature, _ = graph_signature(op.outputs, op.inputs)
+        info = sorted(getattr(op, 'info', {}).items())
+        return '%s %s %s' % (type(op).__name__, info, inner_signature)
+    if hasattr(op, '__props__'):
+        return '%s%r' % (type(op).__name__, op._props())
+    return str(op)
+
+def _describe_variable(variable):
+    if isinstance(variable, SharedVariable):
+        # the type has the broadcastable pattern. The compiled function
+        # does not depend on the shape.
+        return 'shared %s' % variable.type
+    if isinstance(variable, graph.Constant):
+        data = np.asarray(variable.data)
+        if data.dtype == object:
+            return 'constant %s %r' % (variable.type, variable.data)
+        return 'constant %s %s' % (variable.type,
+                hashlib.md5(data.tostring()).hexdigest())
+    return str(variable.type)
+
+def graph_signature(outputs, variables=[], extra=[]):
+    """Structural signature of the graph of outputs
+
+    Two graphs get the same signature if they apply the same ops in
+    the same order to inputs of the same types. variables (e.g. the
+    symbolic inputs and the params) are located in the graph so that
+    graphs that only differ in which variable is which do not collide.
+    extra is a list of anything else that the function depends on.
+
+    Returns (signature, the shared variables in the order of the graph)
+    """
+    lines = [repr(x) for x in extra]
+    numbers = {}
+    shared_variables = []
+    def number(variable):
+        if variable not in numbers:
+            numbers[variable] = len(numbers)
+            lines.append('%s %s' %
+                    (numbers[variable], _describe_variable(variable)))
+            if isinstance(variable, SharedVariable):
+                shared_variables.append(variable)
+        return numbers[variable]
+
+    for node in graph.io_toposort(graph.inputs(outputs), outputs):
+        input_numbers = [number(x) for x in node.inputs]
+        lines.append('%s %s' % (_describe_op(node.op), input_numbers))
+        for x in node.outputs:
+            number(x)
+    lines.append('outputs %s' % [number(x) for x in outputs])
+    lines.append('variables %s' % [numbers.get(x, -1) for x in variables])
+    # the reprs of functions and objects in the op props have addresses
+    text = re.sub(' at 0x[0-9a-f]+', '', '\n'.join(lines))
+    return hashlib.md5(text).hexdigest(), shared_variables
+
+def compilation_options():
+    """The theano settings that change the compiled function"""
+    return [FUNCTION_CACHE_VERSION, theano.__version__, config.floatX,
+            config.device, str(config.mode), config.linker, config.optimizer,
+            bool(config.cxx)]
+
+_SOURCE_MD5 = {}
+
+def source_signature(classes):
+    """md5 of the source files that define the classes (and their bases)
+
+    The update rule (the optimizer and the trainer code) goes into 
+    the function after the cache lookup, so the key has to cover its code.
+    """
+    file_names = set()
+    for cls in classes:
+        for base in inspect.getmro(cls):
+            if base is not object:
+                file_names.add(inspect.getsourcefile(base))
+    file_names.add(inspect.getsourcefile(sys.modules[__name__]))
+    md5 = hashlib.md5()
+    for file_name in sorted(x for x in file_names if x is not None):
+        if file_name not in _SOURCE_MD5:
+            with open(file_name, 'rb') as f:
+                _SOURCE_MD5[file_name] = hashlib.md5(f.read()).hexdigest()
+        md5.update(_SOURCE_MD5[file_name])
+    return md5.hexdigest()
+
+def _placeholder(variable):
+    """Empty shared variable of the same type as variable"""
+    if isinstance(variable.type, T.TensorType):
+        shape = [1 if x else 0 for x in variable.broadcastable]
+        return theano.shared(np.zeros(shape, dtype=variable.dtype),
+                broadcastable=variable.broadcastable)
+    value = variable.get_value(borrow=True)
+    if sp.issparse(value):
+        value = value[:0]
+    return theano.shared(value)
+
+def _shared_inputs(function):
+    return [x.variable for x in function.maker.inputs
+            if isinstance(x.variable, SharedVariable)]
+
+def _same_type(type1, type2):
+    # RandomStateType has no __eq__ so the unpickled ones never match
+    return type1 == type2 or \
+            (type(type1) is type(type2) and str(type1) == str(type2))
+
+def swap_shared_variables(function, swap):
+    """Copy of the compiled function with the shared variables swapped
+
+    This is Function.copy(swap=swap) with a DestroyHandler on the copied
+    graph. Without it, the in-place updates (e.g. the rows of the sparse
+    params and their states) may run before the reads of the old values.
+
+    Returns None if one of the shared variables of the function is not
+    in swap or if the types do not match.
+    """
+    maker = function.maker
+    shared_inputs = _shared_inputs(function)
+    if any(x not in swap for x in shared_inputs):
+        return None
+    if not all(_same_type(x.type, swap[x].type) for x in shared_inputs):
+        return None
+
+    equiv = graph.clone_get_equiv(maker.fgraph.inputs, maker.fgraph.outputs)
+    fgraph = FunctionGraph([equiv[x] for x in maker.fgraph.inputs],
+            [equiv[x] for x in maker.fgraph.outputs], clone=False)
+    fgraph.attach_feature(DestroyHandler())
+    outputs = [SymbolicOutput(x, borrow=y.borrow) for x, y in 
+            zip(fgraph.outputs, maker.outputs)]
+    inputs = []
+    update_outputs = iter(fgraph.outputs[len(maker.outputs):])
+    for spec, variable in zip(maker.inputs, fgraph.inputs):
+        spec = copy.copy(spec)
+        if spec.variable in swap:
+            spec.value = swap[spec.variable].container
+        spec.variable = variable
+        if spec.update is not None:
+            spec.update = next(update_outputs)
+        inputs.append(spec)
+    function_copy = maker.__class__(inputs=inputs, outputs=outputs, 
+            fgraph=fgraph, mode=maker.mode, on_unused_input='ignore',
+            function_builder=maker.function_builder, accept_inplace=True,
+            output_keys=maker.output_keys).create([x.value for x in inputs])
+    # so that we can swap the shared variables of the copy again
+    for spec, copied_spec in zip(maker.inputs, function_copy.maker.inputs):
+        if spec.variable in swap:
+            copied_spec.variable = swap[spec.variable]
+    # the maker of the copy has a list of outputs, so the single output
+    # would come back in a list
+    for x in ['unpack_single', 'return_none']:
+        setattr(function_copy, x, getattr(function, x))
+        setattr(function_copy.maker, x, getattr(function.maker, x))
+    return function_copy
+
+
+class FunctionCache(object):
+    """Compiled functions keyed by graph signature in memory and on disk
+
+    shared_variables must list the shared variables of the functions
+    in the same order for the same key (see graph_signature).
+    """
+
+    def __init__(self, cache_dir=FUNCTION_CACHE_DIR, use_disk=True,
+            max_disk_bytes=MAX_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.use_disk = use_disk
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = {}
+        self.num_hits = 0
+        self.num_disk_hits = 0
+        self.num_misses = 0
+        self.compile_time = 0.0
+        self.time_saved = 0.0
+
+    def cache_file(self, key):
+        return os.path.join(self.cache_dir, '%s.pkl' % key)
+
+    def get(self, key, shared_variables):
+        """Returns a dictionary of functions that use shared_variables
+        or None if the key is not in the cache
+        """
+        start_time = timeit.default_timer()
+        from_disk = False
+        if key not in self.entries and self.use_disk:
+            from_disk = self._load(key)
+        if key not in self.entries:
+            self.num_misses += 1
+            return None
+        functions, placeholders, compile_time = self.entries[key]
+        if len(placeholders) != len(shared_variables):
+            self.num_misses += 1
+            return None
+        swap = dict(zip(placeholders, shared_variables))
+        copies = {}
+        for name, function in functions.items():
+            copies[name] = None if function is None else \
+                    swap_shared_variables(function, swap)
+            if function is not None and copies[name] is None:
+                self.num_misses += 1
+                return None
+        self.num_hits += 1
+        if from_disk:
+            self.num_disk_hits += 1
+        self.time_saved += max(
+                compile_time - (timeit.default_timer() - start_time), 0)
+        return copies
+
+    def put(self, key, functions, shared_variables, compile_time):
+        """Cache the functions and save them to disk
+
+        We keep the copies with the placeholders so that the cache
+        does not hold on to the params and the training data.
+        """
+        self.compile_time += compile_time
+        placeholders = [_placeholder(x) for x in shared_variables]
+        swap = dict(zip(shared_variables, placeholders))
+        light_functions = {}
+        for name, function in functions.items():
+            light_functions[name] = None if function is None else \
+                    swap_shared_variables(function, swap)
+            if function is not None and light_functions[name] is None:
+                print 'Function %s uses shared variables that ' % name + \
+                        'are not in the signature. Not cached.'
+                return
+        self.entries[key] = (light_functions, placeholders, compile_time)
+        if self.use_disk:
+            self._save(key)
+
+    def _save(self, key):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        file_name = self.cache_file(key)
+        tmp_file_name = '%s.%s.tmp' % (file_name, os.getpid())
+        recursion_limit = sys.getrecursionlimit()
+        # the graphs with scan are too deep for the default limit
+        sys.setrecursionlimit(max(recursion_limit, PICKLE_RECURSION_LIMIT))
+        try:
+            with open(tmp_file_name, 'wb') as f:
+                cPickle.dump(self.entries[key], f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_file_name, file_name)
+            self.prune()
+        except (cPickle.PicklingError, RuntimeError, TypeError) as e:
+            print 'Could not save the compiled functions: %s' % e
+            if os.path.exists(tmp_file_name):
+                os.remove(tmp_file_name)
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+
+    def _load(self, key):
+        file_name = self.cache_file(key)
+        if not os.path.exists(file_name):
+            return False
+        recursion_limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(max(recursion_limit, PICKLE_RECURSION_LIMIT))
+        try:
+            with open(file_name, 'rb') as f:
+                self.entries[key] = cPickle.load(f)
+            # prune deletes the files with the oldest modification time
+            os.utime(file_name, None)
+        except Exception as e:
+            print 'Could not load the compiled functions: %s' % e
+            return False
+        finally:
+            sys.setrecursionlimit(recursion_limit)
+        return True
+
+    def prune(self, max_disk_bytes=None):
+        """Delete the least recently used files over max_disk_bytes
+
+        Returns the number of files deleted
+        """
+        if max_disk_bytes is None:
+            max_disk_bytes = self.max_disk_bytes
+        if not os.path.exists(self.cache_dir):
+            return 0
+        files = []
+        for x in os.listdir(self.cache_dir):
+            if x.endswith('.pkl'):
+                file_name = os.path.join(self.cache_dir, x)
+                stat = os.stat(file_name)
+                files.append((stat.st_mtime, stat.st_size, file_name))
+        total_bytes = sum(x[1] for x in files)
+        num_deleted = 0
+        for _, num_bytes, file_name in sorted(files):
+            if total_bytes <= max_disk_bytes:
+                break
+            try:
+                os.remove(file_name)
+            except OSError:
+                # another process got to it first
+                continue
+            total_bytes -= num_bytes
+            num_deleted += 1
+        return num_deleted
+
+    def report(self):
+        return 'Function cache: %s hits ' % self.num_hits + \
+                '(%s from disk), %s misses. ' % \
+                (self.num_disk_hits, self.num_misses) + \
+                'Compiled for %.1f seconds and saved %.1f seconds' % \
+                (self.compile_time, self.time_saved)
+
+DEFAULT_FUNCTION_CACHE = FunctionCache()
@@ -1,9 +1,32 @@
+from collections import OrderedDict
+
 import numpy as np
 import theano
 import theano.tensor as T
-from theano import config
+from theano.gof import graph
 import timeit
 
+from cognitive_disco.nets.function_cache import DEFAULT_FUNCTION_CACHE, \
+        compilation_options, graph_signature, source_signature
+from cognitive_disco.nets.optimizers import Adagrad
+
+def unique_with_inverse(x):
+    """The sorted unique values of the vector x and the positions of x in them
+
+    Same as T.extra_ops.Unique(return_inverse=True)(x) but made of ops that
+    infer their shapes. The infer_shape of Unique needs node.fgraph, so
+    theano 1.0.5 logs a traceback for it whenever the graph goes into scan.
+    """
+    order = T.argsort(x)
+    sorted_x = x[order]
+    # flag the first element and every element that differs from the previous
+    is_first = T.concatenate([T.ones((T.minimum(x.shape[0], 1),), 
+        dtype='int64'), T.neq(sorted_x[1:], sorted_x[:-1]).astype('int64')])
+    unique_x = sorted_x[is_first.nonzero()[0]]
+    inverse = T.set_subtensor(T.zeros(x.shape, dtype='int64')[order], 
+            T.cumsum(is_first) - 1)
+    return unique_x, inverse
+
 class DataTriplet(object):
 
     def __init__(self, data_list=None, label_vectors=None, label_alphabet_list=None):
@@ -30,6 +53,9 @@ class DataTriplet(object):
         for x in data_list:
             if len(x.shape) == 3:
                 num_rows.append(x.shape[1])
+            elif len(x.shape) == 2 and x.dtype.kind == 'i':
+                # 2T x N node label indices
+                num_rows.append(x.shape[1])
             elif len(x.shape) == 1 or len(x.shape) == 2:
                 num_rows.append(x.shape[0])
             else:
@@ -75,8 +101,149 @@ class DataTriplet(object):
         return self.test_data + self.test_data_label
 
 
+class LengthBucketSampler(object):
+    """Length-bucketed minibatches with per-minibatch padding
+
+    The serrated matrices (T x N x d series and T x N masks) are padded to
+    the same max length, so scan runs the full T steps for every minibatch
+    even though most arguments are much shorter. The sampler sorts 
+    the training samples into buckets by length (the longer of the args, 
+    rounded up to bucket_width) and shuffles them within the bucket. 
+    The time axis of each minibatch is trimmed to the longest sample in it 
+    so the scan steps track the real lengths. 
+
+    At the start of every epoch, the trainer calls shuffle, which shuffles 
+    the samples within the buckets again and regroups the minibatches.
+    The remainder that does not fill a minibatch is drawn at random 
+    and left out of that epoch, so every sample gets trained on.
+
+    The training data are reordered in place, so make the sampler before 
+    the trainer. The dev and test data are trimmed to their own max length.
+    All buckets live in the same shared tensors and the compiled function
+    slices the time axis with the time_steps shared variable, so we compile
+    only once.
+
+    time_major_indices - the input variables with time as the first axis
+    mask_indices - the T x N masks among the input variables
+    """
+
+    def __init__(self, data_triplet, time_major_indices=[0, 1, 2, 3], 
+            mask_indices=[1, 3], bucket_width=5, rng=None):
+        if rng is None:
+            rng = np.random.RandomState(100)
+        self.rng = rng
+        self.data_triplet = data_triplet
+        self.time_major_indices = time_major_indices
+        self.mask_indices = mask_indices
+        self.bucket_width = bucket_width
+
+        masks = [data_triplet.training_data[i] for i in mask_indices]
+        self.max_length = masks[0].shape[0]
+        num_tokens = np.array([m.sum(axis=0) for m in masks])
+        lengths = np.maximum(num_tokens.max(axis=0), 1).astype('int64')
+        buckets = (lengths + bucket_width - 1) // bucket_width
+        order = np.lexsort((rng.permutation(len(lengths)), buckets))
+
+        self.lengths = lengths[order]
+        self.buckets = buckets[order]
+        self.num_tokens = num_tokens.sum(axis=0)[order]
+        trimmed_length = self.lengths.max()
+        data_triplet.training_data = \
+                self._reorder(data_triplet.training_data, order, trimmed_length)
+        data_triplet.training_data_label = \
+                [x[order] for x in data_triplet.training_data_label]
+        data_triplet.dev_data = self._trim(data_triplet.dev_data)
+        data_triplet.test_data = self._trim(data_triplet.test_data)
+        self.time_steps = theano.shared(np.int64(trimmed_length))
+
+    def _reorder(self, data_list, order, length=None):
+        return [x[:length, order] if i in self.time_major_indices else x[order]
+                for i, x in enumerate(data_list)]
+
+    def _trim(self, data_list):
+        length = max(max(data_list[i].sum(axis=0).max() 
+            for i in self.mask_indices), 1)
+        return [x[:int(length)] if i in self.time_major_indices else x
+                for i, x in enumerate(data_list)]
+
+    def make_givens(self, make_givens_fn):
+        """Wrap make_givens_fn so that the time axis is trimmed to time_steps
+        """
+        def _make_givens(givens, input_vec, T_training_data, 
+                output_vec, T_training_data_label, start_idx, end_idx):
+            trimmed_data = [x[:self.time_steps] 
+                    if i in self.time_major_indices else x 
+                    for i, x in enumerate(T_training_data)]
+            make_givens_fn(givens, input_vec, trimmed_data, 
+                    output_vec, T_training_data_label, start_idx, end_idx)
+        return _make_givens
+
+    def shuffle(self, minibatch_size, shared_data_list):
+        """Regroup the training data into new minibatches for the epoch
+
+        The samples left over from the full minibatches are picked at 
+        random and moved to the end. The others are sorted by bucket and 
+        shuffled within the bucket. shared_data_list holds the shared 
+        variables of data_triplet.training_data_and_label_list().
+        """
+        num_samples = len(self.lengths)
+        left_over = np.zeros(num_samples, dtype=bool)
+        left_over[self.rng.permutation(num_samples)[
+            :num_samples % minibatch_size]] = True
+        order = np.lexsort(
+                (self.rng.permutation(num_samples), self.buckets, left_over))
+        self.lengths = self.lengths[order]
+        self.buckets = self.buckets[order]
+        self.num_tokens = self.num_tokens[order]
+
+        data_triplet = self.data_triplet
+        data_triplet.training_data = \
+                self._reorder(data_triplet.training_data, order)
+        data_triplet.training_data_label = \
+                [x[order] for x in data_triplet.training_data_label]
+        for shared_data, x in zip(shared_data_list, 
+                data_triplet.training_data_and_label_list()):
+            shared_data.set_value(x, borrow=True)
+
+    def minibatch_order(self, n_train_batches):
+        """Shuffle the minibatches so that we do not go from short to long
+        """
+        return self.rng.permutation(n_train_batches)
+
+    def set_minibatch(self, minibatch_index, minibatch_size):
+        start_idx = minibatch_index * minibatch_size
+        end_idx = start_idx + minibatch_size
+        self.time_steps.set_value(np.int64(self.lengths[start_idx:end_idx].max()))
+
+    def padding_waste(self, minibatch_size):
+        """The fraction of the scanned time slices that are padding
+
+        Returns (waste before, waste after) over the samples in the full 
+        minibatches of the current grouping (see shuffle).
+        Before is the fixed max length padding. After is the bucketed one.
+        """
+        n_train_batches = len(self.lengths) / minibatch_size
+        num_used = n_train_batches * minibatch_size
+        num_real = float(self.num_tokens[:num_used].sum())
+        num_args = len(self.mask_indices)
+        num_before = num_args * num_used * self.max_length
+        batch_lengths = self.lengths[:num_used].\
+                reshape((n_train_batches, minibatch_size)).max(axis=1)
+        num_after = num_args * minibatch_size * batch_lengths.sum()
+        return 1. - num_real / num_before, 1. - num_real / num_after
+
+    def padding_report(self, minibatch_size):
+        before, after = self.padding_waste(minibatch_size)
+        return 'Padding waste with minibatch size %s: ' % minibatch_size + \
+                'before = %.1f%% after = %.1f%%' % (100 * before, 100 * after)
+
+
 class Trainer(object):
 
+    bucket_sampler = None
+    lr_schedule = None
+    steps_per_call = 1
+
     def train_minibatch(self, minibatch_size, n_epochs, 
             training_data, dev_data, test_data):
         """Train minibatch with one output
@@ -98,6 +265,35 @@ class Trainer(object):
                 minibatch_size, n_epochs, data_triplet)
 
 
+    def _num_steps(self, iteration, num_remaining, validation_frequency, 
+            patience):
+        """The number of minibatches for the next call of the training function
+
+        A call stops at the next validation and at the end of the patience
+        so we validate and stop at the same iterations as one step per call.
+        """
+        num_steps = min(self.steps_per_call, num_remaining,
+                validation_frequency - iteration % validation_frequency,
+                patience - iteration + 1)
+        return max(num_steps, 1)
+
+    def _train_steps(self, minibatch_indices, minibatch_size):
+        """Train on the minibatches and return their costs"""
+        if len(minibatch_indices) > 1:
+            return self.train_steps_function(
+                    np.asarray(minibatch_indices, dtype='int64'), 
+                    minibatch_size)
+        minibatch_index = minibatch_indices[0]
+        if self.bucket_sampler is not None:
+            self.bucket_sampler.set_minibatch(
+                    minibatch_index, minibatch_size)
+
+        if self.misc_function is not None:
+            misc = self.misc_function(minibatch_index, minibatch_size)
+            print misc
+
+        return [self.train_function(minibatch_index, minibatch_size)]
+
     def train_minibatch_triplet(self, minibatch_size, n_epochs):
         """Train with minibatch
 
@@ -120,86 +316,114 @@ class Trainer(object):
         total_cost = 0.0
         while (epoch < n_epochs) and (not done_looping):
             epoch = epoch + 1
-            for minibatch_index in xrange(n_train_batches):
-
-                iteration = (epoch - 1) * n_train_batches  + minibatch_index
+            if self.lr_schedule is not None:
+                self.optimizer.set_learning_rate(self.lr_schedule(epoch))
+            if self.bucket_sampler is not None:
+                self.bucket_sampler.shuffle(
+                        minibatch_size, self.shared_training_data)
+                minibatch_order = \
+                        self.bucket_sampler.minibatch_order(n_train_batches)
+            else:
+                minibatch_order = range(n_train_batches)
+            batch_count = 0
+            while batch_count < n_train_batches:
+
+                first_iteration = (epoch - 1) * n_train_batches + batch_count
+                num_steps = self._num_steps(first_iteration, 
+                        n_train_batches - batch_count, 
+                        validation_frequency, patience)
+                minibatch_indices = \
+                        minibatch_order[batch_count:batch_count + num_steps]
                 start_time = timeit.default_timer()
-
-                if self.misc_function is not None:
-                    misc = self.misc_function(minibatch_index, minibatch_size)
-                    print misc
-
-                c = self.train_function(minibatch_index, minibatch_size)
-                if np.isnan(c):
-                    print 'NaN found at batch %s after seeing %s samples' % \
-                            (minibatch_index, iteration * minibatch_size)
-                    done_looping =True
-                    break
-                total_cost += c
+                costs = self._train_steps(minibatch_indices, minibatch_size)
                 end_time = timeit.default_timer()
                 iteration_time = end_time - start_time
-                if (iteration + 1) % validation_frequency == 0:
-                    num_samples_seen = iteration * minibatch_size
-                    average_cost = total_cost / num_samples_seen
-                    print 'TRAIN: iteration %s :' % iteration + \
-                            'takes %s seconds. ' % iteration_time + \
-                            'Average cost =%s' % average_cost
-
-                    dev_data = self.data_triplet.dev_data_and_label_list()
-                    dev_accuracy, c = self.eval_function_dev(*dev_data)
-                    print 'DEV: iteration %s : accuracy = %s ; cost =%s' % \
-                            (iteration, dev_accuracy, c)
-
-                    test_data = self.data_triplet.test_data_and_label_list()
-                    test_accuracy, c = self.eval_function_test(*test_data)
-                    print 'TEST: iteration %s : accuracy = %s ; cost =%s' % \
-                            (iteration, test_accuracy, c)
-
-                    if dev_accuracy > best_dev_acc:
-                        if dev_accuracy * improvement_threshold >\
-                                best_dev_acc:
-                            patience = max(patience, 
-                                    iteration * patience_increase)
-                        best_dev_acc = dev_accuracy
-                        best_dev_iteration = iteration
-                        best_test_acc = test_accuracy    
-                if patience <= iteration:
-                    done_looping = True
+
+                for step, c in enumerate(costs):
+                    iteration = first_iteration + step
+                    if np.isnan(c):
+                        print 'NaN found at batch %s ' % \
+                                minibatch_indices[step] + \
+                                'after seeing %s samples' % \
+                                (iteration * minibatch_size)
+                        done_looping =True
+                        break
+                    total_cost += c
+                    if (iteration + 1) % validation_frequency == 0:
+                        num_samples_seen = iteration * minibatch_size
+                        average_cost = total_cost / num_samples_seen
+                        print 'TRAIN: iteration %s :' % iteration + \
+                                'takes %s seconds. ' % iteration_time + \
+                                'Average cost =%s' % average_cost
+
+                        dev_data = self.data_triplet.dev_data_and_label_list()
+                        dev_accuracy, c = self.eval_function_dev(*dev_data)
+                        print 'DEV: iteration %s : accuracy = %s ; cost =%s' % \
+                                (iteration, dev_accuracy, c)
+
+                        test_data = \
+                                self.data_triplet.test_data_and_label_list()
+                        test_accuracy, c = self.eval_function_test(*test_data)
+                        print 'TEST: iteration %s : ' % iteration + \
+                                'accuracy = %s ; cost =%s' % (test_accuracy, c)
+
+                        if dev_accuracy > best_dev_acc:
+                            if dev_accuracy * improvement_threshold >\
+                                    best_dev_acc:
+                                patience = max(patience, 
+                                        iteration * patience_increase)
+                            best_dev_acc = dev_accuracy
+                            best_dev_iteration = iteration
+                            best_test_acc = test_accuracy    
+                    if patience <= iteration:
+                        done_looping = True
+                        break
+                if done_looping:
                     break
+                batch_count += num_steps
 
         return best_dev_iteration, float(best_dev_acc), float(best_test_acc)
 
-class AdagradTrainer(Trainer):
-
-    def __init__(self, model, cost_function, learning_rate, lr_smoother, 
-            data_triplet, make_givens_fn=None, misc_function=None):
+class GradientTrainer(Trainer):
+    """Minibatch training with the update rule of the optimizer
+
+    optimizer is one of nets.optimizers. Its hyperparameters are shared 
+    variables so the same trainer (and the same compiled functions) can be 
+    reused across reps with different learning rates. If lr_schedule is 
+    given, the learning rate is set to lr_schedule(epoch) at the start of 
+    each epoch (see optimizers.step_decay).
+    """
+
+    def __init__(self, model, cost_function, optimizer, data_triplet, 
+            make_givens_fn=None, misc_function=None, bucket_sampler=None,
+            lr_schedule=None, function_cache=DEFAULT_FUNCTION_CACHE,
+            steps_per_call=1):
+        """bucket_sampler is a LengthBucketSampler made on data_triplet.
+        make_givens_fn must then slice the time axis of the serrated matrices.
+
+        If function_cache is given (see nets.function_cache), the compiled
+        functions are looked up by the signature of the graph before
+        taking the gradient. Pass None to always compile.
+
+        If steps_per_call > 1, we also compile train_steps_function, which
+        scans over a vector of minibatch indices and returns their costs,
+        so the training loop calls it once for up to steps_per_call 
+        minibatches. The bucket sampler and misc_function need one call 
+        per minibatch.
+        """
+        if steps_per_call > 1 and \
+                (bucket_sampler is not None or misc_function is not None):
+            raise ValueError('steps_per_call > 1 does not work with '
+                    'bucket_sampler or misc_function')
         self.model = model
         self.cost_function = cost_function 
-        self.learning_rate = learning_rate
-        self.lr_smoother = lr_smoother
+        self.optimizer = optimizer
+        self.lr_schedule = lr_schedule
         self.data_triplet = data_triplet
-
-        print 'Taking gradient...'
-        self.gparams = T.grad(cost_function, self.model.params)
-
-        #self.gparams = [T.maximum(-5, T.minimum(5, x)) for x in self.gparams]
-        #        for x in self.model.params]
-        self.sum_gradient_squareds = [
-                theano.shared(value=np.zeros(param.get_value().shape).\
-                        astype(config.floatX), borrow=True) 
-                for param in self.model.params]
-
-        adagrad_rates = [learning_rate / (lr_smoother + T.sqrt(sgs)) 
-                for sgs in self.sum_gradient_squareds]
-
-        self.sgs_updates = [(sgs, sgs + T.square(gparam)) 
-            for sgs, gparam in zip(self.sum_gradient_squareds, self.gparams)]
-
-
-        self.param_updates = [(param, param - adagrad_rate * gparam) 
-                for param, gparam, adagrad_rate in 
-                zip(self.model.params, self.gparams, adagrad_rates)]
+        self.function_cache = function_cache
+        self.steps_per_call = steps_per_call
         self.train_function = None
+        self.train_steps_function = None
         self.dev_eval_function = None
         self.test_eval_function = None
 
@@ -214,10 +438,14 @@ class AdagradTrainer(Trainer):
         T_training_data_label = [theano.shared(x, borrow=True) 
                 for x in data_triplet.training_data_label]
         self.num_training_data = len(data_triplet.training_data_label[-1])
+        self.shared_training_data = T_training_data + T_training_data_label
 
         givens = {}
         start_idx = index * minibatch_size
         end_idx = (index + 1) * minibatch_size
+        self.bucket_sampler = bucket_sampler
+        if bucket_sampler is not None:
+            make_givens_fn = bucket_sampler.make_givens(make_givens_fn)
         if make_givens_fn is not None:
             make_givens_fn(givens, self.model.input, T_training_data, 
                     self.model.output, T_training_data_label, 
@@ -229,22 +457,57 @@ class AdagradTrainer(Trainer):
                 givens[output_var] = \
                         T_training_data_label[i][start_idx:end_idx]
 
+        #WARNING: compute accuracy on the last output variable only
+        accuracy = T.mean(T.eq(self.model.output[-1], self.model.predict[-1]))
+        sparse_params = self._group_sparse_params(
+                getattr(self.model, 'sparse_params', []))
+        states = optimizer.add_states(
+                self.model.params + [x[0] for x in sparse_params])
+
+        functions = None
+        if function_cache is not None:
+            key, shared_variables = self._signature(
+                    [index, minibatch_size], givens, accuracy, 
+                    misc_function, sparse_params, states)
+            functions = function_cache.get(key, shared_variables)
+        if functions is not None:
+            print 'Found the compiled functions in the cache...'
+            self.gparams = None
+            self.updates = None
+            self.train_function = functions['train']
+            self.train_steps_function = functions['train steps']
+            self.eval_function_dev = functions['eval']
+            self.eval_function_test = self.eval_function_dev
+            self.misc_function = functions['misc']
+            print function_cache.report()
+            return
+
+        start_time = timeit.default_timer()
+        print 'Taking gradient...'
+        self.gparams = T.grad(cost_function, self.model.params)
+
+        #self.gparams = [T.maximum(-5, T.minimum(5, x)) for x in self.gparams]
+        #        for x in self.model.params]
+        self.updates = optimizer.get_updates(self.model.params, self.gparams,
+                self._sparse_gradients(sparse_params), states)
+
         print 'Compiling training function...'
         self.train_function = theano.function(
                 inputs=[index, minibatch_size],
                 outputs=self.cost_function,
-                updates=self.sgs_updates + self.param_updates,
+                updates=self.updates,
                 givens=givens,
                 on_unused_input='warn')
+        if steps_per_call > 1:
+            self.train_steps_function = self._make_train_steps_function(
+                    index, minibatch_size, givens)
 
-        #WARNING: compute accuracy on the last output variable only
-        accuracy = T.mean(T.eq(self.model.output[-1], self.model.predict[-1]))
         self.eval_function_dev = \
                 theano.function(inputs=self.model.input + self.model.output, 
                         outputs=[accuracy, self.cost_function],
                         on_unused_input='warn')
         self.eval_function_test = self.eval_function_dev
-        print 'Adagrad finished compiling...'
+        print 'Finished compiling...'
 
         if misc_function is not None:
             self.misc_function = theano.function(
@@ -255,8 +518,141 @@ class AdagradTrainer(Trainer):
         else:
             self.misc_function = None
 
+        if function_cache is not None:
+            compile_time = timeit.default_timer() - start_time
+            function_cache.put(key, 
+                    {'train': self.train_function, 
+                        'train steps': self.train_steps_function,
+                        'eval': self.eval_function_dev,
+                        'misc': self.misc_function},
+                    shared_variables, compile_time)
+            print function_cache.report()
+
+    def _make_train_steps_function(self, index, minibatch_size, givens):
+        """Compile the updates of a vector of minibatches into one call
+
+        The cost and the updates are taken on the givens for the minibatch
+        index. Each step of the scan replaces the index with the next one
+        and returns the updates, so the shared variables are updated 
+        after every minibatch as in train_function.
+
+        Returns a function of (minibatch indices, minibatch size) 
+        that returns the costs of the minibatches
+        """
+        # the random states of the dropout masks are updated by default
+        # and their default updates do not see the givens
+        updates = list(self.updates)
+        for x in graph.inputs([self.cost_function] + [y[1] for y in updates]):
+            if getattr(x, 'default_update', None) is not None and \
+                    x not in [y[0] for y in updates]:
+                updates.append((x, x.default_update))
+        update_variables = [x[0] for x in updates]
+        given_outputs = theano.clone(
+                [self.cost_function] + [x[1] for x in updates], 
+                replace=givens)
+
+        def step(step_index, step_minibatch_size):
+            outputs = theano.clone(given_outputs, replace={
+                index: step_index, minibatch_size: step_minibatch_size})
+            return outputs[0], OrderedDict(zip(update_variables, outputs[1:]))
+
+        print 'Compiling multi-step training function...'
+        minibatch_indices = T.lvector()
+        costs, updates = theano.scan(step, sequences=minibatch_indices, 
+                non_sequences=minibatch_size)
+        return theano.function(
+                inputs=[minibatch_indices, minibatch_size],
+                outputs=costs,
+                updates=updates,
+                on_unused_input='warn')
+
+    def _signature(self, inputs, givens, accuracy, misc_function, 
+            sparse_params, states):
+        """Signature of the functions and their shared variables in order
+
+        The givens are taken in the order of the graph so that the 
+        signature does not depend on the order of the dictionary.
+        The shared variables of the optimizer are not in the graph
+        before taking the gradient so they are added at the end.
+        Neither is the update rule, so the key has the source_signature
+        of the optimizer and the trainer classes.
+        """
+        outputs = [self.cost_function, accuracy]
+        if misc_function is not None:
+            outputs.append(misc_function)
+        given_variables = [x for x in graph.inputs(outputs) if x in givens]
+        sparse_variables = [x[0] for x in sparse_params] + \
+                [y for x in sparse_params for pair in x[1] for y in pair]
+        key, shared_variables = graph_signature(
+                outputs + [givens[x] for x in given_variables],
+                variables=inputs + self.model.input + self.model.output +
+                    self.model.params + sparse_variables + given_variables,
+                extra=compilation_options() + [type(self.optimizer).__name__, 
+                    source_signature([type(self.optimizer), type(self)]),
+                    misc_function is not None, self.steps_per_call > 1])
+        shared_variables = shared_variables + \
+                self.optimizer.hyperparameters + \
+                self.optimizer.global_states + \
+                [y for x in states for y in x]
+        return key, shared_variables
+
+    def _group_sparse_params(self, sparse_params):
+        """Group the (param, row indices, looked-up rows) by param
+
+        The groups are in the order of the first occurrence of the param
+        so the graph is the same every time we build the model.
+
+        Returns a list of (param, list of (row indices, looked-up rows))
+        """
+        groups = []
+        for param, indices, rows in sparse_params:
+            for group_param, indices_rows in groups:
+                if group_param is param:
+                    indices_rows.append((indices, rows))
+                    break
+            else:
+                groups.append((param, [(indices, rows)]))
+        return groups
+
+    def _sparse_gradients(self, sparse_params):
+        """Gradients with respect to the rows looked up in the minibatch
+
+        sparse_params is a list of (param, list of (row indices, looked-up
+        rows)) (see _group_sparse_params, lstm.EmbeddingLayer and the 
+        sparse inputs of bilinear_layer.LinearLayer). The gradient is 
+        taken with respect to the looked-up rows, so we never make 
+        the full gradient matrix. If a row occurs more than once in 
+        a minibatch, its gradients are summed so the update is the same 
+        as the dense update.
+
+        Returns a list of (param, unique row indices, row gradients)
+        """
+        sparse_gradients = []
+        for param, indices_rows in sparse_params:
+            indices = T.concatenate([x[0] for x in indices_rows])
+            grows = T.concatenate(
+                    [T.grad(self.cost_function, x[1]) for x in indices_rows])
+            unique_indices, positions = unique_with_inverse(indices)
+            summed_grows = T.alloc(T.cast(0, grows.dtype), 
+                    unique_indices.shape[0], 
+                    *[grows.shape[i] for i in range(1, grows.ndim)])
+            summed_grows = T.inc_subtensor(summed_grows[positions], grows)
+            sparse_gradients.append((param, unique_indices, summed_grows))
+        return sparse_gradients
+
     def reset(self):
-        for sgs in self.sum_gradient_squareds:
-            value = np.zeros(sgs.get_value().shape, dtype=config.floatX)
-            sgs.set_value(value)
+        self.optimizer.reset()
+
+class AdagradTrainer(GradientTrainer):
+
+    def __init__(self, model, cost_function, learning_rate, lr_smoother, 
+            data_triplet, make_givens_fn=None, misc_function=None,
+            bucket_sampler=None, lr_schedule=None, 
+            function_cache=DEFAULT_FUNCTION_CACHE, steps_per_call=1):
+        self.learning_rate = learning_rate
+        self.lr_smoother = lr_smoother
+        GradientTrainer.__init__(self, model, cost_function, 
+                Adagrad(learning_rate, lr_smoother), data_triplet, 
+                make_givens_fn, misc_function, bucket_sampler, lr_schedule,
+                function_cache, steps_per_call)
 
@@ -66,6 +66,46 @@ class LSTM(object):
         self.b.set_value(b_values)
 
 
+class EmbeddingLayer(object):
+    """Look up the word embeddings inside the graph
+
+    The input is a T x N matrix of token indices into wbm.wm instead of
+    the T x N x d embedding series, so the training data is d times smaller.
+    X is the looked-up T x N x d series. Pass E of another EmbeddingLayer
+    to share the embedding matrix (e.g. between Arg1 and Arg2).
+
+    If trainable, only the rows in the minibatch are updated. The embedding
+    matrix is not in params but in sparse_params as 
+    (param, row indices, looked-up rows) so that the trainer takes
+    the gradient with respect to the looked-up rows only.
+    """
+
+    def __init__(self, rng, wbm, trainable=False, E=None):
+        self.rng = rng
+        if E is None:
+            all_rows = np.arange(wbm.wm.shape[0])
+            E = theano.shared(np.asarray(wbm.wm[all_rows], dtype=config.floatX),
+                    borrow=True)
+        self.E = E
+        self.initial_E = E.get_value().copy() if trainable else None
+        self.n_out = wbm.num_units
+
+        self.indices = T.lmatrix('token indices')
+        flat_indices = self.indices.flatten()
+        self.rows = self.E[flat_indices]
+        self.X = self.rows.reshape(
+                (self.indices.shape[0], self.indices.shape[1], self.E.shape[1]))
+        self.input = [self.indices]
+        self.params = []
+        if trainable:
+            self.sparse_params = [(self.E, flat_indices, self.rows)]
+        else:
+            self.sparse_params = []
+
+    def reset(self, rng):
+        if self.initial_E is not None:
+            self.E.set_value(self.initial_E.copy())
+
 class BinaryTreeLSTM(LSTM):
     """Tree LSTM 
 
@@ -77,24 +117,46 @@ class BinaryTreeLSTM(LSTM):
     graph in theano. It takes around 12s per discourse relation, which is 
     far too slow. 
 
+    If level_schedule, the children input is the H x W x N x 3 level 
+    schedule from tree_util.level_schedule instead of the T x N x 3 children 
+    matrix. Each scan step computes all of the nodes on one level of 
+    all trees in the minibatch, so the number of steps is the tree height 
+    instead of the number of internal nodes, and each step only writes 
+    the rows of those nodes.
     """
 
-    def __init__(self, rng, dim_proj, W=None, U=None, b=None):
+    def __init__(self, rng, dim_proj, W=None, U=None, b=None,
+            embedding_layer=None, level_schedule=False):
         self._init_params(rng, dim_proj, W, U, b, 5)
-        word_matrix = T.tensor3('Word matrix', dtype=config.floatX) 
+        self.level_schedule = level_schedule
+        self.embedding_layer = embedding_layer
+        if embedding_layer is None:
+            word_matrix = T.tensor3('Word matrix', dtype=config.floatX) 
+            word_input = [word_matrix]
+            self.sparse_params = []
+        else:
+            word_matrix = embedding_layer.X
+            word_input = embedding_layer.input
+            self.sparse_params = embedding_layer.sparse_params
 
         c_mask = T.matrix('Child mask', dtype=config.floatX)
         node_mask = T.matrix('Node mask', dtype=config.floatX)
-        children = T.tensor3('Children', dtype='int64')
+        if level_schedule:
+            children = T.tensor4('Level children', dtype='int64')
+        else:
+            children = T.tensor3('Children', dtype='int64')
         
         self.X = word_matrix
         self.mask = node_mask
         self.c_mask = c_mask
 
-        self.input = [word_matrix, children, c_mask, node_mask]
+        self.input = word_input + [children, c_mask, node_mask]
         n_samples = word_matrix.shape[1]
 
-        self.h, self.c_memory = self.project(word_matrix, children, c_mask)
+        if level_schedule:
+            self.h, self.c_memory = self.project_levels(word_matrix, children)
+        else:
+            self.h, self.c_memory = self.project(word_matrix, children, c_mask)
         all_samples = T.arange(n_samples)
 
         self.max_pooled_h = (self.h * node_mask[:, :, None]).max(axis=0) 
@@ -108,6 +170,8 @@ class BinaryTreeLSTM(LSTM):
 
     def reset(self, rng):
         self._reset(rng, 5)
+        if self.embedding_layer is not None:
+            self.embedding_layer.reset(rng)
 
     def project(self, word_embedding, children, c_mask):
         """
@@ -128,25 +192,14 @@ class BinaryTreeLSTM(LSTM):
             r_child_idx = c[:, 2]
 
             all_samples = T.arange(n_samples)
-            recursive = \
-                    T.dot(hidden[l_child_idx, all_samples, :], self.W) +\
-                    T.dot(hidden[r_child_idx, all_samples, :], self.U) +\
-                    self.b
-
-            i = T.nnet.sigmoid(_slice(recursive, 0, self.dim_proj))
-            f1 = T.nnet.sigmoid(_slice(recursive, 1, self.dim_proj))
-            f2 = T.nnet.sigmoid(_slice(recursive, 2, self.dim_proj))
-            o = T.nnet.sigmoid(_slice(recursive, 3, self.dim_proj))
-            c_prime = T.tanh(_slice(recursive, 4, self.dim_proj))
-
-            new_c = i * c_prime + \
-                    f1 * c_matrix[l_child_idx, all_samples,: ] +\
-                    f2 * c_matrix[r_child_idx, all_samples,: ]
+            new_h, new_c = self.compose(
+                    hidden[l_child_idx, all_samples, :],
+                    c_matrix[l_child_idx, all_samples, :],
+                    hidden[r_child_idx, all_samples, :],
+                    c_matrix[r_child_idx, all_samples, :])
 
             new_c_masked = c_m[:,None] * new_c + \
                     (1. - c_m[:, None]) * c_matrix[node_idx, all_samples, :]
-
-            new_h = o * T.tanh(new_c_masked)
             new_h_masked = c_m[:, None] * new_h + \
                     (1. - c_m[:, None]) * hidden[node_idx, all_samples, :]
 
@@ -161,26 +214,77 @@ class BinaryTreeLSTM(LSTM):
                 n_steps=nsteps)
         return rval[0][-1], rval[1][-1]
 
+    def compose(self, left_h, left_c, right_h, right_c):
+        """Compute h and c of the parent nodes (one per row) from the children
+        """
+        return compose_node(self, left_h, left_c, right_h, right_c)
+
+    def project_levels(self, word_embedding, level_children):
+        """
+
+        word_embedding - TxNxd serrated tensor prefilled with word embeddings 
+        level_children - HxWxNx3 level schedule (-1 for padding)
+
+        The hidden and memory tensors are flattened to (2T x N + 1) x d. 
+        The padding nodes read from and write to the extra last row.
+        """
+        num_nodes = word_embedding.shape[0]
+        n_samples = word_embedding.shape[1]
+        num_rows = num_nodes * n_samples
+        dummy_row = num_rows
+        all_samples = T.arange(n_samples)
+        # only scan the levels that have nodes in this minibatch
+        has_nodes = (level_children[:, :, :, 0] >= 0).max(axis=2).max(axis=1)
+        nsteps = T.maximum(has_nodes.sum(), 1)
+
+        def _flat_index(idx):
+            row = idx * n_samples + all_samples[None, :]
+            return T.switch(idx >= 0, row, dummy_row).flatten()
+
+        def _step(lc, hidden, c_matrix):
+            node_rows = _flat_index(lc[:, :, 0])
+            l_child_rows = _flat_index(lc[:, :, 1])
+            r_child_rows = _flat_index(lc[:, :, 2])
+
+            new_h, new_c = self.compose(
+                    hidden[l_child_rows], c_matrix[l_child_rows],
+                    hidden[r_child_rows], c_matrix[r_child_rows])
+            return T.set_subtensor(hidden[node_rows], new_h), \
+                T.set_subtensor(c_matrix[node_rows], new_c)
+
+        dim = word_embedding.shape[2]
+        hidden = T.concatenate([word_embedding.reshape((num_rows, dim)),
+            T.zeros((1, dim), dtype=word_embedding.dtype)])
+        rval, updates = theano.scan(_step, sequences=[level_children],
+                outputs_info=[hidden, T.zeros_like(hidden)],
+                n_steps=nsteps)
+        h = rval[0][-1][:num_rows].reshape((num_nodes, n_samples, dim))
+        c_memory = rval[1][-1][:num_rows].reshape((num_nodes, n_samples, dim))
+        return h, c_memory
+
     @staticmethod
     def make_givens(givens, input_vec, T_training_data, 
             output_vec, T_training_data_label, start_idx, end_idx):
         """
     embedding_series: 2T x N x d serrated matrix word embedding for the leaves
+            (or 2T x N token indices if the model has an EmbeddingLayer)
     children : T x N x 3 children serrated matrix 
+            (or H x W x N x 3 level schedule)
     c_mask : T x N masking matrix for children matrix
     node_mask : 2T x N masking matrix for the internal nodes 
             (for embedding_series) nice for computing mean h or sum h
         """
         
-        givens[input_vec[0]] = T_training_data[0][:,start_idx:end_idx, :]
-        givens[input_vec[1]] = T_training_data[1][:,start_idx:end_idx, :]
+        givens[input_vec[0]] = T_training_data[0][:,start_idx:end_idx]
+        givens[input_vec[1]] = \
+                _slice_children(T_training_data[1], start_idx, end_idx)
         givens[input_vec[2]] = T_training_data[2][:,start_idx:end_idx]
         givens[input_vec[3]] = T_training_data[3][:,start_idx:end_idx]
 
         givens[input_vec[0+4]] = \
-                T_training_data[0+4][:,start_idx:end_idx, :]
+                T_training_data[0+4][:,start_idx:end_idx]
         givens[input_vec[1+4]] = \
-                T_training_data[1+4][:,start_idx:end_idx, :]
+                _slice_children(T_training_data[1+4], start_idx, end_idx)
         givens[input_vec[2+4]] = T_training_data[2+4][:,start_idx:end_idx]
         givens[input_vec[3+4]] = T_training_data[3+4][:,start_idx:end_idx]
 
@@ -189,13 +293,20 @@ class BinaryTreeLSTM(LSTM):
             givens[output_vec[0]] = \
                     T_training_data_label[0][start_idx:end_idx]
         else:
+            # 2T x N x k node label tensors or 2T x N node label indices
             givens[output_vec[0]] = \
-                    T_training_data_label[0][:, start_idx:end_idx, :]
+                    T_training_data_label[0][:, start_idx:end_idx]
             givens[output_vec[1]] = \
-                    T_training_data_label[1][:, start_idx:end_idx, :]
+                    T_training_data_label[1][:, start_idx:end_idx]
             givens[output_vec[2]] = \
                     T_training_data_label[2][start_idx:end_idx]
 
+def _slice_children(children, start_idx, end_idx):
+    """Slice the samples of the children matrix or the level schedule"""
+    if children.ndim == 4:
+        return children[:, :, start_idx:end_idx]
+    return children[:, start_idx:end_idx]
+
 def build_stacked_lstm(num_layers, num_units, pooling, dropout_p):
     lstm_layers = []
     top_layer = None
@@ -213,30 +324,42 @@ def build_stacked_lstm(num_layers, num_units, pooling, dropout_p):
 class SerialLSTM(LSTM):
 
     def __init__(self, rng, dim_proj, pooling, parent_layer=None,
-            W=None, U=None, b=None, dropout_p=1.0):
+            W=None, U=None, b=None, dropout_p=1.0, embedding_layer=None):
         self._init_params(rng, dim_proj, W, U, b, 4)
         self.dropout_p = dropout_p
+        # shared so that it can be changed without compiling again
+        self.T_dropout_p = theano.shared(
+                np.asarray(dropout_p, dtype=config.floatX))
         self.n_out = dim_proj
         self.srng = RandomStreams()
+        self.embedding_layer = embedding_layer
+        self.sparse_params = []
 
         if parent_layer is None:
-            self.X = T.tensor3('x', dtype=config.floatX) 
+            if embedding_layer is None:
+                self.X = T.tensor3('x', dtype=config.floatX) 
+                self.word_input = [self.X]
+            else:
+                self.X = embedding_layer.X
+                self.word_input = embedding_layer.input
+                self.sparse_params = embedding_layer.sparse_params
             self.mask = T.matrix('mask', dtype=config.floatX)
             self.c_mask = None
             self.h_train = self.project(
-                    self.X, self.mask, self.dropout_p, True)
+                    self.X, self.mask, self.T_dropout_p, True)
             self.h_test = self.project(
-                    self.X, self.mask, self.dropout_p, False)
+                    self.X, self.mask, self.T_dropout_p, False)
         else:
             self.X = parent_layer.X
+            self.word_input = parent_layer.word_input
             self.mask = parent_layer.mask
             self.c_mask = None
             self.h_train = self.project(
-                    parent_layer.h_train, self.mask, self.dropout_p, True)
+                    parent_layer.h_train, self.mask, self.T_dropout_p, True)
             self.h_test = self.project(
-                    parent_layer.h_test, self.mask, self.dropout_p, False)
+                    parent_layer.h_test, self.mask, self.T_dropout_p, False)
 
-        self.input = [self.X, self.mask]
+        self.input = self.word_input + [self.mask]
         n_samples = self.X.shape[1]
         if pooling == 'max_pool':
             self.activation_train = \
@@ -268,6 +391,8 @@ class SerialLSTM(LSTM):
 
     def reset(self, rng):
         self._reset(rng, 4)
+        if self.embedding_layer is not None:
+            self.embedding_layer.reset(rng)
 
     def project(self, embedding_series, mask, dropout_p, training):
         nsteps = embedding_series.shape[0]
@@ -316,12 +441,12 @@ class SerialLSTM(LSTM):
     @staticmethod
     def make_givens(givens, input_vec, T_training_data, 
             output_vec, T_training_data_label, start_idx, end_idx):
-        # first arg embedding and mask
-        givens[input_vec[0]] = T_training_data[0][:,start_idx:end_idx, :]
+        # first arg embedding (or token indices) and mask
+        givens[input_vec[0]] = T_training_data[0][:,start_idx:end_idx]
         givens[input_vec[1]] = T_training_data[1][:,start_idx:end_idx]
 
-        # second arg embedding and mask
-        givens[input_vec[2]] = T_training_data[2][:,start_idx:end_idx, :]
+        # second arg embedding (or token indices) and mask
+        givens[input_vec[2]] = T_training_data[2][:,start_idx:end_idx]
         givens[input_vec[3]] = T_training_data[3][:,start_idx:end_idx]
 
         # the rest if there is more e.g. input for MOE
@@ -334,10 +459,36 @@ class SerialLSTM(LSTM):
 def _slice(_x, n, dim):
     if _x.ndim == 3:
         return _x[:, :, n * dim:(n + 1) * dim]
+    if _x.ndim == 1:
+        return _x[n * dim:(n + 1) * dim]
     return _x[:, n * dim:(n + 1) * dim]
 
+def compose_node(model, left_h, left_c, right_h, right_c):
+    """The gates of a tree LSTM node given its children
+
+    Works on a single node (vectors) or on a batch of nodes (one per row).
+    model has W, U, b, and dim_proj.
+    """
+    preact = T.dot(left_h, model.W) + T.dot(right_h, model.U) + model.b
+
+    i = T.nnet.sigmoid(_slice(preact, 0, model.dim_proj))
+    f1 = T.nnet.sigmoid(_slice(preact, 1, model.dim_proj))
+    f2 = T.nnet.sigmoid(_slice(preact, 2, model.dim_proj))
+    o = T.nnet.sigmoid(_slice(preact, 3, model.dim_proj))
+    c_prime = T.tanh(_slice(preact, 4, model.dim_proj))
+
+    c = i * c_prime + f1 * left_c + f2 * right_c
+    h = o * T.tanh(c)
+    return h, c
+
+
+def prep_srm_arg(relation_list, arg_pos, wbm, max_length, ignore_OOV=True,
+        index_only=False):
+    """Make the T x N x d embedding series and the T x N mask
 
-def prep_srm_arg(relation_list, arg_pos, wbm, max_length, ignore_OOV=True):
+    If index_only, the T x N token index matrix is returned instead of 
+    the embedding series. Use it with EmbeddingLayer.
+    """
     assert arg_pos == 1 or arg_pos == 2
     n_samples = len(relation_list)
     x = np.zeros((max_length, n_samples)).astype('int64')
@@ -347,6 +498,8 @@ def prep_srm_arg(relation_list, arg_pos, wbm, max_length, ignore_OOV=True):
         sequence_length = min(max_length, len(indices))
         x[:sequence_length, i] = indices[:sequence_length]
         x_mask[:sequence_length, i] = 1.
+    if index_only:
+        return x, x_mask
     embedding_series = \
         wbm.wm[x.flatten()].\
             reshape([max_length, n_samples, wbm.num_units]).\
@@ -355,7 +508,9 @@ def prep_srm_arg(relation_list, arg_pos, wbm, max_length, ignore_OOV=True):
 
 
 def prep_tree_srm_arg(relation_list, arg_pos, wbm, max_length, 
-        all_left_branching=False, node_label_alphabet={}):
+        all_left_branching=False, node_label_alphabet={}, index_only=False,
+        cache_dir=tree_util.TOPOLOGY_CACHE_DIR, level_schedule=False,
+        sparse_node_labels=False):
     """Make the matrices from the data required for the tree model
     
     T = number of time steps
@@ -369,53 +524,51 @@ def prep_tree_srm_arg(relation_list, arg_pos, wbm, max_length,
     node_mask : 2T x N masking matrix for the internal nodes 
             (for embedding_series) nice for computing mean h or sum h
     node_label_tensor : 2T x N x k. This masks embedding_series matrix
+
+    If index_only, the 2T x N token index matrix is returned instead of
+    embedding_series. Use it with EmbeddingLayer.
+
+    The tree topology of the split is compiled once and cached in cache_dir
+    (see tree_util.tree_topology). If cache_dir is None, we always compile.
+
+    If level_schedule, children is the H x W x N x 3 level schedule 
+    (see tree_util.level_schedule) for BinaryTreeLSTM(level_schedule=True).
+
+    If sparse_node_labels, node_label_tensor is replaced by the 2T x N 
+    node label indices (-1 for the nodes without labels). Use it with
+    LinearLayerTensorOutput(sparse_targets=True).
     """
-    assert arg_pos == 1 or arg_pos == 2
+    if cache_dir is None:
+        topology = tree_util.compile_tree_topology(relation_list, arg_pos, 
+                max_length, all_left_branching)
+    else:
+        topology = tree_util.tree_topology(relation_list, arg_pos, 
+                max_length, all_left_branching, cache_dir)
+    w_indices = topology.word_indices(wbm)
+    if sparse_node_labels:
+        node_label_tensor = topology.node_label_matrix(node_label_alphabet)
+    else:
+        node_label_tensor = topology.node_label_tensor(node_label_alphabet)
+    children = topology.children
+    c_mask = topology.c_mask
+    if level_schedule:
+        children = tree_util.level_schedule(children, c_mask)
+    node_mask = topology.node_mask
+    if index_only:
+        return w_indices, children, c_mask, node_mask, node_label_tensor
     n_samples = len(relation_list)
-    w_indices = np.zeros((2 * max_length, n_samples)).astype('int64')
-    c_mask = np.zeros((max_length, n_samples), dtype=config.floatX)
-    node_mask = np.zeros((2 * max_length, n_samples), dtype=config.floatX)
-    children = np.zeros((n_samples, max_length, 3), dtype='int64')
-    node_label_tensor = np.zeros((2 * max_length, n_samples, len(node_label_alphabet)), dtype=config.floatX)
-    for i, relation in enumerate(relation_list):
-        if all_left_branching:
-            parse_tree = tree_util.left_branching_tree(relation, arg_pos)
-        else:
-            parse_tree = tree_util.find_parse_tree(relation, arg_pos)
-            if len(parse_tree.leaves()) == 0:
-                parse_tree = tree_util.left_branching_tree(relation, arg_pos)
-        indices = wbm.index_tokens(parse_tree.leaves(), ignore_OOV=False)
-
-        sequence_length = min(max_length, len(indices))
-        w_indices[:sequence_length, i] = indices[:sequence_length]
-
-        ordering_matrix, node_label_list, num_leaves = \
-                tree_util.reverse_toposort(parse_tree)
-        num_nodes = min(2 * max_length, ordering_matrix.shape[0])
-        if num_nodes > num_leaves:
-            num_inner_nodes = num_nodes - num_leaves
-            children[i, :num_inner_nodes, :] = ordering_matrix[num_leaves:num_nodes, :]
-            c_mask[:num_inner_nodes, i] = 1.
-            node_mask[num_leaves:num_nodes, i] = 1. 
-            if len(node_label_alphabet) > 0:
-                for t, node_label in enumerate(node_label_list):
-                    if node_label is not None and t < (2 * max_length):
-                        if node_label in node_label_alphabet:
-                            label_index = node_label_alphabet[node_label]
-                        else:
-                            label_index = node_label_alphabet['OTHERS']
-                        node_label_tensor[t, i, label_index] = 1.
-
-    children = np.swapaxes(children, 0, 1)
     embedding_series = \
         wbm.wm[w_indices.flatten()].\
             reshape([max_length * 2, n_samples, wbm.num_units]).\
             astype(config.floatX)
     return embedding_series, children, c_mask, node_mask, node_label_tensor
 
-def prep_serrated_matrix_relations(relation_list, wbm, max_length):
-    arg1_srm, arg1_mask = prep_srm_arg(relation_list, 1, wbm, max_length)
-    arg2_srm, arg2_mask = prep_srm_arg(relation_list, 2, wbm, max_length)
+def prep_serrated_matrix_relations(relation_list, wbm, max_length,
+        index_only=False):
+    arg1_srm, arg1_mask = prep_srm_arg(relation_list, 1, wbm, max_length,
+            index_only=index_only)
+    arg2_srm, arg2_mask = prep_srm_arg(relation_list, 2, wbm, max_length,
+            index_only=index_only)
     return (arg1_srm, arg1_mask, arg2_srm, arg2_mask)
 
 def _check_masks(word_mask, c_mask):
@@ -427,19 +580,27 @@ def _check_masks(word_mask, c_mask):
     check_sum = word_mask + c_mask
     assert(np.all(0 <= check_sum) and np.all(check_sum <= 1))
 
-def prep_tree_lstm_serrated_matrix_relations(relation_list, wbm, max_length):
+def prep_tree_lstm_serrated_matrix_relations(relation_list, wbm, max_length,
+        index_only=False, all_left_branching=False, level_schedule=False):
     arg1_srm, arg1_children, arg1_c_mask, arg1_node_mask, _ = \
-            prep_tree_srm_arg(relation_list, 1, wbm, max_length)
+            prep_tree_srm_arg(relation_list, 1, wbm, max_length,
+                    all_left_branching, index_only=index_only, 
+                    level_schedule=level_schedule)
     arg2_srm, arg2_children, arg2_c_mask, arg2_node_mask, _ = \
-            prep_tree_srm_arg(relation_list, 2, wbm, max_length)
+            prep_tree_srm_arg(relation_list, 2, wbm, max_length,
+                    all_left_branching, index_only=index_only, 
+                    level_schedule=level_schedule)
     return (arg1_srm, arg1_children, arg1_c_mask, arg1_node_mask, \
             arg2_srm, arg2_children, arg2_c_mask, arg2_node_mask)
 
-def prep_stlstm_serrated_matrix_relations(relation_list, wbm, max_length, label_alphabet):
+def prep_stlstm_serrated_matrix_relations(relation_list, wbm, max_length, label_alphabet,
+        index_only=False, sparse_node_labels=False):
     arg1_srm, arg1_children, arg1_c_mask, arg1_node_mask, arg1_node_label = \
-            prep_tree_srm_arg(relation_list, 1, wbm, max_length, False, label_alphabet)
+            prep_tree_srm_arg(relation_list, 1, wbm, max_length, False, label_alphabet,
+                    index_only, sparse_node_labels=sparse_node_labels)
     arg2_srm, arg2_children, arg2_c_mask, arg2_node_mask, arg2_node_label = \
-            prep_tree_srm_arg(relation_list, 2, wbm, max_length, False, label_alphabet)
+            prep_tree_srm_arg(relation_list, 2, wbm, max_length, False, label_alphabet,
+                    index_only, sparse_node_labels=sparse_node_labels)
     return (
             [arg1_srm, arg1_children, arg1_c_mask, arg1_node_mask, 
             arg2_srm, arg2_children, arg2_c_mask, arg2_node_mask], 
@@ -6,13 +6,14 @@ import numpy as np
 import theano.tensor as T
 
 import cognitive_disco.base_label_functions as l
-from cognitive_disco.nets.learning import AdagradTrainer, DataTriplet
+from cognitive_disco.nets.learning import AdagradTrainer, DataTriplet, \
+        LengthBucketSampler
 from cognitive_disco.data_reader import extract_implicit_relations
 from cognitive_disco.nets.bilinear_layer import \
         BilinearLayer, LinearLayer, NeuralNet, MaskedInputLayer, \
         make_multilayer_net_from_layers 
 from cognitive_disco.nets.lstm import \
-        SerialLSTM, prep_serrated_matrix_relations, \
+        SerialLSTM, prep_serrated_matrix_relations, EmbeddingLayer, \
         BinaryTreeLSTM, prep_tree_lstm_serrated_matrix_relations
 import cognitive_disco.nets.util as util
 
@@ -25,8 +26,12 @@ def net_experiment_lstm(dir_list, args):
         num hidden layers is the number of hidden layers
         proj_type must be one of {mean_pool, sum_pool, max_pool, top}
         shared 
+    Optional arguments
+        index : feed token indices and look up the embeddings in the graph
+        tune : same as index but the embeddings are also trained
+        bucket : length-bucketed minibatches trimmed to the longest sample
     """
-    assert(len(args) == 5)
+    assert(len(args) >= 5)
 
     if args[0] == 'bl':
         use_bl = True
@@ -43,24 +48,32 @@ def net_experiment_lstm(dir_list, args):
         arg_shared_weights = False
     else:
         raise ValueError('Last argument must be shared or noshared')
+    use_indices = 'index' in args[5:] or 'tune' in args[5:]
+    tune_embedding = 'tune' in args[5:]
+    use_buckets = 'bucket' in args[5:]
 
     experiment_name = sys._getframe().f_code.co_name    
     json_file = util.set_logger('%s_%s_%sunits_%sh_%s_%s' % \
             (experiment_name, args[0], num_units, 
-                num_hidden_layers, proj_type, args[4]))
+                num_hidden_layers, proj_type, '_'.join(args[4:])))
     sense_lf = l.SecondLevelLabel()
     relation_list_list = [extract_implicit_relations(dir, sense_lf) 
             for dir in dir_list]
 
-    wbm = util.get_wbm(num_units)
+    wbm = util.get_wbm(num_units, dir_list)
     data_list = []
     for relation_list in relation_list_list:
-        data = prep_serrated_matrix_relations(relation_list, wbm, 30)
+        data = prep_serrated_matrix_relations(relation_list, wbm, 30,
+                index_only=use_indices)
         data_list.append(data)
     label_vectors, label_alphabet = \
             util.label_vectorize(relation_list_list, sense_lf)
     data_triplet = DataTriplet(
             data_list, [[x] for x in label_vectors], [label_alphabet])
+    if use_buckets:
+        bucket_sampler = LengthBucketSampler(data_triplet)
+    else:
+        bucket_sampler = None
 
     num_reps = 10
     num_hidden_unit_list = [0] if num_hidden_layers == 0 \
@@ -74,7 +87,10 @@ def net_experiment_lstm(dir_list, args):
                 use_hinge=False, 
                 proj_type=proj_type,
                 use_bl=use_bl,
-                arg_shared_weights=arg_shared_weights
+                arg_shared_weights=arg_shared_weights,
+                wbm=wbm if use_indices else None,
+                tune_embedding=tune_embedding,
+                bucket_sampler=bucket_sampler
                 )
 
 def net_experiment_tree_lstm(dir_list, args):
@@ -85,6 +101,11 @@ def net_experiment_tree_lstm(dir_list, args):
         num hidden layers is the number of hidden layers
         proj_type must be one of {mean_pool, sum_pool, max_pool, top}
         shared 
+    Optional arguments
+        left : use left-branching trees instead of the parse trees
+        index : feed token indices and look up the embeddings in the graph
+        tune : same as index but the embeddings are also trained
+        level : compute the nodes level by level (one scan step per level)
     """
     assert(len(args) >= 5)
 
@@ -105,29 +126,29 @@ def net_experiment_tree_lstm(dir_list, args):
     else:
         raise ValueError('Last argument must be shared or noshared')
 
-    if len(args) == 6 and args[5] == 'left':
+    if 'left' in args[5:]:
         all_left_branching = True
     else:
         all_left_branching = False
+    use_indices = 'index' in args[5:] or 'tune' in args[5:]
+    tune_embedding = 'tune' in args[5:]
+    level_schedule = 'level' in args[5:]
 
     experiment_name = sys._getframe().f_code.co_name    
-    if all_left_branching:
-        json_file = util.set_logger('%s_%s_%sunits_%sh_%s_%s_left' % \
-                (experiment_name, args[0], num_units, 
-                    num_hidden_layers, proj_type, args[4]))
-    else:
-        json_file = util.set_logger('%s_%s_%sunits_%sh_%s_%s' % \
-                (experiment_name, args[0], num_units, 
-                    num_hidden_layers, proj_type, args[4]))
+    json_file = util.set_logger('%s_%s_%sunits_%sh_%s_%s' % \
+            (experiment_name, args[0], num_units,
+                num_hidden_layers, proj_type, '_'.join(args[4:])))
     sense_lf = l.SecondLevelLabel()
     relation_list_list = [extract_implicit_relations(dir, sense_lf) 
             for dir in dir_list]
 
-    wbm = util.get_wbm(num_units)
+    wbm = util.get_wbm(num_units, dir_list)
     data_list = []
     for relation_list in relation_list_list:
         data = prep_tree_lstm_serrated_matrix_relations(
-                relation_list, wbm, 35)
+                relation_list, wbm, 35, index_only=use_indices,
+                all_left_branching=all_left_branching,
+                level_schedule=level_schedule)
         data_list.append(data)
 
     label_vectors, label_alphabet = \
@@ -147,21 +168,40 @@ def net_experiment_tree_lstm(dir_list, args):
                 use_hinge=False, 
                 proj_type=proj_type,
                 use_bl=use_bl,
-                arg_shared_weights=arg_shared_weights
+                arg_shared_weights=arg_shared_weights,
+                wbm=wbm if use_indices else None,
+                tune_embedding=tune_embedding,
+                model_options={'level_schedule': level_schedule}
                 )
 
 def _net_experiment_lstm_helper(experiment_name,
         json_file, data_triplet, num_units, num_reps, 
         LSTMModel, num_hidden_layers, num_hidden_units, use_hinge, proj_type, 
-        use_bl, arg_shared_weights):
+        use_bl, arg_shared_weights, wbm=None, tune_embedding=False,
+        bucket_sampler=None, model_options={}):
+    """If wbm is given, the data are token indices and the embeddings
+    are looked up in the graph (shared between the args).
+    If bucket_sampler is given, the minibatches are length-bucketed.
+    model_options are passed on to LSTMModel.
+    """
 
     rng = np.random.RandomState(100)
-    arg1_model = LSTMModel(rng, num_units)
+    if wbm is not None:
+        arg1_embedding = EmbeddingLayer(rng, wbm, tune_embedding)
+        arg2_embedding = EmbeddingLayer(rng, wbm, tune_embedding, 
+                E=arg1_embedding.E)
+    else:
+        arg1_embedding = None
+        arg2_embedding = None
+    arg1_model = LSTMModel(rng, num_units, embedding_layer=arg1_embedding,
+            **model_options)
     if arg_shared_weights:
         arg2_model = LSTMModel(rng, num_units, 
-                W=arg1_model.W, U=arg1_model.U, b=arg1_model.b)
+                W=arg1_model.W, U=arg1_model.U, b=arg1_model.b,
+                embedding_layer=arg2_embedding, **model_options)
     else:
-        arg2_model = LSTMModel(rng, num_units)
+        arg2_model = LSTMModel(rng, num_units, embedding_layer=arg2_embedding,
+                **model_options)
 
 
     arg1_pooled = MaskedInputLayer(rng, num_units, proj_type,
@@ -190,7 +230,8 @@ def _net_experiment_lstm_helper(experiment_name,
     trainer = AdagradTrainer(nn,
             nn.hinge_loss if use_hinge else nn.crossentropy,
             learning_rate, lr_smoother, 
-            data_triplet, LSTMModel.make_givens)
+            data_triplet, LSTMModel.make_givens, 
+            bucket_sampler=bucket_sampler)
     
     for rep in xrange(num_reps):
         random_seed = rep
@@ -200,6 +241,8 @@ def _net_experiment_lstm_helper(experiment_name,
         
         minibatch_size = np.random.randint(20, 60)
         n_epochs = 50
+        if bucket_sampler is not None:
+            print bucket_sampler.padding_report(minibatch_size)
 
         start_time = timeit.default_timer()
         best_iter, best_dev_acc, best_test_acc = \
@@ -222,7 +265,11 @@ def _net_experiment_lstm_helper(experiment_name,
                 'num hidden layers': num_hidden_layers,
                 'cost function': 'hinge loss' if use_hinge else 'crossentropy',
                 'projection' : proj_type,
-                'dropout' : False
+                'dropout' : False,
+                'embedding lookup' : wbm is not None,
+                'tune embedding' : tune_embedding,
+                'length buckets' : bucket_sampler is not None,
+                'level schedule' : model_options.get('level_schedule', False)
                 }
         json_file.write('%s\n' % json.dumps(result_dict, sort_keys=True))
 
@@ -14,19 +14,20 @@ import cognitive_disco.nets.util as util
 from cognitive_disco.data_reader import extract_implicit_relations
 from cognitive_disco.nets.learning import AdagradTrainer, DataTriplet
 from cognitive_disco.nets.bilinear_layer import \
-        NeuralNet, MixtureOfExperts, make_multilayer_net
+        NeuralNet, MixtureOfExperts, InputLayer, EmbeddingBagLayer, \
+        make_multilayer_net_from_layers
 
 from theano import config
 import theano.sparse
 import theano.tensor as T
 import numpy as np
-from scipy.sparse import coo_matrix
 
 def net_mixture_experiment1(dir_list, args):
     """Experiment 1 MOE 
 
     Read the sparse feature matrices from the files
     Use Mixture of Experts model
+    Optional arguments: bag size [rank] (see util.parse_bag_options)
     """
     sparse_feature_file = args[0]
     embedding_size = int(args[1])
@@ -34,31 +35,33 @@ def net_mixture_experiment1(dir_list, args):
     sparse_num_hidden_layers = int(args[3])
     mixture_num_hidden_layers = int(args[4])
     proj_type = args[5]
+    bag_options = util.parse_bag_options(args[6:])
 
     experiment_name = sys._getframe().f_code.co_name    
-    json_file = util.set_logger('%s_%sunits_%sh_%sh_%sh_%s' % \
+    json_file = util.set_logger('%s_%sunits_%sh_%sh_%sh_%s%s' % \
             (experiment_name,  embedding_size, 
                 cont_num_hidden_layers,
                 sparse_num_hidden_layers, 
                 mixture_num_hidden_layers,
-                proj_type))
+                proj_type, ''.join('_' + x for x in args[6:])))
 
     data_triplet = _load_continuous_sparse_features(dir_list, embedding_size, 
-            sparse_feature_file, proj_type)
+            sparse_feature_file, proj_type, 'bag_size' in bag_options)
     num_hidden_unit_list = [50, 200, 300, 400, 500]
     num_reps = 20
     for num_hidden_unit in num_hidden_unit_list:
         _net_mixture_experiment_helper(experiment_name, 
                 json_file, data_triplet, num_reps, 
                 sparse_num_hidden_layers, cont_num_hidden_layers,
-                True, mixture_num_hidden_layers, num_hidden_unit, proj_type)
+                True, mixture_num_hidden_layers, num_hidden_unit, proj_type,
+                **bag_options)
 
 def net_mixture_experiment2(dir_list, args):
     """Experiment 2 Linearly combining features
 
     No gating network. We simply concatenate the hidden layer of 
     the continuous features with the sparse feature vector.
-
+    Optional arguments: bag size [rank] (see util.parse_bag_options)
     """
     sparse_feature_file = args[0]
     embedding_size = int(args[1])
@@ -66,53 +69,67 @@ def net_mixture_experiment2(dir_list, args):
     sparse_num_hidden_layers = int(args[3])
     mixture_num_hidden_layers = int(args[4])
     proj_type = args[5]
+    bag_options = util.parse_bag_options(args[6:])
 
     experiment_name = sys._getframe().f_code.co_name    
-    json_file = util.set_logger('%s_%sunits_%sh_%sh_%sh_%s' % \
+    json_file = util.set_logger('%s_%sunits_%sh_%sh_%sh_%s%s' % \
             (experiment_name,  embedding_size, 
                 cont_num_hidden_layers,
                 sparse_num_hidden_layers, 
                 mixture_num_hidden_layers,
-                proj_type))
+                proj_type, ''.join('_' + x for x in args[6:])))
 
     data_triplet = _load_continuous_sparse_features(dir_list, embedding_size, 
-            sparse_feature_file, proj_type)
+            sparse_feature_file, proj_type, 'bag_size' in bag_options)
     num_hidden_unit_list = [50, 200, 400, 500]
     num_reps = 12
     for num_hidden_unit in num_hidden_unit_list:
         _net_mixture_experiment_helper(experiment_name, 
                 json_file, data_triplet, num_reps, 
                 sparse_num_hidden_layers, cont_num_hidden_layers,
-                False, mixture_num_hidden_layers, num_hidden_unit, proj_type)
+                False, mixture_num_hidden_layers, num_hidden_unit, proj_type,
+                **bag_options)
 
 def _load_continuous_sparse_features(dir_list, embedding_size,
-        sparse_feature_file, proj_type):
+        sparse_feature_file, proj_type, padded_indices=False):
+    """The first input variable is the CSR sparse feature matrix
+    or the padded feature indices and values if padded_indices.
+    """
     sense_lf = l.SecondLevelLabel()
     relation_list_list = [extract_implicit_relations(dir, sense_lf) 
             for dir in dir_list]
 
-    num_features = 250000
     id_to_sfv = read_sparse_vectors(dir_list, sparse_feature_file)
+    num_features = max(max(x) for x in id_to_sfv.values() if len(x) > 0) + 1
     sfv_data_list = [get_sfv(relation_list, id_to_sfv, num_features) 
             for relation_list in relation_list_list]
+    if padded_indices:
+        sfv_data_list = [list(util.csr_to_padded_indices(x)) 
+                for x in sfv_data_list]
+    else:
+        sfv_data_list = [[x] for x in sfv_data_list]
 
-    word2vec_ff = util._get_word2vec_ff(embedding_size, proj_type)
+    word2vec_ff = util._get_word2vec_ff(embedding_size, proj_type, dir_list)
     word2vec_data_list = [word2vec_ff(relation_list) 
             for relation_list in relation_list_list]
 
-    data_list = [[x] + y for x, y in zip(sfv_data_list, word2vec_data_list)]
+    data_list = [x + y for x, y in zip(sfv_data_list, word2vec_data_list)]
 
     label_vector_triplet, label_alphabet = \
             util.label_vectorize(relation_list_list, sense_lf)
     data_triplet = DataTriplet(
             data_list, [[x] for x in label_vector_triplet], [label_alphabet])
+    data_triplet.num_sparse_features = num_features
     return data_triplet
 
 def _net_mixture_experiment_helper(experiment_name, 
         json_file, data_triplet, num_reps, sparse_num_hidden_layers, 
         cont_num_hidden_layers, 
         use_moe, mixture_num_hidden_layers,
-        num_hidden_units, proj_type):
+        num_hidden_units, proj_type, bag_size=None, bag_rank=None):
+    """If bag_size is given, the sparse features are padded index lists
+    going into an EmbeddingBagLayer instead of a CSR matrix.
+    """
     rng = np.random.RandomState(100)
     learning_rate = 0.001
     lr_smoother = 0.01
@@ -125,40 +142,48 @@ def _net_mixture_experiment_helper(experiment_name,
         n_out = num_hidden_units
 
     # the first one must be sparse
-    X_list = [theano.sparse.csr_matrix(), T.matrix(), T.matrix()]
-    sf_net, sf_layers = make_multilayer_net(rng, 
-            n_in_list=data_triplet.input_dimensions()[0:1],
-            X_list=X_list[0:1], Y=T.lvector(), use_sparse=True,
+    if bag_size is None:
+        sf_input_layer = InputLayer(rng, 
+                data_triplet.num_sparse_features, True)
+    else:
+        sf_input_layer = EmbeddingBagLayer(rng, 
+                data_triplet.num_sparse_features, bag_size, 
+                use_values=True, rank=bag_rank)
+    word2vec_input_layers = [InputLayer(rng, n_in, False) 
+            for n_in in data_triplet.input_dimensions()[-2:]]
+    _, sf_layers = make_multilayer_net_from_layers([sf_input_layer], 
+            Y=None, use_sparse=bag_size is None,
             num_hidden_layers=sparse_num_hidden_layers, 
             num_hidden_units=num_hidden_units, 
             num_output_units=n_out,
             output_activation_fn=output_activation_fn)
-    word2vec_net, word2vec_layers = make_multilayer_net(rng, 
-            n_in_list=data_triplet.input_dimensions()[1:],
-            X_list=X_list[1:], Y=T.lvector(), use_sparse=False,
+    _, word2vec_layers = make_multilayer_net_from_layers(
+            word2vec_input_layers, Y=None, use_sparse=False,
             num_hidden_layers=cont_num_hidden_layers, 
             num_hidden_units=num_hidden_units, 
             num_output_units=n_out,
             output_activation_fn=output_activation_fn)
 
+    input_layers = [sf_input_layer] + word2vec_input_layers
     if use_moe:
-        complete_net = MixtureOfExperts(rng,
-                n_in_list=data_triplet.input_dimensions(),
-                expert_list=[sf_net, word2vec_net],
-                X_list=X_list, Y=T.lvector(),
+        mixture_layers = [MixtureOfExperts(rng, input_layers,
+                expert_list=[sf_layers[-1], word2vec_layers[-1]],
+                Y=T.lvector(),
                 num_hidden_layers=mixture_num_hidden_layers, 
-                num_hidden_units=num_hidden_units)
+                num_hidden_units=num_hidden_units)]
     else:
-        mixture_net, mixture_layers = make_multilayer_net(rng,
-                n_in_list=[sf_layers[-1].n_out, word2vec_layers[-1].n_out],
-                X_list=[sf_layers[-1].activation, word2vec_layers[-1].activation],
+        _, mixture_layers = make_multilayer_net_from_layers(
+                [sf_layers[-1], word2vec_layers[-1]],
                 Y=T.lvector(),
                 use_sparse=False,
                 num_hidden_layers=mixture_num_hidden_layers,
                 num_hidden_units=num_hidden_units,
                 num_output_units=data_triplet.output_dimensions()[0])
-        complete_net = NeuralNet(sf_layers + word2vec_layers + mixture_layers)
-        complete_net.input = X_list
+    complete_net = NeuralNet(
+            input_layers + sf_layers + word2vec_layers + mixture_layers)
+    complete_net.input = []
+    for input_layer in input_layers:
+        complete_net.input.extend(input_layer.input)
 
     trainer = AdagradTrainer(complete_net, complete_net.crossentropy, 
             learning_rate, lr_smoother, data_triplet, _make_givens)
@@ -191,6 +216,8 @@ def _net_mixture_experiment_helper(experiment_name,
                 'continuous num hidden layers': cont_num_hidden_layers,
                 'cost function': 'crossentropy',
                 'projection' : proj_type,
+                'bag size' : bag_size,
+                'bag rank' : bag_rank,
                 }
         json_file.write('%s\n' % json.dumps(result_dict, sort_keys=True))
 
@@ -213,16 +240,7 @@ def read_sparse_vectors(dir_list, sparse_feature_file):
     return id_to_sfv
 
 def get_sfv(relation_list, id_to_sfv, num_features=250000):
-    rows = []
-    columns = []
-    data = []
-    for i, relation in enumerate(relation_list):
-        relation_id = relation.doc_relation_id
-        columns += id_to_sfv[relation_id]
-        for j in xrange(len(id_to_sfv[relation_id])):
-            rows.append(i)
-            data.append(1)
-    return coo_matrix(
-            (data, (rows, columns)),
-            shape=(len(relation_list), num_features), 
-            dtype=config.floatX).tocsr()
+    builder = util.CSRBuilder(binary=False)
+    for relation in relation_list:
+        builder.add_row(id_to_sfv[relation.doc_relation_id])
+    return builder.tocsr(num_features)
@@ -0,0 +1,183 @@
+"""Update rules for the trainers in learning.py
+
+The hyperparameters (learning rate, smoother, momentum, ...) are shared
+variables, so they can be changed between reps or by a learning rate
+schedule without compiling the training function again.
+
+    optimizer = Adam(0.001)
+    trainer = GradientTrainer(nn, nn.crossentropy, optimizer, data_triplet)
+    for learning_rate in [0.01, 0.001]:
+        optimizer.set_learning_rate(learning_rate)
+        trainer.reset()
+        trainer.train_minibatch_triplet(minibatch_size, n_epochs)
+
+Each optimizer only implements _step, which computes the change in
+the param and the new states (e.g. the sum of squared gradients) from
+the gradient and the current states. The same rule makes the updates for
+the dense params and for the rows of the sparse params looked up in
+the minibatch (see lstm.EmbeddingLayer). The states of the other rows
+are not touched (lazy updates).
+"""
+import numpy as np
+import theano
+import theano.tensor as T
+from theano import config
+
+def shared_scalar(value, name=None):
+    return theano.shared(np.asarray(value, dtype=config.floatX), name=name)
+
+def step_decay(learning_rate, decay=0.5, num_epochs=10):
+    """Learning rate schedule for the trainers
+
+    The learning rate is multiplied by decay every num_epochs epochs.
+    """
+    def lr_schedule(epoch):
+        return learning_rate * decay ** ((epoch - 1) // num_epochs)
+    return lr_schedule
+
+class Optimizer(object):
+
+    num_states = 0
+
+    def __init__(self, learning_rate):
+        self.hyperparameters = []
+        self.global_states = []
+        self.states = []
+        self.learning_rate = \
+                self._hyperparameter(learning_rate, 'learning rate')
+
+    def _hyperparameter(self, value, name):
+        hyperparameter = shared_scalar(value, name)
+        self.hyperparameters.append(hyperparameter)
+        return hyperparameter
+
+    def set_learning_rate(self, learning_rate):
+        self.learning_rate.set_value(
+                np.asarray(learning_rate, dtype=config.floatX))
+
+    def get_updates(self, params, gparams, sparse_params=[], states=None):
+        """Returns the updates for the training function
+
+        sparse_params is a list of (param, row indices, row gradients).
+        The row indices must be unique. states are made by add_states
+        if not given.
+        """
+        updates = []
+        if states is None:
+            states = self.add_states(params + [x[0] for x in sparse_params])
+        dense_states = states[:len(params)]
+        sparse_states = states[len(params):]
+        for param, gparam, param_states in \
+                zip(params, gparams, dense_states):
+            delta, new_states = self._step(gparam, param_states)
+            updates.extend(zip(param_states, new_states))
+            updates.append((param, param + delta))
+        for (param, indices, grows), param_states in \
+                zip(sparse_params, sparse_states):
+            state_rows = [state[indices] for state in param_states]
+            delta, new_state_rows = self._step(grows, state_rows)
+            updates.extend((state, T.set_subtensor(rows, new_rows))
+                    for state, rows, new_rows in
+                    zip(param_states, state_rows, new_state_rows))
+            updates.append((param, T.inc_subtensor(param[indices], delta)))
+        updates.extend(self._global_updates())
+        return updates
+
+    def add_states(self, params):
+        """Makes the states of the params in the order of get_updates
+
+        The dense params come first and then the sparse params.
+        """
+        return [self._new_states(param) for param in params]
+
+    def reset(self):
+        for state in self.states:
+            value = np.zeros(state.get_value().shape, dtype=config.floatX)
+            state.set_value(value)
+
+    def _new_states(self, param):
+        states = [theano.shared(value=np.zeros(param.get_value().shape).\
+                astype(config.floatX), borrow=True)
+                for i in range(self.num_states)]
+        self.states.extend(states)
+        return states
+
+    def _step(self, gparam, states):
+        """Returns the change in the param and the new states"""
+        raise NotImplementedError
+
+    def _global_updates(self):
+        return []
+
+class Adagrad(Optimizer):
+
+    num_states = 1
+
+    def __init__(self, learning_rate, lr_smoother):
+        Optimizer.__init__(self, learning_rate)
+        self.lr_smoother = self._hyperparameter(lr_smoother, 'lr smoother')
+
+    def _step(self, gparam, states):
+        sgs, = states
+        adagrad_rate = self.learning_rate / (self.lr_smoother + T.sqrt(sgs))
+        return -adagrad_rate * gparam, [sgs + T.square(gparam)]
+
+class RMSProp(Optimizer):
+
+    num_states = 1
+
+    def __init__(self, learning_rate, rho=0.9, lr_smoother=1e-6):
+        Optimizer.__init__(self, learning_rate)
+        self.rho = self._hyperparameter(rho, 'rho')
+        self.lr_smoother = self._hyperparameter(lr_smoother, 'lr smoother')
+
+    def _step(self, gparam, states):
+        mean_square, = states
+        new_mean_square = self.rho * mean_square + \
+                (1 - self.rho) * T.square(gparam)
+        delta = -self.learning_rate * gparam / \
+                (self.lr_smoother + T.sqrt(new_mean_square))
+        return delta, [new_mean_square]
+
+class MomentumSGD(Optimizer):
+
+    num_states = 1
+
+    def __init__(self, learning_rate, momentum=0.9):
+        Optimizer.__init__(self, learning_rate)
+        self.momentum = self._hyperparameter(momentum, 'momentum')
+
+    def _step(self, gparam, states):
+        velocity, = states
+        new_velocity = self.momentum * velocity - self.learning_rate * gparam
+        return new_velocity, [new_velocity]
+
+class Adam(Optimizer):
+    """Adam with bias correction
+
+    The sparse rows use the global step count for the bias correction.
+    """
+
+    num_states = 2
+
+    def __init__(self, learning_rate, beta1=0.9, beta2=0.999, lr_smoother=1e-8):
+        Optimizer.__init__(self, learning_rate)
+        self.beta1 = self._hyperparameter(beta1, 'beta1')
+        self.beta2 = self._hyperparameter(beta2, 'beta2')
+        self.lr_smoother = self._hyperparameter(lr_smoother, 'lr smoother')
+        self.num_steps = shared_scalar(0, 'num steps')
+        self.global_states.append(self.num_steps)
+        self.states.append(self.num_steps)
+
+    def _step(self, gparam, states):
+        m, v = states
+        t = self.num_steps + 1
+        new_m = self.beta1 * m + (1 - self.beta1) * gparam
+        new_v = self.beta2 * v + (1 - self.beta2) * T.square(gparam)
+        step_size = self.learning_rate * \
+                T.sqrt(1 - self.beta2 ** t) / (1 - self.beta1 ** t)
+        delta = -step_size * new_m / (self.lr_smoother + T.sqrt(new_v))
+        return delta, [new_m, new_v]
+
+    def _global_updates(self):
+        return [(self.num_steps, self.num_steps + 1)]
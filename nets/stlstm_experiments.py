@@ -9,7 +9,8 @@ import cognitive_disco.base_label_functions as l
 from cognitive_disco.data_reader import extract_implicit_relations
 
 from cognitive_disco.nets.bilinear_layer import \
-        LinearLayer, NeuralNet, LinearLayerTensorOutput
+        MaskedInputLayer, NeuralNet, LinearLayerTensorOutput, \
+        make_multilayer_net_from_layers
 import cognitive_disco.nets.util as util
 from cognitive_disco.nets.learning import AdagradTrainer, DataTriplet
 from cognitive_disco.nets.lstm import \
@@ -26,7 +27,7 @@ def net_experiment_stlstm(dir_list, args):
     sense_lf = l.SecondLevelLabel()
     relation_list_list = [extract_implicit_relations(dir, sense_lf) 
             for dir in dir_list]
-    wbm = util.get_wbm(num_units)
+    wbm = util.get_wbm(num_units, dir_list)
     labels = ['NP', 'VP' , 'S', 'PP', 'SBAR', 'ADVP', 'ADJP', 
             'NP_', 'VP_', 'S_', 'PP_', 'SBAR_', 'ADVP_', 'ADJP_', 
             'OTHERS']
@@ -38,7 +39,8 @@ def net_experiment_stlstm(dir_list, args):
     node_label_tuple_triplet = []
     for relation_list in relation_list_list:
         data, node_labels_tuple = \
-                prep_stlstm_serrated_matrix_relations(relation_list, wbm, 30, node_label_alphabet)
+                prep_stlstm_serrated_matrix_relations(relation_list, wbm, 30, 
+                        node_label_alphabet, sparse_node_labels=True)
         data_list.append(data)
         node_label_tuple_triplet.append(node_labels_tuple)
     label_vector_triplet, label_alphabet = \
@@ -73,57 +75,33 @@ def _construct_net(data_triplet, wbm,
     arg1_node_label_layer = LinearLayerTensorOutput(rng, 
             n_in=wbm.num_units, 
             n_out=data_triplet.output_dimensions()[0],
-            X=arg1_model.h)
+            X=arg1_model.h, sparse_targets=True)
     arg2_node_label_layer = LinearLayerTensorOutput(rng, 
             n_in=wbm.num_units, 
             n_out=data_triplet.output_dimensions()[1],
-            X=arg2_model.h)
-
-    if proj_type == 'max_pool':
-        proj_variables = [arg1_model.max_pooled_h, arg2_model.max_pooled_h]
-    elif proj_type == 'mean_pool':
-        proj_variables = [arg1_model.mean_pooled_h, arg2_model.mean_pooled_h]
-    elif proj_type == 'sum_pool':
-        proj_variables = [arg1_model.sum_pooled_h, arg2_model.sum_pooled_h]
-    elif proj_type == 'top':
-        proj_variables = [arg1_model.top_h, arg2_model.top_h]
-    else:
-        raise ValueError('Invalid projection type: %s' % proj_type)
-
-    hidden_layers = []    
-    n_in_list = [wbm.num_units, wbm.num_units]
-    X_list = proj_variables
-    for i in range(num_hidden_layers):
-        hidden_layer = LinearLayer(rng,
-            n_in_list=n_in_list, 
-            n_out=num_hidden_units,
-            use_sparse=False, 
-            X_list=X_list, 
-            activation_fn=T.tanh)
-        n_in_list = [num_hidden_units]
-        X_list = [hidden_layer.activation]
-        hidden_layers.append(hidden_layer)
-    label_output_layer = LinearLayer(rng, 
-            n_in_list=n_in_list,
-            n_out=data_triplet.output_dimensions()[2],
-            use_sparse=False,
-            X_list=X_list,
-            Y=T.lvector(),
-            activation_fn=T.nnet.softmax)
-
-    nn = NeuralNet()
-    layers = [arg1_model, arg2_model, 
-            arg1_node_label_layer, arg2_node_label_layer, label_output_layer] \
-                    + hidden_layers
-    for layer in layers:
-        nn.params.extend(layer.params)
-    nn.layers = layers
-
-    nn.input.extend(arg1_model.input)
-    nn.input.extend(arg2_model.input)
-    nn.output.extend(arg1_node_label_layer.output + 
-            arg2_node_label_layer.output + 
-            label_output_layer.output)
+            X=arg2_model.h, sparse_targets=True)
+
+    arg1_pooled = MaskedInputLayer(rng, wbm.num_units, proj_type,
+            arg1_model.h, arg1_model.mask, arg1_model.c_mask)
+    arg2_pooled = MaskedInputLayer(rng, wbm.num_units, proj_type,
+            arg2_model.h, arg2_model.mask, arg2_model.c_mask)
+    _, pred_layers = make_multilayer_net_from_layers(
+            input_layers=[arg1_pooled, arg2_pooled],
+            Y=T.lvector(), use_sparse=False,
+            num_hidden_layers=num_hidden_layers,
+            num_hidden_units=num_hidden_units,
+            num_output_units=data_triplet.output_dimensions()[2],
+            output_activation_fn=T.nnet.softmax,
+            dropout=False)
+    label_output_layer = pred_layers[-1]
+
+    nn = NeuralNet([arg1_model, arg2_model, 
+            arg1_node_label_layer, arg2_node_label_layer] + pred_layers)
+
+    nn.input = arg1_model.input + arg2_model.input
+    nn.output = arg1_node_label_layer.output + \
+            arg2_node_label_layer.output + \
+            label_output_layer.output
     nn.predict = label_output_layer.predict
     nn.crossentropy = label_output_layer.crossentropy + \
             0.5 * arg1_node_label_layer.crossentropy + \
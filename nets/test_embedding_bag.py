@@ -0,0 +1,56 @@
+import unittest
+
+import numpy as np
+import theano.tensor as T
+from theano import config
+
+from cognitive_disco.nets.bilinear_layer import EmbeddingBagLayer, \
+        make_multilayer_net_from_layers
+from cognitive_disco.nets.learning import DataTriplet, GradientTrainer
+from cognitive_disco.nets.optimizers import Adam, MomentumSGD, RMSProp
+
+class EmbeddingBagPaddingTest(unittest.TestCase):
+    """The -1 padding must not touch the row of the last feature"""
+
+    def _check(self, optimizer):
+        rng = np.random.RandomState(0)
+        bag_layer = EmbeddingBagLayer(rng, 4, 3, use_values=True)
+        nn, _ = make_multilayer_net_from_layers([bag_layer], T.lvector(),
+                False, 0, 0, 2, T.nnet.softmax, False)
+        # feature 3 is only in the first minibatch
+        indices = np.array([[0, 3, -1], [1, 2, -1], [0, 1, -1], [2, -1, -1]],
+                dtype='int64')
+        values = np.array([[1, 2, 0], [3, 1, 0], [2, 1, 0], [3, 0, 0]], 
+                dtype=config.floatX)
+        labels = np.array([0, 1, 1, 0], dtype='int64')
+        data_triplet = DataTriplet([[indices, values]] * 3, [[labels]] * 3,
+                [{'a': 0, 'b': 1}])
+        trainer = GradientTrainer(nn, nn.crossentropy, optimizer,
+                data_triplet, function_cache=None)
+
+        E_before = bag_layer.E.get_value().copy()
+        trainer.train_function(0, 2)
+        E_after = bag_layer.E.get_value().copy()
+        for row in range(4):
+            self.assertFalse(np.allclose(E_before[row], E_after[row]))
+
+        # the states of row 3 are not zero now but it must stay put
+        E_before = E_after
+        for _ in range(3):
+            trainer.train_function(1, 2)
+        E_after = bag_layer.E.get_value()
+        self.assertTrue(np.array_equal(E_before[3], E_after[3]))
+        for row in range(3):
+            self.assertFalse(np.allclose(E_before[row], E_after[row]))
+
+    def test_momentum(self):
+        self._check(MomentumSGD(0.1, 0.9))
+
+    def test_adam(self):
+        self._check(Adam(0.1))
+
+    def test_rmsprop(self):
+        self._check(RMSProp(0.1))
+
+if __name__ == '__main__':
+    unittest.main()
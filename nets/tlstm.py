@@ -1,5 +1,5 @@
 from nltk import Tree
-from lstm import LSTM
+from lstm import LSTM, BinaryTreeLSTM, compose_node
 
 import theano
 from theano import config
@@ -7,6 +7,11 @@ import theano.tensor as T
 import tree_util
 
 class BinaryForestLSTM(LSTM):
+    """Tree LSTM with one subgraph per tree in the data
+
+    Composing the graph takes far too long for the full data set. 
+    Use IndexedForestLSTM instead.
+    """
 
     def __init__(self, data, rng, wbm, 
             X_list=None, n_out=None, W=None, U=None, b=None):
@@ -78,22 +83,36 @@ class TLSTMNode(object):
             #self.embedding = self.wbm.get_embedding(word)
             self.h = self.wbm.get_embedding(word)
         else:
-            preact = T.dot(self.left.h, self.W) +\
-                    T.dot(self.right.h, self.U) + self.b
-
-            #i = T.nnet.sigmoid(_slice(preact, 0, self.dim_proj))
-            #f1 = T.nnet.sigmoid(_slice(preact, 1, self.dim_proj))
-            #f2 = T.nnet.sigmoid(_slice(preact, 2, self.dim_proj))
-            #o = T.nnet.sigmoid(_slice(preact, 3, self.dim_proj))
-            #c_prime = T.tanh(_slice(preact, 4, self.dim_proj))
-            i = T.nnet.sigmoid(preact[0:self.dim_proj])
-            f1 = T.nnet.sigmoid(preact[self.dim_proj:self.dim_proj*2])
-            f2 = T.nnet.sigmoid(preact[(self.dim_proj*2):(self.dim_proj*3)])
-            o = T.nnet.sigmoid(preact[self.dim_proj*3:self.dim_proj*4])
-            c_prime = T.tanh(preact[self.dim_proj*4:self.dim_proj*5])
-
-            self.c = i * c_prime + f1 * self.left.c + f2 * self.right.c
-            self.h = (o * T.tanh(self.c))
+            self.h, self.c = compose_node(self, self.left.h, self.left.c, 
+                    self.right.h, self.right.c)
+
+
+class IndexedForestLSTM(BinaryTreeLSTM):
+    """BinaryTreeLSTM(level_schedule=True) under its tree LSTM name
+
+    BinaryForestLSTM builds a subgraph of TLSTMNodes for every tree, so 
+    the time to compose and compile the graph grows with the data. 
+    BinaryTreeLSTM computes the same nodes (lstm.compose_node) but the trees
+    come in as children index arrays (the level schedule from 
+    tree_util.level_schedule), so we compile one graph for any number of
+    trees and train on minibatches of the full data set. This class only 
+    fixes level_schedule=True.
+
+    The inputs are the same as BinaryTreeLSTM(level_schedule=True):
+        word_matrix : 2T x N x d word embedding for the leaves
+        level_children : H x W x N x 3 level schedule
+        c_mask : T x N masking matrix for the children matrix
+        node_mask : 2T x N masking matrix for the internal nodes
+    max_pooled_h, mean_pooled_h, sum_pooled_h pool over the internal nodes 
+    and top_h is the root like in BinaryForestLSTM.
+    Use prep_tree_lstm_serrated_matrix_relations(level_schedule=True) 
+    and BinaryTreeLSTM.make_givens.
+    """
+
+    def __init__(self, rng, dim_proj, W=None, U=None, b=None,
+            embedding_layer=None):
+        BinaryTreeLSTM.__init__(self, rng, dim_proj, W, U, b, 
+                embedding_layer=embedding_layer, level_schedule=True)
 
 def prep_tree_arg(relation_list, arg_pos, all_left_branching=False):
     parse_trees = []
@@ -1,5 +1,14 @@
+import hashlib
+import os
+
 import numpy as np
 from nltk import Tree
+from theano import config
+
+from cognitive_disco.nets.embedding_store import CACHE_DIR
+
+TOPOLOGY_CACHE_DIR = os.path.join(CACHE_DIR, 'tree_topology')
+TOPOLOGY_VERSION = 1
 
 def reverse_toposort(tree):
     """Reverse topological sorting
@@ -129,3 +138,214 @@ def _truncate_to_first_sentence(token_list):
     sentence_indices = [t[3] for t in token_list]
     first_sentence_index = min(sentence_indices)
     return [t for t in token_list if t[3] == first_sentence_index]
+
+
+class TreeTopology(object):
+    """The binarized trees of a split compiled into arrays
+
+    T = max length, N = number of samples
+
+    word_ids : T x N indices into words for the leaves (-1 for padding)
+    children : T x N x 3 children serrated matrix
+    c_mask : T x N masking matrix for the children matrix
+    node_mask : 2T x N masking matrix for the internal nodes
+    node_labels : 2T x N indices into labels (-1 for the leaves and padding)
+    words : the leaf words
+    labels : the syntactic categories of the internal nodes
+
+    The arrays do not depend on the word embedding or the node label 
+    alphabet, so one topology serves every experiment on the split.
+    """
+
+    ARRAY_NAMES = ['word_ids', 'children', 'c_mask', 'node_mask', 
+            'node_labels', 'words', 'labels']
+
+    def __init__(self, word_ids, children, c_mask, node_mask, node_labels,
+            words, labels):
+        self.word_ids = word_ids
+        self.children = children
+        self.c_mask = c_mask
+        self.node_mask = node_mask
+        self.node_labels = node_labels
+        self.words = words
+        self.labels = labels
+
+    def word_indices(self, wbm):
+        """2T x N token indices into wbm.wm (0 for padding as before)"""
+        max_length, n_samples = self.word_ids.shape
+        vocab_indices = np.array(
+                wbm.index_tokens(list(self.words), ignore_OOV=False) + [0], 
+                dtype='int64')
+        w_indices = np.zeros((2 * max_length, n_samples), dtype='int64')
+        w_indices[:max_length] = vocab_indices[self.word_ids]
+        return w_indices
+
+    def node_label_tensor(self, node_label_alphabet):
+        """2T x N x k one-hot node labels
+
+        The labels not in the alphabet are mapped to OTHERS.
+        """
+        num_nodes, n_samples = self.node_labels.shape
+        node_label_tensor = np.zeros(
+                (num_nodes, n_samples, len(node_label_alphabet)), 
+                dtype=config.floatX)
+        if len(node_label_alphabet) == 0:
+            return node_label_tensor
+        label_indices = np.array([node_label_alphabet[x] 
+            if x in node_label_alphabet else node_label_alphabet['OTHERS'] 
+            for x in self.labels], dtype='int64')
+        node_indices, sample_indices = np.nonzero(self.node_labels >= 0)
+        node_label_tensor[node_indices, sample_indices, 
+                label_indices[self.node_labels[node_indices, sample_indices]]] = 1.
+        return node_label_tensor
+
+    def node_label_matrix(self, node_label_alphabet, ignore_index=-1):
+        """2T x N node label indices 
+
+        The leaves and the padding get ignore_index.
+        The labels not in the alphabet are mapped to OTHERS.
+        """
+        node_label_matrix = np.empty(self.node_labels.shape, dtype='int64')
+        node_label_matrix.fill(ignore_index)
+        if len(node_label_alphabet) == 0:
+            return node_label_matrix
+        label_indices = np.array([node_label_alphabet[x] 
+            if x in node_label_alphabet else node_label_alphabet['OTHERS'] 
+            for x in self.labels], dtype='int64')
+        is_labeled = self.node_labels >= 0
+        node_label_matrix[is_labeled] = label_indices[self.node_labels[is_labeled]]
+        return node_label_matrix
+
+    def save(self, file_name):
+        tmp_file_name = '%s.%s.tmp' % (file_name, os.getpid())
+        with open(tmp_file_name, 'wb') as f:
+            np.savez(f, **dict((x, getattr(self, x)) for x in self.ARRAY_NAMES))
+        os.rename(tmp_file_name, file_name)
+
+    @classmethod
+    def load(cls, file_name):
+        arrays = np.load(file_name)
+        return cls(*[arrays[x] for x in cls.ARRAY_NAMES])
+
+
+def compile_tree_topology(relation_list, arg_pos, max_length, 
+        all_left_branching=False):
+    """Binarize and toposort the trees of a split into a TreeTopology
+
+    The truncation follows lstm.prep_tree_srm_arg. Leaves beyond max_length 
+    are dropped and we keep the first 2T nodes.
+    """
+    assert arg_pos == 1 or arg_pos == 2
+    n_samples = len(relation_list)
+    word_ids = -np.ones((max_length, n_samples), dtype='int32')
+    children = np.zeros((n_samples, max_length, 3), dtype='int64')
+    c_mask = np.zeros((max_length, n_samples), dtype=config.floatX)
+    node_mask = np.zeros((2 * max_length, n_samples), dtype=config.floatX)
+    node_labels = -np.ones((2 * max_length, n_samples), dtype='int32')
+    word_alphabet = {}
+    label_alphabet = {}
+    for i, relation in enumerate(relation_list):
+        if all_left_branching:
+            parse_tree = left_branching_tree(relation, arg_pos)
+        else:
+            parse_tree = find_parse_tree(relation, arg_pos)
+            if len(parse_tree.leaves()) == 0:
+                parse_tree = left_branching_tree(relation, arg_pos)
+        leaves = parse_tree.leaves()[:max_length]
+        word_ids[:len(leaves), i] = [word_alphabet.setdefault(x, len(word_alphabet)) 
+                for x in leaves]
+
+        ordering_matrix, node_label_list, num_leaves = \
+                reverse_toposort(parse_tree)
+        num_nodes = min(2 * max_length, ordering_matrix.shape[0])
+        if num_nodes > num_leaves:
+            num_inner_nodes = num_nodes - num_leaves
+            children[i, :num_inner_nodes, :] = \
+                    ordering_matrix[num_leaves:num_nodes, :]
+            c_mask[:num_inner_nodes, i] = 1.
+            node_mask[num_leaves:num_nodes, i] = 1. 
+            for t, node_label in enumerate(node_label_list[:2 * max_length]):
+                if node_label is not None:
+                    node_labels[t, i] = label_alphabet.setdefault(
+                            unicode(node_label), len(label_alphabet))
+
+    words = sorted(word_alphabet, key=word_alphabet.get)
+    labels = sorted(label_alphabet, key=label_alphabet.get)
+    return TreeTopology(word_ids, np.swapaxes(children, 0, 1), 
+            c_mask, node_mask, node_labels,
+            np.array(words, dtype=unicode), np.array(labels, dtype=unicode))
+
+
+def tree_topology_file(relation_list, arg_pos, max_length, all_left_branching,
+        cache_dir=TOPOLOGY_CACHE_DIR):
+    """The cache file for the topology of a split
+
+    The key hashes the relation IDs of the split (in order), the argument,
+    max length, and the binarization mode (parse trees or left branching).
+    """
+    mode = 'left' if all_left_branching else 'parse'
+    key_list = [str(TOPOLOGY_VERSION), str(arg_pos), str(max_length), mode] + \
+            [x.doc_relation_id for x in relation_list]
+    key = hashlib.md5('\n'.join(key_list)).hexdigest()[:16]
+    return os.path.join(cache_dir, 'arg%s-%s-%s-%s.npz' % \
+            (arg_pos, max_length, mode, key))
+
+def tree_topology(relation_list, arg_pos, max_length, all_left_branching=False,
+        cache_dir=TOPOLOGY_CACHE_DIR):
+    """Load the topology of the split from the cache or compile and save it
+    """
+    file_name = tree_topology_file(relation_list, arg_pos, max_length, 
+            all_left_branching, cache_dir)
+    if os.path.exists(file_name):
+        return TreeTopology.load(file_name)
+    topology = compile_tree_topology(relation_list, arg_pos, max_length, 
+            all_left_branching)
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    topology.save(file_name)
+    return topology
+
+
+def level_schedule(children, c_mask):
+    """Group the internal nodes by their height for level-synchronous scans
+
+    The leaves are on level 0 and an internal node is one level above its
+    higher child, so the nodes on the same level never depend on each other
+    and can be computed together.
+
+    children : T x N x 3 children serrated matrix (from reverse_toposort)
+    c_mask : T x N masking matrix for the children matrix
+
+    Returns level_children : H x W x N x 3 where H is the height of
+    the tallest tree and W is the most nodes on a level. Each row is 
+    (node index, left child index, right child index). Padding is -1.
+    """
+    max_length, n_samples = c_mask.shape
+    all_samples = np.arange(n_samples)
+    node_levels = np.zeros((2 * max_length, n_samples), dtype='int64')
+    inner_levels = np.zeros((max_length, n_samples), dtype='int64')
+    for t in xrange(max_length):
+        node_idx = children[t, :, 0]
+        level = np.maximum(node_levels[children[t, :, 1], all_samples],
+                node_levels[children[t, :, 2], all_samples]) + 1
+        is_inner = c_mask[t] > 0
+        node_levels[node_idx, all_samples] = \
+                np.where(is_inner, level, node_levels[node_idx, all_samples])
+        inner_levels[t] = np.where(is_inner, level, 0)
+
+    t_indices, sample_indices = np.nonzero(c_mask > 0)
+    levels = inner_levels[t_indices, sample_indices] - 1
+    height = levels.max() + 1 if len(levels) > 0 else 1
+    # slot of the node among the nodes on the same level of the same tree
+    order = np.lexsort((t_indices, levels, sample_indices))
+    t_indices = t_indices[order]
+    sample_indices = sample_indices[order]
+    levels = levels[order]
+    keys = sample_indices * height + levels
+    slots = np.arange(len(keys)) - np.searchsorted(keys, keys, 'left')
+    width = slots.max() + 1 if len(slots) > 0 else 1
+
+    level_children = -np.ones((height, width, n_samples, 3), dtype='int64')
+    level_children[levels, slots, sample_indices] = \
+            children[t_indices, sample_indices]
+    return level_children
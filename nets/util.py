@@ -1,10 +1,114 @@
+import os
 import sys
+from array import array
+from collections import OrderedDict
+
 import numpy as np
 import scipy as sp
+import scipy.sparse
+from theano import config
 from tpl.language.lexical_structure import WordEmbeddingMatrix
 import cognitive_disco.dense_feature_functions as df
+from cognitive_disco.nets.embedding_store import WordEmbeddingStore, store_exists, \
+        restricted_store
+
+PROJECTIONS = ['sum_pool', 'mean_pool', 'max_pool', 'top']
+
+class ByteBoundedLRU(object):
+    """LRU cache that evicts when the total size goes over max_bytes
+
+    The size of each value is given when it is put in.
+    A value bigger than max_bytes is not cached at all.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        value, num_bytes = self.entries.pop(key)
+        self.entries[key] = (value, num_bytes)
+        return value
+
+    def put(self, key, value, num_bytes):
+        if key in self.entries:
+            self.num_bytes -= self.entries.pop(key)[1]
+        if num_bytes > self.max_bytes:
+            return
+        while self.num_bytes + num_bytes > self.max_bytes:
+            evicted_key, (evicted_value, evicted_bytes) = \
+                    self.entries.popitem(last=False)
+            self.num_bytes -= evicted_bytes
+        self.entries[key] = (value, num_bytes)
+        self.num_bytes += num_bytes
+
+    def clear(self):
+        self.entries.clear()
+        self.num_bytes = 0
+
+# Process-wide caches shared by _get_word2vec_ff and _get_zh_word2vec_ff.
+# zh_experiment0 runs 144 configurations over only 12 embeddings, and
+# the 4 projections of the same embedding share one pooling pass.
+EMBEDDING_CACHE = ByteBoundedLRU(4 * 2 ** 30)
+POOLED_CACHE = ByteBoundedLRU(2 ** 30)
+
+def _embedding_num_bytes(word2vec):
+    word_embedding_dict = word2vec.word_embedding_dict
+    return len(word_embedding_dict) * word_embedding_dict.num_units * 8
+
+def _get_embedding_featurizer(embedding_key, file_name, dir_list, precision):
+    """EmbeddingFeaturizer from EMBEDDING_CACHE or load it and cache it"""
+    word2vec = EMBEDDING_CACHE.get(embedding_key)
+    if word2vec is None:
+        if dir_list is not None:
+            word2vec = df.EmbeddingFeaturizer(
+                    word_embedding_dict=restricted_store(file_name, dir_list,
+                        precision=precision))
+        else:
+            word2vec = df.EmbeddingFeaturizer(file_name)
+        EMBEDDING_CACHE.put(embedding_key, word2vec, _embedding_num_bytes(word2vec))
+    return word2vec
+
+def _check_projection(projection):
+    if projection not in PROJECTIONS:
+        raise ValueError('projection must be one of {mean_pool, sum_pool, max_pool, top}. Got %s ' % projection)
+
+def _pooling_ff(embedding_key, word2vec, projection):
+    """Feature function that memoizes the pooled matrices in POOLED_CACHE
 
-def _get_word2vec_ff(num_units, projection):
+    All of the projections are computed in one pass and cached together,
+    keyed by the embedding and the doc_relation_ids of the relation list.
+    The feature function returns copies so the cache is never modified.
+    """
+    def word2vec_ff(relation_list):
+        key = (embedding_key, tuple(x.doc_relation_id for x in relation_list))
+        pooled = POOLED_CACHE.get(key)
+        if pooled is None:
+            pooled = dict(zip(PROJECTIONS, word2vec.pool_args(relation_list, PROJECTIONS)))
+            num_bytes = sum(x.nbytes for arg_matrices in pooled.values()
+                    for x in arg_matrices)
+            POOLED_CACHE.put(key, pooled, num_bytes)
+        return [x.copy() for x in pooled[projection]]
+    return word2vec_ff
+
+def _get_word2vec_ff(num_units, projection, dir_list=None, precision='float32'):
+    """Returns the pooling feature function
+
+    If dir_list is given, only the vectors of the words in those data splits
+    are loaded. The subset is cached (see embedding_store.restricted_store)
+    and stored in the given precision (float32, float16, or int8).
+    The embeddings and the pooled matrices are memoized in the process.
+    """
     if num_units == 50:
         dict_file = '/home/j/llc/tet/nlp/lib/lexicon/homemade_word_vector/wsj-skipgram50.txt'
     elif num_units == 100:
@@ -13,34 +117,87 @@ def _get_word2vec_ff(num_units, projection):
         dict_file = '/home/j/llc/tet/nlp/lib/lexicon/google_word_vector/GoogleNews-vectors-negative300.txt'
     else:
         raise ValueError('num units must be {50, 100, 300}. Got %s ' % num_units)
+    _check_projection(projection)
 
-    word2vec = df.EmbeddingFeaturizer(dict_file)
-    if projection == 'mean_pool':
-        return word2vec.mean_args
-    elif projection == 'sum_pool':
-        return word2vec.additive_args
-    elif projection == 'max_pool':
-        return word2vec.max_args
-    elif projection == 'top':
-        return word2vec.top_args
-    else:
-        raise ValueError('projection must be one of {mean_pool, sum_pool, max_pool, top}. Got %s ' % projection)
+    embedding_key = ('en', None, num_units,
+            None if dir_list is None else tuple(dir_list), precision)
+    word2vec = _get_embedding_featurizer(embedding_key, dict_file, dir_list, precision)
+    return _pooling_ff(embedding_key, word2vec, projection)
 
-def _get_zh_word2vec_ff(num_units, vec_type, projection):
+def _get_zh_word2vec_ff(num_units, vec_type, projection, dir_list=None,
+        precision='float32'):
     prefix = 'zh_gigaword3'
     file_name = '/home/j/llc/tet/nlp/lib/lexicon/homemade_word_vector/%s-%s%s.txt' \
             % (prefix, vec_type, num_units)
-    word2vec = df.EmbeddingFeaturizer(file_name)
-    if projection == 'mean_pool':
-        return word2vec.mean_args
-    elif projection == 'sum_pool':
-        return word2vec.additive_args
-    elif projection == 'max_pool':
-        return word2vec.max_args
-    elif projection == 'top':
-        return word2vec.top_args
-    else:
-        raise ValueError('projection must be one of {mean_pool, sum_pool, max_pool, top}. Got %s ' % projection)
+    _check_projection(projection)
+    embedding_key = ('zh', vec_type, num_units,
+            None if dir_list is None else tuple(dir_list), precision)
+    word2vec = _get_embedding_featurizer(embedding_key, file_name, dir_list, precision)
+    return _pooling_ff(embedding_key, word2vec, projection)
+
+class CSRBuilder(object):
+    """Build a CSR matrix row by row without structural changes
+
+    The column indices (and the values) go into growable array buffers.
+    tocsr() sorts the indices within each row and removes the duplicates
+    in one vectorized pass so the result is canonical CSR with int32
+    indices. If binary is True, duplicates become 1. Otherwise, 
+    they are summed up like coo_matrix.tocsr().
+    """
+
+    def __init__(self, binary=True, dtype=config.floatX):
+        self.binary = binary
+        self.dtype = dtype
+        self.indices = array('i')
+        self.data = array('f')
+        self.row_lengths = array('i')
+
+    @property
+    def num_rows(self):
+        return len(self.row_lengths)
+
+    def add_row(self, indices, values=None):
+        self.indices.extend(indices)
+        if not self.binary:
+            if values is None:
+                self.data.extend([1.0] * len(indices))
+            else:
+                self.data.extend(values)
+        self.row_lengths.append(len(indices))
+
+    def tocsr(self, num_columns):
+        num_rows = self.num_rows
+        indices = np.frombuffer(self.indices, dtype=np.int32) \
+                if len(self.indices) > 0 else np.zeros(0, dtype=np.int32)
+        row_lengths = np.frombuffer(self.row_lengths, dtype=np.int32) \
+                if num_rows > 0 else np.zeros(0, dtype=np.int32)
+        row_ids = np.repeat(np.arange(num_rows, dtype=np.int32), row_lengths)
+        if self.binary:
+            data = np.ones(len(indices), dtype=self.dtype)
+        else:
+            data = np.frombuffer(self.data, dtype=np.float32).astype(self.dtype) \
+                    if len(self.data) > 0 else np.zeros(0, dtype=self.dtype)
+
+        order = np.lexsort((indices, row_ids))
+        indices = indices[order]
+        row_ids = row_ids[order]
+        data = data[order]
+
+        first = np.ones(len(indices), dtype=bool)
+        first[1:] = (indices[1:] != indices[:-1]) | (row_ids[1:] != row_ids[:-1])
+        if self.binary:
+            data = data[first]
+        elif len(data) > 0:
+            data = np.add.reduceat(data, np.nonzero(first)[0]).astype(self.dtype)
+        indices = indices[first]
+        row_ids = row_ids[first]
+
+        indptr = np.zeros(num_rows + 1, dtype=np.int32)
+        np.cumsum(np.bincount(row_ids, minlength=num_rows), out=indptr[1:])
+        matrix = sp.sparse.csr_matrix((data, indices, indptr), 
+                shape=(num_rows, num_columns))
+        matrix.has_sorted_indices = True
+        return matrix
 
 def _sparse_featurize_relation_list(relation_list, ff_list, alphabet=None):
     if alphabet is None:
@@ -48,7 +205,7 @@ def _sparse_featurize_relation_list(relation_list, ff_list, alphabet=None):
         grow_alphabet = True
     else:
         grow_alphabet = False
-    feature_vectors = []
+    builder = CSRBuilder()
     print 'Applying feature functions...'
     for relation in relation_list:
         feature_vector_indices = []
@@ -59,57 +216,167 @@ def _sparse_featurize_relation_list(relation_list, ff_list, alphabet=None):
                     alphabet[f] = len(alphabet)
                 if f in alphabet:
                     feature_vector_indices.append(alphabet[f])
-        feature_vectors.append(feature_vector_indices)
+        builder.add_row(feature_vector_indices)
 
     print 'Creating feature sparse matrix...'
-    feature_matrix = sp.sparse.lil_matrix((len(relation_list), len(alphabet)))
-    for i, fv in enumerate(feature_vectors):
-        feature_matrix[i, fv] = 1    
-    return feature_matrix.tocsr(), alphabet    
+    return builder.tocsr(len(alphabet)), alphabet    
+
+def sparse_featurize(relation_list_list, ff_list, alphabet_prefix=None):
+    """Featurize the data splits with the alphabet of the first one
 
-def sparse_featurize(relation_list_list, ff_list):
+    If alphabet_prefix is given, the alphabet of the training split is 
+    frozen (see alphabet.FrozenAlphabet) and saved with that prefix, and 
+    the other splits are featurized with the memory-mapped copy. If it has 
+    been saved already, we load it instead of growing a dict, so delete 
+    the files when the feature functions change.
+    """
     print 'Featurizing...'
     data_list = []
     alphabet = None
+    if alphabet_prefix is not None:
+        from cognitive_disco.nets.alphabet import FrozenAlphabet, \
+                alphabet_exists, freeze_feature_matrices
+        if not alphabet_exists(alphabet_prefix):
+            data, alphabet = _sparse_featurize_relation_list(
+                    relation_list_list[0], ff_list)
+            data_list, frozen_alphabet = \
+                    freeze_feature_matrices([data], alphabet)
+            frozen_alphabet.save(alphabet_prefix)
+            relation_list_list = relation_list_list[1:]
+        print 'Loading the frozen alphabet %s...' % alphabet_prefix
+        alphabet = FrozenAlphabet.load(alphabet_prefix)
     for relation_list in relation_list_list:
         data, alphabet = _sparse_featurize_relation_list(relation_list, ff_list, alphabet)
         data_list.append(data)
     return (data_list, alphabet)    
 
-def compute_mi(feature_matrix, label_vector):
-    """Compute mutual information of each feature 
+def _mi_chunks(feature_matrix, label_vector, chunk_size):
+    """Compute mutual information one chunk of features at a time
 
+    Yields (start column index, MI vector for the chunk). The counts come
+    from X.T * onehot(y) on the sparse matrix so we never densify the rows.
+    Only chunk_size x num_labels dense matrices are alive at any time.
     """
+    feature_matrix = sp.sparse.csc_matrix(feature_matrix)
+    label_vector = np.asarray(label_vector)
     num_labels = np.max(label_vector) + 1
-    num_features = feature_matrix.shape[1]
-    num_rows = feature_matrix.shape[0]
+    num_rows, num_features = feature_matrix.shape
     total = num_rows + num_labels
 
-    c_y = np.zeros(num_labels)
-    for l in label_vector:
-        c_y[l] += 1.0
-    c_y += 1.0
-
-    c_x_y = np.zeros((num_features, num_labels)) 
-    c_x = np.zeros(num_features)
-    for i in range(num_rows):
-        c_x_y[:, label_vector[i]] += feature_matrix[i, :]
-        c_x += feature_matrix[i, :]
-    c_x_y += 1.0
-    c_x += 1.0
-
-    c_x_c_y = np.outer(c_x, c_y)
-    c_not_x_c_y = np.outer((total - c_x), c_y)
-    c_not_x_y = c_y - c_x_y
-
-    inner = c_x_y / total * np.log(c_x_y * total / c_x_c_y) + \
-            c_not_x_y / total * np.log(c_not_x_y * total / c_not_x_c_y) 
-    mi_x = inner.sum(1)    
+    c_y = np.bincount(label_vector, minlength=num_labels) + 1.0
+    label_matrix = sp.sparse.csr_matrix(
+            (np.ones(num_rows), (np.arange(num_rows), label_vector)),
+            shape=(num_rows, num_labels))
+
+    for start in xrange(0, num_features, chunk_size):
+        end = min(start + chunk_size, num_features)
+        chunk = feature_matrix[:, start:end]
+        c_x_y = chunk.T.dot(label_matrix).toarray() + 1.0
+        c_x = np.asarray(chunk.sum(0)).ravel() + 1.0
+
+        c_x_c_y = np.outer(c_x, c_y)
+        c_not_x_c_y = np.outer((total - c_x), c_y)
+        c_not_x_y = c_y - c_x_y
+
+        inner = c_x_y / total * np.log(c_x_y * total / c_x_c_y) + \
+                c_not_x_y / total * np.log(c_not_x_y * total / c_not_x_c_y) 
+        yield start, inner.sum(1)
+
+def compute_mi(feature_matrix, label_vector, chunk_size=50000):
+    """Compute mutual information of each feature 
+
+    feature_matrix can be sparse or dense. The features are processed
+    in column chunks so the memory is bounded by chunk_size x num_labels.
+    """
+    num_features = feature_matrix.shape[1]
+    mi_x = np.zeros(num_features)
+    for start, mi_chunk in _mi_chunks(feature_matrix, label_vector, chunk_size):
+        mi_x[start:start + len(mi_chunk)] = mi_chunk
     return mi_x
 
+def select_top_features(mi, num_features):
+    """Returns the indices of the features with the highest MI
+
+    The indices are in the increasing order of MI (same as argsort).
+    """
+    num_features = min(num_features, len(mi))
+    if num_features == 0:
+        return np.array([], dtype=np.int32)
+    top_indices = np.argpartition(mi, len(mi) - num_features)[-num_features:]
+    return top_indices[np.argsort(mi[top_indices])].astype(np.int32)
+
+def compute_top_mi_features(feature_matrix, label_vector, num_features, 
+        chunk_size=50000):
+    """Select the top features by MI without keeping the whole MI vector
+
+    We keep a running top-k over the chunks.
+
+    Returns the feature indices and their MI (increasing order of MI)
+    """
+    best_indices = np.array([], dtype=np.int32)
+    best_mi = np.array([])
+    for start, mi_chunk in _mi_chunks(feature_matrix, label_vector, chunk_size):
+        candidate_indices = np.concatenate(
+                [best_indices, np.arange(start, start + len(mi_chunk))])
+        candidate_mi = np.concatenate([best_mi, mi_chunk])
+        top = select_top_features(candidate_mi, num_features)
+        best_indices = candidate_indices[top].astype(np.int32)
+        best_mi = candidate_mi[top]
+    return best_indices, best_mi
+
+def select_csr_columns(feature_matrix, column_indices):
+    """Select the columns from a CSR matrix without leaving CSR
+
+    The new column j is the old column column_indices[j]. 
+    Indices and indptr are int32. 
+    """
+    feature_matrix = sp.sparse.csr_matrix(feature_matrix)
+    num_rows, num_features = feature_matrix.shape
+    column_map = np.empty(num_features, dtype=np.int32)
+    column_map.fill(-1)
+    column_map[column_indices] = np.arange(len(column_indices), dtype=np.int32)
+
+    new_indices = column_map[feature_matrix.indices]
+    keep = new_indices >= 0
+    row_ids = np.repeat(np.arange(num_rows, dtype=np.int32), 
+            np.diff(feature_matrix.indptr))
+    row_nnz = np.bincount(row_ids[keep], minlength=num_rows)
+    indptr = np.zeros(num_rows + 1, dtype=np.int32)
+    np.cumsum(row_nnz, out=indptr[1:])
+
+    pruned = sp.sparse.csr_matrix(
+            (feature_matrix.data[keep], new_indices[keep], indptr),
+            shape=(num_rows, len(column_indices)))
+    pruned.sort_indices()
+    return pruned
+
 def prune_feature_matrices(feature_matrices, mi, num_features):
-    sorted_indices = mi.argsort()[-num_features:]
-    return [x[:, sorted_indices] for x in feature_matrices]
+    sorted_indices = select_top_features(mi, num_features)
+    return [select_csr_columns(x, sorted_indices) for x in feature_matrices]
+
+def csr_to_padded_indices(feature_matrix, max_length=None):
+    """Turn the rows of a CSR matrix into padded feature index lists
+
+    Returns (indices, values) for bilinear_layer.EmbeddingBagLayer.
+    Both are N x L where L is the most non-zeros in a row (or max_length).
+    The padding index is -1 and the padding value is 0. If a row has
+    more than max_length non-zeros, the rest are dropped.
+    """
+    feature_matrix = sp.sparse.csr_matrix(feature_matrix)
+    num_rows = feature_matrix.shape[0]
+    row_nnz = np.diff(feature_matrix.indptr)
+    if max_length is None:
+        max_length = max(row_nnz.max() if num_rows > 0 else 0, 1)
+    row_ids = np.repeat(np.arange(num_rows), row_nnz)
+    positions = np.arange(len(row_ids)) - feature_matrix.indptr[row_ids]
+    keep = positions < max_length
+
+    indices = np.empty((num_rows, max_length), dtype=np.int64)
+    indices.fill(-1)
+    values = np.zeros((num_rows, max_length), dtype=config.floatX)
+    indices[row_ids[keep], positions[keep]] = feature_matrix.indices[keep]
+    values[row_ids[keep], positions[keep]] = feature_matrix.data[keep]
+    return indices, values
 
 class BrownDictionary(object):
 
@@ -144,16 +411,12 @@ class BrownDictionary(object):
         return bag
 
     def get_brown_sparse_matrices_relations(self, relations):
-        X1 = sp.sparse.csr_matrix((len(relations), self.num_clusters),dtype=float)    
-        X2 = sp.sparse.csr_matrix((len(relations), self.num_clusters),dtype=float)    
+        X1 = CSRBuilder(dtype=float)
+        X2 = CSRBuilder(dtype=float)
         for i, relation in enumerate(relations):
-            bag1 = self._get_brown_cluster_bag(relation.arg_tokens(1))
-            for cluster in bag1:
-                X1[i, cluster] = 1.0
-            bag2 = self._get_brown_cluster_bag(relation.arg_tokens(2))
-            for cluster in bag2:
-                X2[i, cluster] = 1.0
-        return (X1, X2)
+            X1.add_row(self._get_brown_cluster_bag(relation.arg_tokens(1)))
+            X2.add_row(self._get_brown_cluster_bag(relation.arg_tokens(2)))
+        return (X1.tocsr(self.num_clusters), X2.tocsr(self.num_clusters))
 
     def get_brown_matrices_data(self, relation_list_list, use_sparse):
         """Extract sparse 
@@ -215,7 +478,16 @@ def level2_labels(relations, alphabet=None):
         label_vector.append(alphabet[relation.senses[0]])
     return np.array(label_vector, np.int64), alphabet
 
-def get_wbm(num_units):
+def get_wbm(num_units, dir_list=None, precision='float32'):
+    """Load the word embedding matrix
+
+    If the memory-mapped store (see embedding_store.py) has been converted
+    next to the .npy file, we use it instead.
+    If dir_list is given, only the vectors of the words in those data splits
+    are loaded. The subset is cached (see embedding_store.restricted_store).
+    If precision is float16 or int8, the vectors are stored in that precision
+    and only the gathered rows are dequantized.
+    """
     if num_units == 50:
         dict_file = '/home/j/llc/tet/nlp/lib/lexicon/homemade_word_vector/wsj-skipgram50.npy'
         vocab_file = '/home/j/llc/tet/nlp/lib/lexicon/homemade_word_vector/wsj-skipgram50_vocab.txt'
@@ -229,9 +501,32 @@ def get_wbm(num_units):
         # this will crash the next step and te's too lazy to make it throw an exception.
         dict_file = None
         vocab_file = None
+    if dict_file is not None and dir_list is not None:
+        return restricted_store(dict_file, dir_list, vocab_file,
+                precision=precision)
+    if dict_file is not None:
+        store_prefix = os.path.splitext(dict_file)[0]
+        if precision != 'float32':
+            store_prefix = '%s-%s' % (store_prefix, precision)
+        if store_exists(store_prefix):
+            return WordEmbeddingStore(store_prefix)
     wbm = WordEmbeddingMatrix(dict_file, vocab_file)
     return wbm
 
+def parse_bag_options(args):
+    """Optional experiment arguments: bag size [rank]
+
+    The sparse features then go into a bilinear_layer.EmbeddingBagLayer
+    of the given size (factorized through the rank if given).
+    Returns the keyword arguments bag_size and bag_rank.
+    """
+    if len(args) == 0 or args[0] != 'bag':
+        return {}
+    options = {'bag_size': int(args[1])}
+    if len(args) > 2:
+        options['bag_rank'] = int(args[2])
+    return options
+
 def set_logger(file_name, dry_mode=False):
     if not dry_mode:
         sys.stdout = open('%s.log' % file_name, 'w', 1)
@@ -243,13 +538,14 @@ from cognitive_disco.nets.learning import DataTriplet
 from cognitive_disco.data_reader import extract_implicit_relations
 from cognitive_disco.nets.lstm import prep_serrated_matrix_relations
 
-def get_data_srm(dir_list, wbm, max_length=75):
+def get_data_srm(dir_list, wbm, max_length=75, index_only=False):
     sense_lf = l.SecondLevelLabel()
     relation_list_list = [extract_implicit_relations(dir, sense_lf) 
             for dir in dir_list]
     data_list = []
     for relation_list in relation_list_list:
-        data = prep_serrated_matrix_relations(relation_list, wbm, max_length)
+        data = prep_serrated_matrix_relations(relation_list, wbm, max_length,
+                index_only)
         data_list.append(data)
     label_vectors, label_alphabet = \
             label_vectorize(relation_list_list, sense_lf)
@@ -262,14 +558,15 @@ def make_givens_srm(givens, input_vec, T_training_data,
     """Make the 'given' dict for SGD training for discourse
 
     the input vecs should be [X1 mask1 X2 mask2]
-    X1 and X2 are TxNxd serrated matrices.
+    X1 and X2 are TxNxd serrated matrices 
+    (or TxN token index matrices for lstm.EmbeddingLayer).
     """
     # first arg embedding and mask
-    givens[input_vec[0]] = T_training_data[0][:,start_idx:end_idx, :]
+    givens[input_vec[0]] = T_training_data[0][:,start_idx:end_idx]
     givens[input_vec[1]] = T_training_data[1][:,start_idx:end_idx]
 
     # second arg embedding and mask
-    givens[input_vec[2]] = T_training_data[2][:,start_idx:end_idx, :]
+    givens[input_vec[2]] = T_training_data[2][:,start_idx:end_idx]
     givens[input_vec[3]] = T_training_data[3][:,start_idx:end_idx]
 
     for i, output_var in enumerate(output_vec):
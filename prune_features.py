@@ -1,9 +1,54 @@
 """Prune features that are fewer than the specified number"""
+import math
 import os
 from collections import Counter
 from codecs import open as copen
 import argparse
 
+import numpy as np
+
+
+class CountMinSketch(object):
+    """Count-min sketch for approximate feature counting
+
+    The memory is fixed at depth x width counters no matter how many
+    distinct features we see. The estimate never undercounts, so a feature
+    whose true count is above the cutoff is never pruned by mistake.
+    With probability 1 - delta, the overcount is at most epsilon * total
+    where epsilon = e / width and delta = exp(-depth).
+    """
+
+    def __init__(self, width, depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth, width), dtype='uint32')
+        self.total = 0
+
+    def _buckets(self, feature):
+        return [hash((i, feature)) % self.width for i in xrange(self.depth)]
+
+    def add(self, feature, count=1):
+        for i, bucket in enumerate(self._buckets(feature)):
+            self.table[i, bucket] += count
+        self.total += count
+
+    def __getitem__(self, feature):
+        return min(self.table[i, bucket]
+                for i, bucket in enumerate(self._buckets(feature)))
+
+    def epsilon(self):
+        return math.e / self.width
+
+    def delta(self):
+        return math.exp(-self.depth)
+
+    def error_bound(self):
+        """The maximum overcount with probability 1 - delta"""
+        return self.epsilon() * self.total
+
+    def num_bytes(self):
+        return self.table.nbytes
+
 
 def get_feature_counter(file_name, counter):
     """Count each feature and put the counts in a Counter
@@ -19,6 +64,34 @@ def get_feature_counter(file_name, counter):
             counter[feature] += 1
     return counter
 
+def get_feature_sketch(file_name, sketch):
+    """Count each feature approximately and put the counts in a CountMinSketch
+
+    Same format as get_feature_counter. The file is streamed line by line
+    so that we never hold the whole file in the memory.
+    """
+    with copen(file_name, encoding='utf8') as f:
+        for line in f:
+            name, label, features = line.strip().split('\t')
+            for feature in features.split(' '):
+                sketch.add(feature)
+    return sketch
+
+def get_candidate_counter(file_name, sketch, cutoff, counter):
+    """Count exactly only the features that the sketch says are above cutoff
+
+    This is the second pass. The sketch never undercounts, so every feature
+    above the cutoff is a candidate. The exact counts weed out the
+    false positives that come from hash collisions.
+    """
+    with copen(file_name, encoding='utf8') as f:
+        for line in f:
+            name, label, features = line.strip().split('\t')
+            for feature in features.split(' '):
+                if feature in counter or sketch[feature] > cutoff:
+                    counter[feature] += 1
+    return counter
+
 def rewrite_training_file(file_name, counter, cutoff):
     """Overwrite the file such that the features are pruned based on the cutoff"""
     write_training_file(file_name, file_name, counter, cutoff)
@@ -40,12 +113,45 @@ def write_training_file(file_name, new_file_name, counter, cutoff):
         new_training_file.write('%s\t%s\t%s\n' % (name, label, ' '.join(features)))
     new_training_file.close()
 
+def approximate_feature_counter(file_names, cutoff, sketch_width, sketch_depth=4):
+    """Two-pass feature counting with fixed memory for the first pass
+
+    The first pass fills up a count-min sketch. The second pass counts
+    exactly only the features whose estimated counts are above the cutoff.
+    Returns the exact Counter over the candidates and the sketch.
+    """
+    sketch = CountMinSketch(sketch_width, sketch_depth)
+    for file_name in file_names:
+        get_feature_sketch(file_name, sketch)
+    print 'Sketch uses %s bytes. ' % sketch.num_bytes() + \
+            'Overcount <= %s with probability %s' % \
+            (sketch.error_bound(), 1 - sketch.delta())
 
-def prune_features_cutoff_list(file_names, cutoff_list):
     counter = Counter()
     for file_name in file_names:
-        get_feature_counter(file_name, counter)
-    num_features = len(counter)
+        get_candidate_counter(file_name, sketch, cutoff, counter)
+    num_false_positives = len([x for x in counter if counter[x] <= cutoff])
+    print '%s candidate features. %s of them are false positives' % \
+            (len(counter), num_false_positives)
+    return counter, sketch
+
+def prune_features_cutoff_list(file_names, cutoff_list,
+        sketch_width=None, sketch_depth=4):
+    """Prune the features at each cutoff
+
+    If sketch_width is specified, we count approximately with a count-min
+    sketch first and then count exactly only the surviving candidates, so
+    the memory does not grow with the number of distinct features.
+    """
+    if sketch_width is None:
+        counter = Counter()
+        for file_name in file_names:
+            get_feature_counter(file_name, counter)
+        num_features = len(counter)
+    else:
+        counter, sketch = approximate_feature_counter(file_names,
+                min(cutoff_list), sketch_width, sketch_depth)
+        num_features = '%s candidate' % len(counter)
     for cutoff in cutoff_list:
         num_reduced_features = len([x for x in counter if counter[x] > cutoff])
         print 'From %s features reduced to %s features' % (num_features, num_reduced_features)
@@ -60,8 +166,13 @@ if __name__ == '__main__':
     argparser.add_argument('--file_names', 
             help='the file name of the datasets that need pruning', type=str, nargs='+')
     argparser.add_argument('--cutoff', 
-            help='the cutoff count', default=20, type=int, nargs='+')
+            help='the cutoff count', default=[20], type=int, nargs='+')
+    argparser.add_argument('--sketch_width',
+            help='count approximately with a count-min sketch of this width',
+            default=None, type=int)
+    argparser.add_argument('--sketch_depth',
+            help='the number of hash functions in the count-min sketch',
+            default=4, type=int)
     args = argparser.parse_args()
-    prune_features_cutoff_list(args.file_names, args.cutoff)
-
-
+    prune_features_cutoff_list(args.file_names, args.cutoff,
+            args.sketch_width, args.sketch_depth)
@@ -0,0 +1,71 @@
+"""Benchmark the sparse matrix construction on a data split
+
+Compare filling a lil_matrix row by row (the old way) with util.CSRBuilder.
+The feature functions are applied once beforehand so that we only time
+the matrix construction.
+
+python benchmark_csr_builder.py conll15-st-05-19-15-train
+"""
+import argparse
+import timeit
+
+import numpy as np
+import scipy as sp
+import scipy.sparse
+
+import cognitive_disco.base_label_functions as l
+import cognitive_disco.feature_functions as f
+from cognitive_disco.data_reader import extract_implicit_relations
+from cognitive_disco.nets.util import CSRBuilder
+
+def featurize_to_indices(relation_list, ff_list):
+    alphabet = {}
+    feature_vectors = []
+    for relation in relation_list:
+        feature_vector_indices = []
+        for ff in ff_list:
+            for feature in ff(relation):
+                if feature not in alphabet:
+                    alphabet[feature] = len(alphabet)
+                feature_vector_indices.append(alphabet[feature])
+        feature_vectors.append(feature_vector_indices)
+    return feature_vectors, len(alphabet)
+
+def lil_build(feature_vectors, num_columns):
+    feature_matrix = sp.sparse.lil_matrix((len(feature_vectors), num_columns))
+    for i, fv in enumerate(feature_vectors):
+        feature_matrix[i, fv] = 1
+    return feature_matrix.tocsr()
+
+def builder_build(feature_vectors, num_columns):
+    builder = CSRBuilder()
+    for fv in feature_vectors:
+        builder.add_row(fv)
+    return builder.tocsr(num_columns)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('dir', help='the data split e.g. the training set')
+    args = parser.parse_args()
+
+    relation_list = extract_implicit_relations(args.dir, l.SecondLevelLabel())
+    bf = f.BrownClusterFeaturizer()
+    feature_vectors, num_columns = featurize_to_indices(relation_list,
+            [bf.brown_words, bf.brown_word_pairs, f.production_rules])
+    nnz = sum(len(x) for x in feature_vectors)
+    print '%s rows %s columns %s non-zeros' % \
+            (len(feature_vectors), num_columns, nnz)
+
+    start_time = timeit.default_timer()
+    X_lil = lil_build(feature_vectors, num_columns)
+    end_time = timeit.default_timer()
+    print 'lil_matrix takes %s seconds' % (end_time - start_time)
+
+    start_time = timeit.default_timer()
+    X_builder = builder_build(feature_vectors, num_columns)
+    end_time = timeit.default_timer()
+    print 'CSRBuilder takes %s seconds' % (end_time - start_time)
+
+    assert (X_lil != X_builder).nnz == 0
+    print 'CSRBuilder indices %s data %s' % \
+            (X_builder.indices.dtype, X_builder.data.dtype)
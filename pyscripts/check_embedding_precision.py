@@ -0,0 +1,70 @@
+"""Check how much accuracy we lose by storing the embeddings in low precision
+
+For each embedding size, we pool the word vectors (sum pooling) from the
+float32, float16, and int8 stores and train the same softmax classifier
+on each. The dev accuracy and the difference from float32 are printed
+along with the largest difference in the pooled features.
+
+python check_embedding_precision.py conll15-st-05-19-15-train conll15-st-05-19-15-dev
+"""
+import argparse
+
+import numpy as np
+import theano.tensor as T
+
+import cognitive_disco.base_label_functions as l
+from cognitive_disco.data_reader import extract_implicit_relations
+from cognitive_disco.nets.bilinear_layer import InputLayer, \
+        make_multilayer_net_from_layers
+from cognitive_disco.nets.learning import AdagradTrainer, DataTriplet
+import cognitive_disco.nets.util as util
+
+def dev_accuracy(data_list, label_vectors, label_alphabet, n_epochs):
+    data_triplet = DataTriplet(data_list, [[x] for x in label_vectors],
+            [label_alphabet])
+    rng = np.random.RandomState(100)
+    input_layers = [InputLayer(rng, n_in, False)
+            for n_in in data_triplet.input_dimensions()]
+    model, _ = make_multilayer_net_from_layers(input_layers, T.lvector(),
+            use_sparse=False, num_hidden_layers=0, num_hidden_units=0,
+            num_output_units=data_triplet.output_dimensions()[0],
+            output_activation_fn=T.nnet.softmax, dropout=False)
+    trainer = AdagradTrainer(model, model.crossentropy, 0.01, 0.01, data_triplet)
+    best_iter, best_dev_acc, best_test_acc = \
+            trainer.train_minibatch_triplet(50, n_epochs)
+    return best_dev_acc
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('train_dir')
+    parser.add_argument('dev_dir')
+    parser.add_argument('--num_units', type=int, nargs='+', default=[50, 100, 300])
+    parser.add_argument('--n_epochs', type=int, default=20)
+    args = parser.parse_args()
+
+    sense_lf = l.SecondLevelLabel()
+    dir_list = [args.train_dir, args.dev_dir]
+    relation_list_list = [extract_implicit_relations(dir, sense_lf)
+            for dir in dir_list]
+    label_vectors, label_alphabet = \
+            util.label_vectorize(relation_list_list, sense_lf)
+    # the dev set doubles as the test set
+    label_vectors.append(label_vectors[1])
+    for num_units in args.num_units:
+        float32_data = None
+        float32_acc = None
+        for precision in ['float32', 'float16', 'int8']:
+            word2vec_ff = util._get_word2vec_ff(num_units, 'sum_pool',
+                    dir_list, precision)
+            data_list = [word2vec_ff(x) for x in relation_list_list]
+            data_list.append(data_list[1])
+            accuracy = dev_accuracy(data_list, label_vectors, label_alphabet,
+                    args.n_epochs)
+            if precision == 'float32':
+                float32_data = data_list
+                float32_acc = accuracy
+            max_diff = max(np.abs(x - y).max()
+                    for a, b in zip(data_list, float32_data)
+                    for x, y in zip(a, b))
+            print '%s units %s: dev accuracy %s delta %s max feature diff %s' % \
+                    (num_units, precision, accuracy, accuracy - float32_acc, max_diff)
@@ -0,0 +1,46 @@
+"""Report how much of the serrated matrices is padding
+
+The LSTM models scan over the full max length for every minibatch.
+This prints the fraction of the scanned time slices that are padding
+with the fixed max length and with the length-bucketed minibatches
+(learning.LengthBucketSampler).
+
+python padding_report.py conll15-st-05-19-15-train conll15-st-05-19-15-dev
+"""
+import argparse
+
+import cognitive_disco.base_label_functions as l
+from cognitive_disco.data_reader import extract_implicit_relations
+from cognitive_disco.nets.learning import DataTriplet, LengthBucketSampler
+from cognitive_disco.nets.lstm import prep_serrated_matrix_relations
+import cognitive_disco.nets.util as util
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('train_dir')
+    parser.add_argument('dev_dir')
+    parser.add_argument('--max_length', type=int, nargs='+', default=[30, 75])
+    parser.add_argument('--minibatch_size', type=int, nargs='+',
+            default=[20, 40, 60])
+    parser.add_argument('--bucket_width', type=int, default=5)
+    args = parser.parse_args()
+
+    sense_lf = l.SecondLevelLabel()
+    dir_list = [args.train_dir, args.dev_dir]
+    relation_list_list = [extract_implicit_relations(dir, sense_lf)
+            for dir in dir_list]
+    label_vectors, label_alphabet = \
+            util.label_vectorize(relation_list_list, sense_lf)
+    label_vectors.append(label_vectors[1])
+    wbm = util.get_wbm(50, dir_list)
+    for max_length in args.max_length:
+        data_list = [prep_serrated_matrix_relations(x, wbm, max_length,
+            index_only=True) for x in relation_list_list]
+        data_list.append(data_list[1])
+        data_triplet = DataTriplet(data_list, [[x] for x in label_vectors],
+                [label_alphabet])
+        bucket_sampler = LengthBucketSampler(data_triplet,
+                bucket_width=args.bucket_width)
+        for minibatch_size in args.minibatch_size:
+            print 'max length %s. %s' % \
+                    (max_length, bucket_sampler.padding_report(minibatch_size))